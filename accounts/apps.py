@@ -4,3 +4,16 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from django.db.models.signals import post_delete, post_save
+
+        from .authentication import invalidate_cached_user
+        from .models import CachedUser
+
+        for model in (User, CachedUser):
+            post_save.connect(invalidate_cached_user, sender=model,
+                              dispatch_uid=f'invalidate_cached_user_save_{model.__name__}')
+            post_delete.connect(invalidate_cached_user, sender=model,
+                                dispatch_uid=f'invalidate_cached_user_delete_{model.__name__}')
@@ -0,0 +1,181 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.utils import aware_utcnow, datetime_to_epoch
+
+from .models import CachedUser
+
+# Shared and never evicted, see CACHES['auth'] in the settings
+auth_cache = ConnectionProxy(caches, 'auth')
+
+# Signed into every token so most requests never load the user
+USER_CLAIMS = ('username', 'is_staff', 'is_active')
+# The password hash stays in the database
+CACHED_FIELDS = tuple(field.attname for field in User._meta.concrete_fields
+                      if field.attname != 'password')
+# Fields a CachedUser built from claims has loaded; the rest are deferred
+CLAIM_FIELDS = tuple(field for field in CACHED_FIELDS
+                     if field in ('id', *USER_CLAIMS))
+
+
+def user_cache_key(user_id):
+    return f'accounts:user:{user_id}'
+
+
+def claims_changed_key(user_id):
+    return f'accounts:user:{user_id}:claims_changed'
+
+
+def now_epoch():
+    # Fractional like the tokens' iat, see UserClaimsRefreshToken.set_iat
+    now = aware_utcnow()
+    return datetime_to_epoch(now) + now.microsecond / 1e6
+
+
+def revoked_key(jti):
+    return f'accounts:revoked:{jti}'
+
+
+def valid_after_key(user_id):
+    return f'accounts:user:{user_id}:valid_after'
+
+
+def revoke_token(token):
+    """
+    Revoke one token by its jti until it would have expired anyway. Returns
+    False if it was already revoked (or has expired), which auth_cache.add makes
+    atomic so a refresh token can only be rotated once.
+    """
+    remaining = token['exp'] - datetime_to_epoch(aware_utcnow())
+    if remaining <= 0:
+        return False
+    return auth_cache.add(revoked_key(token[api_settings.JTI_CLAIM]), 1, remaining)
+
+
+def revoke_user_tokens(user_id):
+    """Revoke every token issued to the user so far with a single cache write."""
+    auth_cache.set(valid_after_key(user_id), now_epoch(),
+                   api_settings.REFRESH_TOKEN_LIFETIME.total_seconds())
+
+
+def get_token_state(token):
+    """Revocation and claim changes that apply to `token`, in one cache read."""
+    user_id = token[api_settings.USER_ID_CLAIM]
+    keys = {
+        'revoked': revoked_key(token[api_settings.JTI_CLAIM]),
+        'valid_after': valid_after_key(user_id),
+        'claims_changed': claims_changed_key(user_id),
+    }
+    found = auth_cache.get_many(keys.values())
+    return {name: found.get(key) for name, key in keys.items()}
+
+
+def is_revoked(token, state):
+    return state['revoked'] is not None or (
+        state['valid_after'] is not None and token.get('iat', 0) <= state['valid_after'])
+
+
+def get_cached_user_values(user_id):
+    """The user's fields (but the password) from the cache, loading them on a miss."""
+    key = user_cache_key(user_id)
+    values = auth_cache.get(key)
+    if values is None:
+        values = User.objects.filter(pk=user_id).values(*CACHED_FIELDS).first()
+        if values is None:
+            return None
+        auth_cache.set(key, values, settings.USER_CACHE_TTL.total_seconds())
+    return values
+
+
+def build_cached_user(values):
+    """A CachedUser from get_cached_user_values(), with only the password deferred."""
+    return CachedUser.from_db('default', CACHED_FIELDS, [values[field] for field in CACHED_FIELDS])
+
+
+def invalidate_cached_user(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    post_save/post_delete receiver for User and CachedUser. QuerySet.update()
+    and bulk_update() send no signals: after changing users that way, call
+    invalidate_cached_user(User, user) for each of them, or their tokens keep
+    the old claims until they expire.
+    """
+    auth_cache.delete(user_cache_key(instance.pk))
+    if created:
+        return
+    # Tokens issued before a change to their claims can't be trusted any
+    # more; this outlives every token that could carry the old claims
+    if update_fields is None or set(update_fields) & {*USER_CLAIMS, 'is_superuser'}:
+        auth_cache.set(claims_changed_key(instance.pk), now_epoch(),
+                       api_settings.REFRESH_TOKEN_LIFETIME.total_seconds())
+
+
+class UserClaimsRefreshToken(RefreshToken):
+    def set_iat(self, claim='iat', at_time=None):
+        # Fractional seconds (allowed for JWT NumericDates), so a token issued
+        # right after a revocation is never mistaken for one from before it
+        at_time = at_time or self.current_time
+        self.payload[claim] = datetime_to_epoch(at_time) + at_time.microsecond / 1e6
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        for claim in USER_CLAIMS:
+            token[claim] = getattr(user, claim)
+        # Copied into the access tokens made from this one
+        return token
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication without the per-request User query. The user is built
+    from the token's signed claims, and fields outside them are read from a
+    per-user cache when a view first needs them. Tokens issued before the
+    user's username, staff or active flags changed fall back to the cached
+    user, and revoked tokens are refused.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(
+                _("Token contained no recognizable user identification"))
+
+        try:
+            state = get_token_state(validated_token)
+        except Exception:
+            # Without the store a revoked token or stale claims can't be
+            # told apart from a good token, so none is accepted
+            raise AuthenticationFailed(
+                _("Token could not be checked"), code="token_not_checked")
+        if is_revoked(validated_token, state):
+            raise AuthenticationFailed(
+                _("Token has been revoked"), code="token_revoked")
+
+        changed_at = state['claims_changed']
+        trusted = all(claim in validated_token for claim in USER_CLAIMS) and (
+            changed_at is None or validated_token.get('iat', 0) > changed_at)
+
+        if trusted:
+            claims = {'id': user_id, **{claim: validated_token[claim]
+                                        for claim in USER_CLAIMS}}
+            user = CachedUser.from_db(
+                'default', CLAIM_FIELDS, [claims[field] for field in CLAIM_FIELDS])
+        else:
+            values = get_cached_user_values(user_id)
+            if values is None:
+                raise AuthenticationFailed(
+                    _("User not found"), code="user_not_found")
+            user = build_cached_user(values)
+
+        if not user.is_active:
+            raise AuthenticationFailed(
+                _("User is inactive"), code="user_inactive")
+        return user
@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from accounts.throttling import METRICS_DAYS, get_rejections
+
+
+class Command(BaseCommand):
+    help = "Show how many login, register and password requests were throttled per day."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7,
+                            help=f"Number of days to show, today included (default: 7, at most {METRICS_DAYS}).")
+
+    def handle(self, *args, **options):
+        if not 1 <= options['days'] <= METRICS_DAYS:
+            raise CommandError(
+                f"--days must be between 1 and {METRICS_DAYS}.")
+
+        rejections = get_rejections(options['days'])
+        today = timezone.localdate()
+        for offset in range(options['days']):
+            day = today - timedelta(days=offset)
+            counts = [
+                f"{scope}/{kind}={rejections.get((day, scope, kind), 0)}"
+                for scope, rates in settings.AUTH_THROTTLE_RATES.items()
+                for kind in rates
+            ]
+            self.stdout.write(f"{day}: {' '.join(counts)}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{sum(rejections.values())} requests throttled in the last {options['days']} days."))
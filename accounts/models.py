@@ -22,3 +22,28 @@ class Address(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class CachedUser(User):
+    # The user behind a JWT, built from the token's claims without a query.
+    # Any other field is filled from the per-user cache in
+    # accounts.authentication the first time it is read.
+    class Meta:
+        proxy = True
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        from .authentication import get_cached_user_values
+
+        deferred = self.get_deferred_fields()
+        if fields is None or not deferred.issuperset(fields):
+            return super().refresh_from_db(using=using, fields=fields, **kwargs)
+
+        values = get_cached_user_values(self.pk)
+        if values is None:
+            raise User.DoesNotExist("User matching query does not exist.")
+        missing = [field for field in fields if field not in values]
+        for field in deferred.intersection(values):
+            setattr(self, field, values[field])
+        if missing:
+            # The password hash is never cached
+            super().refresh_from_db(using=using, fields=missing, **kwargs)
@@ -2,10 +2,10 @@ from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from rest_framework_simplejwt.tokens import RefreshToken
 
 from revvona.utils import CustomSerializer, error_response
 
+from .authentication import UserClaimsRefreshToken
 from .models import Address
 
 
@@ -35,11 +35,13 @@ class UserRegisterTokenSerializer(UserSerializer):
         fields = ["id", "username", "email", "token"]
 
     def get_token(self, obj):
-        token = RefreshToken.for_user(obj)
+        token = UserClaimsRefreshToken.for_user(obj)
         return str(token.access_token)
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = UserClaimsRefreshToken
+
     @classmethod
     def get_token(cls, user):
         token = super().get_token(user)
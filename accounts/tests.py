@@ -1,7 +1,34 @@
+import importlib.util
+import os
+import threading
+from io import StringIO
+from unittest import mock
+
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.core import mail
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
 from django.template.loader import render_to_string
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from cart.views import CartViewSet
+
+from .authentication import (ClaimsJWTAuthentication, UserClaimsRefreshToken,
+                             auth_cache, get_token_state,
+                             invalidate_cached_user)
+from .throttling import SlidingWindowThrottle, get_rejections
 
 
 class EmailAppearanceTest(SimpleTestCase):
@@ -56,3 +83,281 @@ class EmailAppearanceTest(SimpleTestCase):
             self.assertIn('x.com', sent_email.body)  # Ensure token is present
             # Ensure username is present
             self.assertIn(user['username'], sent_email.body)
+
+
+class ClaimsAuthenticationTest(TestCase):
+    def setUp(self):
+        auth_cache.clear()
+        self.user = User.objects.create_user(
+            'buyer', 'buyer@example.com', 'pw')
+        self.access = str(UserClaimsRefreshToken.for_user(self.user).access_token)
+
+    def authenticate(self):
+        request = APIRequestFactory().get(
+            '/', HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        return ClaimsJWTAuthentication().authenticate(request)[0]
+
+    def test_user_comes_from_the_claims(self):
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+            self.assertEqual((user.pk, user.username, user.is_active),
+                             (self.user.pk, 'buyer', True))
+
+        # Other fields are loaded once, then served from the cache
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'buyer@example.com')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate().email, 'buyer@example.com')
+
+    def test_cart_read_does_one_query_less(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        client.get(reverse('cart-detail'))  # Creates the cart
+
+        queries = []
+        for authentication in (JWTAuthentication, ClaimsJWTAuthentication):
+            with mock.patch.object(CartViewSet, 'authentication_classes', [authentication]):
+                with CaptureQueriesContext(connection) as captured:
+                    self.assertEqual(client.get(
+                        reverse('cart-detail')).status_code, 200)
+            queries.append(len(captured))
+
+        self.assertEqual(queries[1], queries[0] - 1)
+
+    def test_changed_users_are_reloaded(self):
+        self.authenticate().email  # Cached
+        self.user.username = 'renamed'
+        self.user.save()
+        self.assertEqual(self.authenticate().username, 'renamed')
+
+        self.user.is_active = False
+        self.user.save(update_fields=['is_active'])
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_claim_changes_outlive_the_default_cache(self):
+        self.user.is_active = False
+        self.user.save(update_fields=['is_active'])
+        # Throttle counters and the dashboard can fill or clear the default cache
+        cache.clear()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_queryset_updates_need_an_explicit_invalidation(self):
+        self.authenticate().email  # Cached
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        # No signal is sent, so the old claims are still trusted
+        self.assertTrue(self.authenticate().is_active)
+
+        invalidate_cached_user(User, self.user)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_tokens_are_refused_when_the_store_is_down(self):
+        with mock.patch.object(auth_cache, 'get_many', side_effect=ConnectionError):
+            with self.assertRaises(AuthenticationFailed) as raised:
+                self.authenticate()
+        self.assertEqual(raised.exception.detail.code, 'token_not_checked')
+
+
+class TokenRevocationTest(TestCase):
+    def setUp(self):
+        auth_cache.clear()
+        self.user = User.objects.create_user(
+            'buyer', 'buyer@example.com', 'old-password-123')
+        self.refresh = UserClaimsRefreshToken.for_user(self.user)
+        self.client = APIClient()
+
+    def refresh_with(self, token):
+        return self.client.post(reverse('token-refresh'), {'refresh_token': str(token)})
+
+    def get_profile(self, access):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        status_code = self.client.get(reverse('user-profile')).status_code
+        self.client.credentials()
+        return status_code
+
+    def test_refresh_tokens_rotate_once(self):
+        response = self.refresh_with(self.refresh)
+        self.assertEqual(response.status_code, 200)
+        rotated = response.data['data']['refresh_token']
+        self.assertNotEqual(rotated, str(self.refresh))
+
+        # Replaying the old token fails and ends every session, the rotated one included
+        self.assertEqual(self.refresh_with(self.refresh).status_code, 401)
+        self.assertEqual(self.refresh_with(rotated).status_code, 401)
+
+    def test_refresh_check_is_one_cache_read(self):
+        with mock.patch('accounts.authentication.auth_cache', wraps=auth_cache) as wrapped:
+            get_token_state(self.refresh)
+        self.assertEqual(wrapped.get_many.call_count, 1)
+        self.assertEqual(wrapped.get.call_count, 0)
+
+    def test_password_change_revokes_every_session(self):
+        other_session = UserClaimsRefreshToken.for_user(self.user)
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f'Bearer {self.refresh.access_token}')
+        response = self.client.patch(reverse('change-password'), {
+            'curr_password': 'old-password-123', 'new_password': 'new-password-456'})
+        self.client.credentials()
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.get_profile(self.refresh.access_token), 401)
+        self.assertEqual(self.refresh_with(other_session).status_code, 401)
+        # The pair returned with the response keeps this session logged in
+        self.assertEqual(self.get_profile(response.data['data']['access_token']), 200)
+        self.assertEqual(self.refresh_with(
+            response.data['data']['refresh_token']).status_code, 200)
+
+    def test_logout_revokes_the_tokens(self):
+        access = self.refresh.access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.assertEqual(self.client.post(reverse('logout'), {
+            'refresh_token': str(self.refresh)}).status_code, 200)
+        self.client.credentials()
+
+        self.assertEqual(self.get_profile(access), 401)
+        self.assertEqual(self.refresh_with(self.refresh).status_code, 401)
+
+    def test_revocations_outlive_the_default_cache(self):
+        self.assertEqual(self.refresh_with(self.refresh).status_code, 200)
+        # Throttle counters from a burst of requests fill the default cache
+        cache.set_many({f'throttle:spray:{i}': 1 for i in range(1000)})
+        self.assertEqual(self.refresh_with(self.refresh).status_code, 401)
+
+    def test_failed_revocation_keeps_the_old_password(self):
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f'Bearer {self.refresh.access_token}')
+        with mock.patch.object(auth_cache, 'set', side_effect=ConnectionError):
+            response = self.client.patch(reverse('change-password'), {
+                'curr_password': 'old-password-123', 'new_password': 'new-password-456'})
+        self.assertEqual(response.status_code, 500)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('old-password-123'))
+
+    def test_production_needs_a_shared_auth_cache(self):
+        spec = importlib.util.find_spec('revvona.settings')
+        environ = {key: value for key, value in os.environ.items()
+                   if key not in ('REDIS_URL', 'AUTH_REDIS_URL')}
+        with mock.patch.dict(os.environ, {**environ, 'ENV': 'PROD'}, clear=True):
+            with self.assertRaisesMessage(ImproperlyConfigured, 'AUTH_REDIS_URL'):
+                spec.loader.exec_module(importlib.util.module_from_spec(spec))
+
+            os.environ['AUTH_REDIS_URL'] = 'redis://localhost:6380/0'
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        self.assertEqual(module.CACHES['auth']['LOCATION'], 'redis://localhost:6380/0')
+
+
+@override_settings(AUTH_THROTTLE_RATES={
+    'login': {'ip': '4/m', 'username': '2/m', 'account': '3/m'},
+    'register': {'ip': '5/h', 'email': '3/h'},
+    'password': {'user': '5/h'},
+})
+class SlidingWindowThrottleTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def login(self, username, at, **extra):
+        with mock.patch('accounts.throttling.now_epoch', return_value=at):
+            return self.client.post(reverse('login'), {'username': username, 'password': 'pw'}, **extra)
+
+    def test_rejections_happen_before_any_query(self):
+        self.assertEqual(self.login('nobody', 1000).status_code, 404)
+        self.assertEqual(self.login('NoBody ', 1001).status_code, 404)
+
+        # The same username however it's typed, rejected without a user lookup
+        with self.assertNumQueries(0):
+            response = self.login('nobody', 1002)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '18')
+
+        # Other usernames run into the per-IP limit
+        self.assertEqual(self.login('other', 1003).status_code, 404)
+        self.assertEqual(self.login('another', 1004).status_code, 404)
+        self.assertEqual(self.login('third', 1005).status_code, 429)
+
+        rejections = get_rejections(1)
+        self.assertEqual(sum(count for (day, scope, kind), count in rejections.items()
+                             if kind == 'username'), 1)
+        self.assertEqual(sum(count for (day, scope, kind), count in rejections.items()
+                             if kind == 'ip'), 1)
+        out = StringIO()
+        call_command('throttle_stats', '--days', '1', stdout=out)
+        self.assertIn('login/ip=1 login/username=1', out.getvalue())
+
+    def test_previous_window_counts_by_its_overlap(self):
+        self.login('nobody', 960)
+        self.login('nobody', 961)
+        self.assertEqual(self.login('nobody', 975).status_code, 429)
+
+        # 45s into the next window a quarter of the previous one still counts
+        self.assertEqual(self.login('nobody', 1065).status_code, 404)
+        self.assertEqual(self.login('nobody', 1065).status_code, 404)
+        self.assertEqual(self.login('nobody', 1065).status_code, 429)
+
+    def test_failed_logins_elsewhere_do_not_lock_the_owner_out(self):
+        self.login('nobody', 1000, REMOTE_ADDR='198.51.100.1')
+        self.login('nobody', 1001, REMOTE_ADDR='198.51.100.1')
+        self.assertEqual(self.login('nobody', 1002, REMOTE_ADDR='198.51.100.1').status_code, 429)
+
+        self.assertEqual(self.login('nobody', 1003, REMOTE_ADDR='198.51.100.2').status_code, 404)
+
+    def test_failed_logins_from_many_ips_hit_the_account_limit(self):
+        for n in range(3):
+            self.assertEqual(self.login(
+                'nobody', 1000, REMOTE_ADDR=f'198.51.100.{n}').status_code, 404)
+        response = self.login('nobody', 1001, REMOTE_ADDR='198.51.100.9')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(get_rejections(1)[
+            timezone.localdate(), 'login', 'account'], 1)
+
+        # The rejected attempt used up nothing of its IP's limit
+        for n in range(4):
+            self.assertEqual(self.login(
+                f'user{n}', 1002, REMOTE_ADDR='198.51.100.9').status_code, 404)
+
+    def test_parallel_requests_cannot_overshoot_the_limit(self):
+        requests = [Request(APIRequestFactory().post('/', {'username': 'nobody'}, format='json'),
+                            parsers=[JSONParser()]) for _ in range(6)]
+        for request in requests:
+            request.data
+        # Every request reads the counters before any of them is counted
+        barrier = threading.Barrier(len(requests))
+        get_many = LocMemCache.get_many
+
+        def read_together(self, keys, version=None):
+            counts = get_many(self, keys, version)
+            barrier.wait(timeout=5)
+            return counts
+
+        allowed = []
+        with mock.patch('accounts.throttling.now_epoch', return_value=1000), \
+                mock.patch.object(LocMemCache, 'get_many', read_together):
+            threads = [threading.Thread(target=lambda request=request: allowed.append(
+                SlidingWindowThrottle('login').allow_request(request, None))) for request in requests]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(allowed.count(True), 2)
+        self.assertEqual(self.login('nobody', 1001).status_code, 429)
+
+    @override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1})
+    def test_forwarded_for_only_trusts_the_proxy(self):
+        # The proxy appends the address it saw to whatever the client sent
+        for n in range(4):
+            self.assertEqual(self.login(
+                f'user{n}', 1000, HTTP_X_FORWARDED_FOR=f'spoof-{n}, 203.0.113.7').status_code, 404)
+        self.assertEqual(self.login(
+            'user4', 1001, HTTP_X_FORWARDED_FOR='spoof-4, 203.0.113.7').status_code, 429)
+        self.assertEqual(self.login(
+            'user4', 1001, HTTP_X_FORWARDED_FOR='203.0.113.8').status_code, 404)
+
+    def test_forwarded_for_is_ignored_without_a_proxy(self):
+        for n in range(4):
+            self.login(f'user{n}', 1000, HTTP_X_FORWARDED_FOR=f'203.0.113.{n}')
+        self.assertEqual(self.login(
+            'user4', 1001, HTTP_X_FORWARDED_FOR='203.0.113.9').status_code, 429)
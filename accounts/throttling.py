@@ -0,0 +1,135 @@
+import hashlib
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework.throttling import BaseThrottle
+
+from .authentication import now_epoch
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+# Rejection counters are kept per day for this long
+METRICS_DAYS = 8
+
+
+def parse_rate(rate):
+    """'5/m' or '5/15m' -> (5 requests, 60 or 900 seconds)."""
+    requests, period = rate.split('/')
+    count = int(period[:-1] or 1)
+    return int(requests), count * PERIODS[period[-1]]
+
+
+def rejections_key(day, scope, kind):
+    return f'throttle:rejected:{day:%Y-%m-%d}:{scope}:{kind}'
+
+
+def increment(key, timeout):
+    """Add one to the counter at `key`, starting it if needed, and return the new count."""
+    if cache.add(key, 1, timeout):
+        return 1
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Expired between add and incr
+        cache.set(key, 1, timeout)
+        return 1
+
+
+def record_rejection(scope, kind):
+    increment(rejections_key(timezone.localdate(), scope, kind),
+              METRICS_DAYS * PERIODS['d'])
+
+
+def get_rejections(days):
+    """{(day, scope, kind): rejected requests} for the last `days` days, in one cache read."""
+    today = timezone.localdate()
+    keys = {
+        rejections_key(today - timedelta(days=offset), scope, kind): (today - timedelta(days=offset), scope, kind)
+        for offset in range(days)
+        for scope, rates in settings.AUTH_THROTTLE_RATES.items()
+        for kind in rates
+    }
+    return {keys[key]: count for key, count in cache.get_many(keys).items()}
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    Limits a scope of AUTH_THROTTLE_RATES per client IP and per submitted
+    username (from that IP, and from any IP), email or logged-in user, using
+    sliding-window counters in the cache. Each window keeps a counter for
+    the current and the previous fixed window, and the previous one is
+    weighted by how much of it still overlaps the sliding window. Requests
+    are counted before the check, so concurrent ones never see the same
+    count, and rejected requests are uncounted again. They never reach the
+    database or the password hasher.
+    """
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.rates = {kind: parse_rate(rate)
+                      for kind, rate in settings.AUTH_THROTTLE_RATES[scope].items()}
+        self.wait_seconds = None
+
+    def get_identities(self, request):
+        data = request.data if hasattr(request.data, 'get') else {}
+        username = str(data.get('username') or '').strip().lower()
+        email = str(data.get('email') or '').strip().lower()
+        # Login takes a username or an email in the same field
+        login = username or email
+        # Set by the proxies in REST_FRAMEWORK['NUM_PROXIES'], not the client
+        ip = self.get_ident(request)
+        identities = {
+            'ip': ip,
+            # Counted per IP too, so failed logins from elsewhere can't lock
+            # the owner out
+            'username': login and (login, ip),
+            'account': login,
+            'email': email,
+        }
+        if 'user' in self.rates and request.user.is_authenticated:
+            identities['user'] = request.user.pk
+        return identities
+
+    def get_windows(self, request, now):
+        identities = self.get_identities(request)
+        for kind, (limit, window) in self.rates.items():
+            identity = identities.get(kind)
+            if not identity:
+                continue
+            # Hashed so emails don't end up in cache keys
+            digest = hashlib.sha256(str(identity).encode()).hexdigest()[:32]
+            index, offset = divmod(now, window)
+            prefix = f'throttle:{self.scope}:{kind}:{digest}'
+            yield (kind, limit, window, offset,
+                   f'{prefix}:{int(index)}', f'{prefix}:{int(index) - 1}')
+
+    def allow_request(self, request, view):
+        now = now_epoch()
+        windows = list(self.get_windows(request, now))
+        previous_counts = cache.get_many([previous for *_, previous in windows])
+
+        counted = []
+        for kind, limit, window, offset, current, previous in windows:
+            # Counted first and decided on the count the increment returns,
+            # so a burst can't all read the same count and pass together.
+            # Kept for two windows, while it can still be the previous one
+            count = increment(current, 2 * window)
+            counted.append(current)
+            earlier = count - 1 + \
+                previous_counts.get(previous, 0) * (window - offset) / window
+            if earlier >= limit:
+                for key in counted:
+                    try:
+                        cache.decr(key)
+                    except ValueError:
+                        # Expired meanwhile, nothing left to take back
+                        pass
+                record_rejection(self.scope, kind)
+                self.wait_seconds = math.ceil(window - offset)
+                return False
+        return True
+
+    def wait(self):
+        return self.wait_seconds
@@ -3,8 +3,8 @@ from django.contrib.auth.hashers import check_password, make_password
 from django.contrib.auth.models import User
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
-from django.core.mail import send_mail
 from django.core.validators import validate_email
+from django.db import transaction
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.encoding import force_bytes, force_str
@@ -12,14 +12,28 @@ from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from rest_framework import status, viewsets
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import AllowAny, IsAuthenticated
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
 
+from notifications.outbox import enqueue_email
 from revvona.utils import CustomPagination, error_response, success_response
 
+from .authentication import (UserClaimsRefreshToken, build_cached_user,
+                             get_cached_user_values, get_token_state,
+                             is_revoked, revoke_token, revoke_user_tokens)
 from .models import Address
 from .serializers import (AddressSerializer, CustomTokenObtainPairSerializer,
                           ProfileSerializer, UserRegisterTokenSerializer,
                           UserSerializer)
+from .throttling import SlidingWindowThrottle
+
+
+# AUTH_THROTTLE_RATES scope of each throttled action
+THROTTLE_SCOPES = {
+    'login_user': 'login',
+    'register_user': 'register',
+    'change_password': 'password',
+}
 
 
 class UserAuthViewSet(viewsets.ViewSet):
@@ -30,6 +44,11 @@ class UserAuthViewSet(viewsets.ViewSet):
             self.permission_classes = [IsAuthenticated]
         return super().get_permissions()
 
+    def get_throttles(self):
+        # Checked before the action runs, so no user lookup or hashing happens
+        scope = THROTTLE_SCOPES.get(self.action)
+        return [SlidingWindowThrottle(scope)] if scope else []
+
     def register_user(self, request, *args, **kwargs):
         try:
             # Check if the user is already logged in
@@ -52,16 +71,18 @@ class UserAuthViewSet(viewsets.ViewSet):
             if User.objects.filter(email=email).exists():
                 return error_response("A user with that email address already exists!", status_code=status.HTTP_403_FORBIDDEN)
 
-            # Create the user with is_active=False for email verification
-            user = User.objects.create(
-                username=username,
-                email=email,
-                password=make_password(data.get("password")),
-                is_active=False
-            )
+            # Create the user and queue the email together so neither exists without the other
+            with transaction.atomic():
+                # Create the user with is_active=False for email verification
+                user = User.objects.create(
+                    username=username,
+                    email=email,
+                    password=make_password(data.get("password")),
+                    is_active=False
+                )
 
-            # Send verification email
-            self.send_verification_email(user)
+                # Queue verification email
+                self.send_verification_email(user)
 
             # Return success response
             return success_response(
@@ -79,7 +100,7 @@ class UserAuthViewSet(viewsets.ViewSet):
             )
 
     def send_verification_email(self, user):
-        """Send a verification email to the user with a frontend-based verification link."""
+        """Queue a verification email to the user with a frontend-based verification link."""
         token = urlsafe_base64_encode(force_bytes(user.pk))  # Encode user ID
         # Replace with your actual frontend URL
         frontend_url = f"{
@@ -91,14 +112,8 @@ class UserAuthViewSet(viewsets.ViewSet):
             'frontend_url': frontend_url
         })
 
-        send_mail(
-            subject,
-            "",  # Plain text message can be left empty if only HTML is used
-            settings.DEFAULT_FROM_EMAIL,
-            [user.email],
-            fail_silently=False,
-            html_message=html_message  # Use the html_message argument for HTML emails
-        )
+        # Sent by the send_outbox worker
+        enqueue_email(subject, [user.email], html_message=html_message)
 
     def verify_email(self, request):
         """Verify email with uid and token sent from the frontend."""
@@ -167,7 +182,7 @@ class UserAuthViewSet(viewsets.ViewSet):
             user.save(update_fields=['last_login'])
 
             # Retrieve tokens from the serializer
-            refresh = RefreshToken.for_user(user)
+            refresh = UserClaimsRefreshToken.for_user(user)
             access_token = str(refresh.access_token)
             refresh_token = str(refresh)
 
@@ -188,7 +203,7 @@ class UserAuthViewSet(viewsets.ViewSet):
             return error_response("An error occurred during login.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     def refresh_token(self, request, *args, **kwargs):
-        """Handle token refresh using the refresh token."""
+        """Rotate the refresh token: the one sent is revoked and a new pair is returned."""
         try:
             refresh_token = request.data.get('refresh_token')
 
@@ -196,22 +211,51 @@ class UserAuthViewSet(viewsets.ViewSet):
                 return error_response("Refresh token is required.", status_code=status.HTTP_400_BAD_REQUEST)
 
             try:
-                refresh = RefreshToken(refresh_token)
-                access_token = str(refresh.access_token)
-
-                return success_response({
-                    "access_token": access_token,
-                }, "Access token refreshed successfully.")
-            except Exception as e:
+                refresh = UserClaimsRefreshToken(refresh_token)
+            except TokenError as e:
                 return error_response("Invalid or expired refresh token.", str(e), status_code=status.HTTP_401_UNAUTHORIZED)
 
+            user_id = refresh[api_settings.USER_ID_CLAIM]
+            state = get_token_state(refresh)
+            if is_revoked(refresh, state):
+                if state['revoked'] is not None:
+                    # An already rotated token is being replayed, so it has
+                    # leaked: end every session of the user
+                    revoke_user_tokens(user_id)
+                return error_response("Invalid or expired refresh token.", "Token has been revoked.", status_code=status.HTTP_401_UNAUTHORIZED)
+
+            # Fails if a concurrent request rotated the same token first
+            if not revoke_token(refresh):
+                return error_response("Invalid or expired refresh token.", "Token has been revoked.", status_code=status.HTTP_401_UNAUTHORIZED)
+
+            # The new pair carries the user's current claims
+            values = get_cached_user_values(user_id)
+            if values is None or not values['is_active']:
+                return error_response("Invalid or expired refresh token.", "User not found or inactive.", status_code=status.HTTP_401_UNAUTHORIZED)
+            refresh = UserClaimsRefreshToken.for_user(build_cached_user(values))
+
+            return success_response({
+                "access_token": str(refresh.access_token),
+                "refresh_token": str(refresh),
+            }, "Access token refreshed successfully.")
+
         except Exception as e:
             return error_response("An error occurred while refreshing the token.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     def logout_user(self, request):
-        """Log out the user."""
+        """Log out the user, revoking the access token used and the refresh token sent."""
         try:
-            # Perform logout logic for JWT-based auth (typically just a client-side action)
+            revoke_token(request.auth)
+
+            refresh_token = request.data.get('refresh_token')
+            if refresh_token:
+                try:
+                    refresh = UserClaimsRefreshToken(refresh_token)
+                    if refresh[api_settings.USER_ID_CLAIM] == request.user.pk:
+                        revoke_token(refresh)
+                except TokenError:
+                    pass  # Expired already
+
             return success_response({}, "Logout successful.", status_code=status.HTTP_200_OK)
         except Exception as e:
             return error_response("An error occurred during logout.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -238,20 +282,20 @@ class UserAuthViewSet(viewsets.ViewSet):
             except ValidationError as e:
                 return error_response("Password validation error.", str(e), status_code=status.HTTP_400_BAD_REQUEST)
 
-            # Set and save the new password
-            user.set_password(new_password)
-            user.save(update_fields=['password'])
+            # Set and save the new password, then log the user out of every
+            # session; if the revocation fails the password is not changed
+            with transaction.atomic():
+                user.set_password(new_password)
+                user.save(update_fields=['password'])
+                revoke_user_tokens(user.pk)
 
-            # Optionally, log the user out of all sessions by invalidating tokens (JWT)
-            # refresh_token = request.data.get("refresh_token")
-            # if refresh_token:
-            #     try:
-            #         token = RefreshToken(refresh_token)
-            #         token.blacklist()
-            #     except Exception:
-            #         pass  # Handle errors if needed
+            # Give this session a new pair
+            refresh = UserClaimsRefreshToken.for_user(user)
 
-            return success_response({}, "Password updated successfully.", status_code=status.HTTP_200_OK)
+            return success_response({
+                "access_token": str(refresh.access_token),
+                "refresh_token": str(refresh),
+            }, "Password updated successfully.", status_code=status.HTTP_200_OK)
 
         except Exception as e:
             return error_response("An error occurred while changing the password.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -1,6 +1,7 @@
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 
 from products.models import Product
 
@@ -33,3 +34,6 @@ class CartItem(models.Model):
 
         # Proceed with saving if it's not a duplicate
         super().save(*args, **kwargs)
+
+        # Touch the cart so purge_stale only removes carts nobody is using
+        Cart.objects.filter(pk=self.cart_id).update(updated_at=timezone.now())
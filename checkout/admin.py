@@ -1,7 +1,17 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from unfold.admin import ModelAdmin, TabularInline
 
-from .models import Order, OrderItem, Payment
+from .emails import resend_order_confirmation_email
+from .export import FORMATS, export_queryset, iter_orders
+from .inventory import release_orders_reservations, restock_orders
+from .models import (ArchivedMonthlyTotal, ArchivedOrder, ArchivedOrderItem,
+                     ArchivedOrderStatusEvent, ArchivedPayment, Order,
+                     OrderItem, OrderStatusEvent, Payment, PaymentWebhookEvent,
+                     StockReservation)
+from .transitions import bulk_transition
 
 
 class OrderItemInline(TabularInline):
@@ -10,14 +20,29 @@ class OrderItemInline(TabularInline):
     can_delete = True  # Allow deletion of order items in admin
 
 
+class OrderStatusEventInline(TabularInline):
+    model = OrderStatusEvent
+    extra = 0
+    can_delete = False
+    fields = ('from_status', 'status', 'at', 'source')
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class OrderAdmin(ModelAdmin):
     list_display = ('id', 'user', 'total_price', 'delivery_charge', 'shipping_address',
                     'billing_address', 'status', 'created_at', 'updated_at')
     list_filter = ('status', 'created_at', 'updated_at')
     search_fields = ('user__username', 'shipping_address__street',
                      'billing_address__street')
-    inlines = [OrderItemInline]
-    readonly_fields = ('created_at', 'updated_at')
+    inlines = [OrderItemInline, OrderStatusEventInline]
+    # Status only changes through the actions below so every change is logged
+    readonly_fields = ('status', 'created_at', 'updated_at')
+    # Confirmation is left to the payment flow, which also commits the stock
+    actions = ['mark_delivered', 'mark_cancelled', 'mark_returned',
+               'resend_confirmation_email', 'export_csv', 'export_jsonl']
 
     fieldsets = (
         (None, {
@@ -28,6 +53,69 @@ class OrderAdmin(ModelAdmin):
         }),
     )
 
+    def get_queryset(self, request):
+        # The stored email HTML is only needed by the resend action
+        return super().get_queryset(request).defer('confirmation_email_html')
+
+    def move_orders(self, request, queryset, to_status):
+        order_ids = list(queryset.values_list('pk', flat=True))
+        moved = bulk_transition(
+            order_ids, to_status, source=f"admin:{request.user.username}")
+        self.message_user(request, f"{len(moved)} orders marked {to_status}.")
+        if len(moved) < len(order_ids):
+            self.message_user(
+                request,
+                f"{len(order_ids) - len(moved)} orders were skipped because they can't move to {to_status}.",
+                level=messages.WARNING)
+        return moved
+
+    @admin.action(description="Mark selected orders as delivered")
+    def mark_delivered(self, request, queryset):
+        self.move_orders(request, queryset, 'delivered')
+
+    @admin.action(description="Cancel selected orders")
+    def mark_cancelled(self, request, queryset):
+        with transaction.atomic():
+            # Locked so the orders can't get confirmed before they move
+            confirmed = set(queryset.select_for_update().filter(
+                status='confirmed').values_list('pk', flat=True))
+            moved = self.move_orders(request, queryset, 'cancelled')
+            restock_orders([pk for pk in moved if pk in confirmed])
+            release_orders_reservations(
+                [pk for pk in moved if pk not in confirmed])
+
+    @admin.action(description="Mark selected returns as returned")
+    def mark_returned(self, request, queryset):
+        self.move_orders(request, queryset, 'returned')
+
+    @admin.action(description="Resend confirmation email")
+    def resend_confirmation_email(self, request, queryset):
+        orders = queryset.exclude(confirmation_email_html='').select_related(
+            'user').defer(None)
+        sent = 0
+        for order in orders:
+            resend_order_confirmation_email(order)
+            sent += 1
+        self.message_user(
+            request, f"{sent} confirmation emails queued for sending.")
+
+    def export(self, queryset, export_format):
+        stream, content_type = FORMATS[export_format]
+        orders = iter_orders(export_queryset(queryset))
+        response = StreamingHttpResponse(
+            stream(orders), content_type=content_type)
+        filename = f"orders-{timezone.localdate():%Y-%m-%d}.{export_format}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    @admin.action(description="Export selected orders as CSV")
+    def export_csv(self, request, queryset):
+        return self.export(queryset, 'csv')
+
+    @admin.action(description="Export selected orders as JSON lines")
+    def export_jsonl(self, request, queryset):
+        return self.export(queryset, 'jsonl')
+
 
 class PaymentAdmin(ModelAdmin):
     list_display = ('id', 'order', 'method', 'amount',
@@ -47,5 +135,97 @@ class PaymentAdmin(ModelAdmin):
     )
 
 
+class StockReservationAdmin(ModelAdmin):
+    list_display = ('id', 'order', 'product', 'quantity',
+                    'status', 'expires_at', 'created_at')
+    list_filter = ('status', 'expires_at')
+    search_fields = ('order__id', 'product__name')
+    readonly_fields = ('order', 'product', 'quantity',
+                       'expires_at', 'created_at')
+
+
+class PaymentWebhookEventAdmin(ModelAdmin):
+    list_display = ('id', 'event', 'event_id', 'received_at', 'processed_at')
+    list_filter = ('event', 'received_at', 'processed_at')
+    search_fields = ('event_id',)
+    readonly_fields = ('event_id', 'event', 'payload',
+                       'received_at', 'processed_at', 'error')
+
+
+class OrderStatusEventAdmin(ModelAdmin):
+    list_display = ('id', 'order', 'from_status', 'status', 'at', 'source')
+    list_filter = ('status', 'at')
+    search_fields = ('order__id', 'source')
+    readonly_fields = ('order', 'from_status', 'status', 'at', 'source')
+
+    # Append-only: rows are written by checkout.transitions and nothing else
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class ArchivedOrderItemInline(TabularInline):
+    model = ArchivedOrderItem
+    extra = 0
+    can_delete = False
+    readonly_fields = ('product', 'quantity', 'discounted_price')
+
+
+class ArchivedPaymentInline(TabularInline):
+    model = ArchivedPayment
+    extra = 0
+    can_delete = False
+    readonly_fields = ('method', 'amount', 'payment_status',
+                       'razorpay_payment_id', 'created_at')
+    exclude = ('razorpay_order_id', 'razorpay_signature')
+
+
+class ArchivedOrderStatusEventInline(TabularInline):
+    model = ArchivedOrderStatusEvent
+    extra = 0
+    can_delete = False
+    fields = ('from_status', 'status', 'at', 'source')
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class ArchivedOrderAdmin(ModelAdmin):
+    list_display = ('id', 'user', 'total_price', 'status',
+                    'created_at', 'updated_at', 'archived_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('id', 'user__username')
+    inlines = [ArchivedOrderItemInline, ArchivedPaymentInline,
+               ArchivedOrderStatusEventInline]
+    readonly_fields = ('id', 'user', 'total_price', 'delivery_charge', 'shipping_address',
+                       'billing_address', 'status', 'created_at', 'updated_at', 'archived_at')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('confirmation_email_html')
+
+    def has_add_permission(self, request):
+        return False
+
+
+class ArchivedMonthlyTotalAdmin(ModelAdmin):
+    list_display = ('month', 'status', 'orders', 'revenue')
+    list_filter = ('status',)
+    readonly_fields = ('month', 'status', 'orders', 'revenue')
+
+    def has_add_permission(self, request):
+        return False
+
+
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Payment, PaymentAdmin)
+admin.site.register(StockReservation, StockReservationAdmin)
+admin.site.register(PaymentWebhookEvent, PaymentWebhookEventAdmin)
+admin.site.register(OrderStatusEvent, OrderStatusEventAdmin)
+admin.site.register(ArchivedOrder, ArchivedOrderAdmin)
+admin.site.register(ArchivedMonthlyTotal, ArchivedMonthlyTotalAdmin)
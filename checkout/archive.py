@@ -0,0 +1,97 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import (ArchivedMonthlyTotal, ArchivedOrder, ArchivedOrderItem,
+                     ArchivedOrderStatusEvent, ArchivedPayment, Order,
+                     OrderItem, OrderStatusEvent, Payment)
+
+# Statuses an order can't leave any more, the only ones safe to archive
+ARCHIVABLE_STATUSES = ('delivered', 'cancelled', 'returned')
+
+
+def archivable_orders(cutoff):
+    return Order.objects.filter(status__in=ARCHIVABLE_STATUSES, updated_at__lt=cutoff)
+
+
+def archive_chunk(queryset, pks):
+    """
+    Move the orders of `queryset` among `pks`, with their items, payment,
+    status history and confirmation email, to the archive tables in one
+    transaction and fold them into the monthly totals. Their stock
+    reservations are dropped. Returns the number of orders and items moved.
+    """
+    with transaction.atomic():
+        # Re-apply the filter so orders that changed since the scan are kept
+        orders = list(queryset.select_for_update().filter(pk__in=pks))
+        if not orders:
+            return 0, 0
+        pks = [order.pk for order in orders]
+        items = list(OrderItem.objects.filter(order_id__in=pks))
+        payments = list(Payment.objects.filter(order_id__in=pks))
+        events = list(OrderStatusEvent.objects.filter(
+            order_id__in=pks).order_by('at', 'id'))
+
+        ArchivedOrder.objects.bulk_create([
+            ArchivedOrder(
+                id=order.pk, user_id=order.user_id, total_price=order.total_price,
+                delivery_charge=order.delivery_charge,
+                shipping_address_id=order.shipping_address_id,
+                billing_address_id=order.billing_address_id, status=order.status,
+                confirmation_email_html=order.confirmation_email_html,
+                created_at=order.created_at, updated_at=order.updated_at,
+            )
+            for order in orders
+        ])
+        ArchivedOrderItem.objects.bulk_create([
+            ArchivedOrderItem(order_id=item.order_id, product_id=item.product_id,
+                              quantity=item.quantity, discounted_price=item.discounted_price)
+            for item in items
+        ])
+        ArchivedPayment.objects.bulk_create([
+            ArchivedPayment(
+                order_id=payment.order_id, method=payment.method, amount=payment.amount,
+                razorpay_order_id=payment.razorpay_order_id,
+                razorpay_payment_id=payment.razorpay_payment_id,
+                razorpay_signature=payment.razorpay_signature,
+                payment_status=payment.payment_status, created_at=payment.created_at,
+            )
+            for payment in payments
+        ])
+        ArchivedOrderStatusEvent.objects.bulk_create([
+            ArchivedOrderStatusEvent(order_id=event.order_id, from_status=event.from_status,
+                                     status=event.status, at=event.at, source=event.source)
+            for event in events
+        ])
+        add_to_monthly_totals(orders)
+
+        OrderItem.objects.filter(order_id__in=pks).delete()
+        Payment.objects.filter(order_id__in=pks).delete()
+        Order.objects.filter(pk__in=pks).delete()
+
+    return len(orders), len(items)
+
+
+def add_to_monthly_totals(orders):
+    totals = defaultdict(lambda: [0, Decimal('0')])
+    for order in orders:
+        month = timezone.localtime(order.updated_at).date().replace(day=1)
+        totals[month, order.status][0] += 1
+        totals[month, order.status][1] += order.total_price or 0
+
+    for (month, status), (count, revenue) in totals.items():
+        updated = ArchivedMonthlyTotal.objects.filter(month=month, status=status).update(
+            orders=F('orders') + count, revenue=F('revenue') + revenue)
+        if not updated:
+            ArchivedMonthlyTotal.objects.create(
+                month=month, status=status, orders=count, revenue=revenue)
+
+
+def archived_totals(statuses=ARCHIVABLE_STATUSES):
+    """Order count and revenue of everything archived in `statuses`."""
+    totals = ArchivedMonthlyTotal.objects.filter(status__in=statuses).aggregate(
+        orders=Sum('orders'), revenue=Sum('revenue'))
+    return {'orders': totals['orders'] or 0, 'revenue': totals['revenue'] or Decimal('0')}
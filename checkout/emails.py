@@ -0,0 +1,40 @@
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from notifications.outbox import enqueue_email
+
+from .models import Order
+from .pricing import quote_order
+
+
+def order_confirmation_subject(order):
+    return f"Order Confirmation - Order #{order.id}"
+
+
+def send_order_confirmation_email(user, order, payment):
+    """
+    Render the confirmation once, keep the HTML on the order and queue it.
+    Resends and "view in browser" reuse the stored HTML.
+    """
+    items = order.items.select_related('product').order_by('id')
+
+    # Prepare HTML content with order and payment details
+    html_content = render_to_string("emails/order_confirmation.html", {
+        "user": user,
+        "order": order,
+        "payment": payment,
+        "quote": quote_order(order, items),
+        "current_year": timezone.now().year,
+    })
+    order.confirmation_email_html = html_content
+    Order.objects.filter(pk=order.pk).update(
+        confirmation_email_html=html_content)
+
+    # Queue the email, the send_outbox worker delivers it
+    return enqueue_email(order_confirmation_subject(order), [user.email], html_message=html_content)
+
+
+def resend_order_confirmation_email(order):
+    """Queue the stored confirmation again, without re-rendering it."""
+    return enqueue_email(order_confirmation_subject(order), [order.user.email],
+                         html_message=order.confirmation_email_html)
@@ -0,0 +1,131 @@
+import csv
+import json
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+
+from .models import Order, OrderItem
+
+ADDRESS_FIELDS = ('name', 'phone_number', 'street',
+                  'landmark', 'city', 'state', 'pin_code')
+
+CSV_HEADER = (
+    'order_id', 'created_at', 'updated_at', 'status', 'username', 'email',
+    'total_price', 'delivery_charge',
+    'payment_method', 'payment_status', 'payment_amount', 'razorpay_payment_id',
+    *(f'shipping_{field}' for field in ADDRESS_FIELDS),
+    'product_id', 'product_name', 'quantity', 'discounted_price', 'line_total',
+)
+
+
+def export_queryset(queryset=None, start=None, end=None, statuses=None, since=None):
+    """
+    Orders to export with everything a row needs joined in. `start`/`end`
+    bound created_at, `since` picks up orders changed after the last export.
+    """
+    queryset = Order.objects.all() if queryset is None else queryset
+    if start:
+        queryset = queryset.filter(created_at__gte=start)
+    if end:
+        queryset = queryset.filter(created_at__lt=end)
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    if since:
+        queryset = queryset.filter(updated_at__gt=since)
+
+    return (
+        queryset.defer('confirmation_email_html')
+        .select_related('user', 'payment', 'shipping_address')
+        .prefetch_related(Prefetch('items', queryset=OrderItem.objects.select_related(
+            'product').only('order_id', 'product_id', 'product__name', 'quantity',
+                            'discounted_price').order_by('id')))
+        .order_by('pk')
+    )
+
+
+def iter_orders(queryset, chunk_size=2000):
+    # With a chunk_size, iterator() runs the prefetches per chunk, so memory
+    # stays flat no matter how many orders match
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+def get_payment(order):
+    try:
+        return order.payment
+    except ObjectDoesNotExist:
+        return None
+
+
+def order_record(order):
+    payment = get_payment(order)
+    address = order.shipping_address
+    return {
+        'id': order.pk,
+        'created_at': order.created_at,
+        'updated_at': order.updated_at,
+        'status': order.status,
+        'username': order.user.username,
+        'email': order.user.email,
+        'total_price': order.total_price,
+        'delivery_charge': order.delivery_charge,
+        'payment': payment and {
+            'method': payment.method,
+            'status': payment.payment_status,
+            'amount': payment.amount,
+            'razorpay_payment_id': payment.razorpay_payment_id,
+        },
+        'shipping_address': address and {field: getattr(address, field) for field in ADDRESS_FIELDS},
+        'items': [{
+            'product_id': item.product_id,
+            'product_name': item.product.name,
+            'quantity': item.quantity,
+            'discounted_price': item.discounted_price,
+            'line_total': (item.discounted_price or 0) * item.quantity,
+        } for item in order.items.all()],
+    }
+
+
+def csv_rows(record):
+    payment = record['payment'] or {}
+    address = record['shipping_address'] or {}
+    order_columns = [
+        record['id'], record['created_at'].isoformat(), record['updated_at'].isoformat(),
+        record['status'], record['username'], record['email'],
+        record['total_price'], record['delivery_charge'],
+        payment.get('method'), payment.get('status'), payment.get('amount'),
+        payment.get('razorpay_payment_id'),
+        *(address.get(field) for field in ADDRESS_FIELDS),
+    ]
+    # One row per item; orders without items still get a row
+    for item in record['items'] or [{}]:
+        yield order_columns + [
+            item.get('product_id'), item.get('product_name'), item.get('quantity'),
+            item.get('discounted_price'), item.get('line_total'),
+        ]
+
+
+class Echo:
+    """File-like object whose write() hands the line back to csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(orders):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for order in orders:
+        for row in csv_rows(order_record(order)):
+            yield writer.writerow(row)
+
+
+def stream_jsonl(orders):
+    for order in orders:
+        yield json.dumps(order_record(order), cls=DjangoJSONEncoder) + '\n'
+
+
+FORMATS = {
+    'csv': (stream_csv, 'text/csv'),
+    'jsonl': (stream_jsonl, 'application/x-ndjson'),
+}
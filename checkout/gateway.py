@@ -0,0 +1,297 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from decimal import Decimal
+
+import razorpay
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class GatewayError(Exception):
+    """The gateway rejected the request or returned an error."""
+
+
+class GatewayUnavailable(GatewayError):
+    """The gateway timed out, is unreachable or the circuit breaker is open."""
+
+
+def to_paise(amount):
+    return int((Decimal(amount) * 100).to_integral_value())
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for
+    `reset_timeout` seconds, then lets a single trial call through.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == 'open':
+                raise GatewayUnavailable(
+                    "Payment gateway is temporarily unavailable.")
+            if state == 'half-open':
+                # Let this call through as the trial and keep the others out
+                self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class GatewayMetrics:
+    """In-process call counters and latencies per gateway operation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, operation, seconds, ok):
+        with self._lock:
+            stats = self._stats.setdefault(
+                operation, {'calls': 0, 'failures': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            stats['calls'] += 1
+            stats['failures'] += 0 if ok else 1
+            stats['total_ms'] += seconds * 1000
+            stats['max_ms'] = max(stats['max_ms'], seconds * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                operation: {**stats, 'avg_ms': stats['total_ms'] / stats['calls']}
+                for operation, stats in self._stats.items()
+            }
+
+
+class TimeoutSession(requests.Session):
+    """requests session that applies a default (connect, read) timeout."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
+
+
+class BaseGateway(ABC):
+    def __init__(self, key_secret, breaker=None, webhook_secret=None):
+        self.key_secret = key_secret or ''
+        self.webhook_secret = webhook_secret or ''
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = GatewayMetrics()
+
+    def _call(self, operation, func, *args, **kwargs):
+        self.breaker.before_call()
+        started = time.monotonic()
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = True
+            return result
+        except (requests.Timeout, requests.ConnectionError) as e:
+            self.breaker.record_failure()
+            raise GatewayUnavailable(str(e)) from e
+        except razorpay.errors.ServerError as e:
+            self.breaker.record_failure()
+            raise GatewayUnavailable(str(e)) from e
+        except (razorpay.errors.BadRequestError, razorpay.errors.GatewayError) as e:
+            # The gateway answered, so it is healthy even though it said no
+            self.breaker.record_success()
+            raise GatewayError(str(e)) from e
+        finally:
+            if ok:
+                self.breaker.record_success()
+            self.metrics.record(operation, time.monotonic() - started, ok)
+
+    def sign(self, message, secret=None):
+        if isinstance(message, str):
+            message = message.encode()
+        secret = self.key_secret if secret is None else secret
+        return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+    def verify_payment_signature(self, razorpay_order_id, razorpay_payment_id, razorpay_signature):
+        """Check the checkout signature locally, no network call is made."""
+        # An empty secret would accept anything signed with the empty key
+        if not self.key_secret:
+            return False
+        expected = self.sign(f"{razorpay_order_id}|{razorpay_payment_id}")
+        return hmac.compare_digest(expected, str(razorpay_signature or ''))
+
+    def verify_webhook_signature(self, body, signature):
+        """Check the X-Razorpay-Signature of a raw webhook body."""
+        if not self.webhook_secret:
+            return False
+        expected = self.sign(body, self.webhook_secret)
+        return hmac.compare_digest(expected, str(signature or ''))
+
+    @abstractmethod
+    def create_order(self, amount, currency='INR', receipt=None):
+        """Create a gateway order for `amount` rupees."""
+
+    @abstractmethod
+    def fetch_order(self, razorpay_order_id):
+        """Fetch a gateway order by its id."""
+
+
+class RazorpayGateway(BaseGateway):
+    def __init__(self, key_id, key_secret, connect_timeout=3.05, read_timeout=10, retries=2, breaker=None, webhook_secret=None):
+        super().__init__(key_secret, breaker, webhook_secret)
+        session = TimeoutSession((connect_timeout, read_timeout))
+        # Connection errors are retried for every call; read errors and 5xx only for GETs
+        adapter = HTTPAdapter(pool_maxsize=10, max_retries=Retry(
+            total=retries,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({'GET'}),
+            raise_on_status=False,
+        ))
+        session.mount('https://', adapter)
+        self.client = razorpay.Client(
+            session=session, auth=(key_id, key_secret))
+
+    def create_order(self, amount, currency='INR', receipt=None):
+        data = {'amount': to_paise(amount), 'currency': currency, 'payment_capture': 1}
+        if receipt:
+            data['receipt'] = str(receipt)
+        return self._call('create_order', self.client.order.create, data)
+
+    def fetch_order(self, razorpay_order_id):
+        return self._call('fetch_order', self.client.order.fetch, razorpay_order_id)
+
+
+class FakeGateway(BaseGateway):
+    """In-process stand-in for Razorpay that never touches the network."""
+
+    def __init__(self, key_secret='fake-secret', breaker=None, webhook_secret='fake-webhook-secret'):
+        super().__init__(key_secret, breaker, webhook_secret)
+        self.orders = {}
+        self._lock = threading.Lock()
+
+    def create_order(self, amount, currency='INR', receipt=None):
+        def create():
+            order = {
+                'id': f"order_fake_{uuid.uuid4().hex[:14]}",
+                'entity': 'order',
+                'amount': to_paise(amount),
+                'currency': currency,
+                'receipt': str(receipt) if receipt else None,
+                'status': 'created',
+            }
+            with self._lock:
+                self.orders[order['id']] = order
+            return order
+        return self._call('create_order', create)
+
+    def fetch_order(self, razorpay_order_id):
+        def fetch():
+            try:
+                return self.orders[razorpay_order_id]
+            except KeyError:
+                raise razorpay.errors.BadRequestError(
+                    "The id provided does not exist")
+        return self._call('fetch_order', fetch)
+
+    def pay(self, razorpay_order_id):
+        """Simulate the customer paying; returns what the checkout form would post back."""
+        payment_id = f"pay_fake_{uuid.uuid4().hex[:14]}"
+        with self._lock:
+            self.orders[razorpay_order_id]['status'] = 'paid'
+        return {
+            'razorpay_order_id': razorpay_order_id,
+            'razorpay_payment_id': payment_id,
+            'razorpay_signature': self.sign(f"{razorpay_order_id}|{payment_id}"),
+        }
+
+    def webhook(self, event, razorpay_order_id, razorpay_payment_id):
+        """Build a signed webhook delivery as (raw body, headers)."""
+        order = self.orders.get(razorpay_order_id, {})
+        body = json.dumps({
+            'entity': 'event',
+            'event': event,
+            'payload': {'payment': {'entity': {
+                'id': razorpay_payment_id,
+                'order_id': razorpay_order_id,
+                'amount': order.get('amount'),
+                'status': 'captured' if event == 'payment.captured' else 'failed',
+            }}},
+        }).encode()
+        return body, {
+            'X-Razorpay-Signature': self.sign(body, self.webhook_secret),
+            'X-Razorpay-Event-Id': f"evt_fake_{uuid.uuid4().hex[:14]}",
+        }
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """
+    Return the gateway shared by every request in this process, so each worker
+    keeps one keep-alive session instead of building a client per request.
+    PAYMENT_GATEWAY = 'fake' swaps in the in-process FakeGateway.
+    """
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                if settings.PAYMENT_GATEWAY == 'fake':
+                    _gateway = FakeGateway(
+                        settings.RAZORPAY_API_SECRET or 'fake-secret',
+                        webhook_secret=settings.RAZORPAY_WEBHOOK_SECRET or 'fake-webhook-secret')
+                else:
+                    _gateway = RazorpayGateway(
+                        settings.RAZORPAY_API_KEY,
+                        settings.RAZORPAY_API_SECRET,
+                        connect_timeout=settings.RAZORPAY_CONNECT_TIMEOUT,
+                        read_timeout=settings.RAZORPAY_READ_TIMEOUT,
+                        webhook_secret=settings.RAZORPAY_WEBHOOK_SECRET,
+                    )
+    return _gateway
+
+
+def reset_gateway(**kwargs):
+    global _gateway
+    with _gateway_lock:
+        _gateway = None
+
+
+def _reset_on_setting_change(setting, **kwargs):
+    if setting.startswith('RAZORPAY_') or setting == 'PAYMENT_GATEWAY':
+        reset_gateway()
+
+
+setting_changed.connect(_reset_on_setting_change)
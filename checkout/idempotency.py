@@ -0,0 +1,101 @@
+import hashlib
+import json
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from revvona.utils import error_response
+
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+# Seconds between checks while a duplicate waits for the first response
+POLL_INTERVAL = 0.2
+
+
+def request_fingerprint(request):
+    """Hash of everything that makes two requests "the same request"."""
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    payload = f"{request.method}\n{request.path}\n{body}"
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def idempotent(view_method):
+    """
+    Make a viewset action safe to retry. A request carrying an Idempotency-Key
+    header runs once per user and key; replays get the stored response back
+    without the action running again.
+
+    The key is claimed in its own short transaction before the action runs,
+    so no transaction or row lock is held across the action's gateway calls.
+    A concurrent duplicate polls for the first request's response for up to
+    IDEMPOTENCY_WAIT and gets a 409 if it is still running after that. A
+    claim left without a response for longer than IDEMPOTENCY_LEASE (its
+    worker died) is taken over. Server errors drop the claim so the client
+    can retry them.
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+
+        if len(key) > 255:
+            return error_response(f"{IDEMPOTENCY_HEADER} must be at most 255 characters.", status_code=status.HTTP_400_BAD_REQUEST)
+
+        fingerprint = request_fingerprint(request)
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT.total_seconds()
+
+        while True:
+            now = timezone.now()
+            with transaction.atomic():
+                record, created = IdempotencyKey.objects.get_or_create(
+                    user=request.user,
+                    endpoint=view_method.__name__,
+                    key=key,
+                    defaults={'fingerprint': fingerprint, 'claimed_at': now},
+                )
+            if created:
+                break
+
+            if record.fingerprint != fingerprint:
+                return error_response(f"{IDEMPOTENCY_HEADER} was already used for a different request.", status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            if record.status_code is not None:
+                response = Response(record.response, status=record.status_code)
+                response['Idempotent-Replayed'] = 'true'
+                return response
+
+            # Only one request can move an expired claim on to its own time
+            if record.claimed_at < now - settings.IDEMPOTENCY_LEASE and IdempotencyKey.objects.filter(
+                    pk=record.pk, status_code__isnull=True, claimed_at=record.claimed_at).update(claimed_at=now):
+                record.claimed_at = now
+                break
+
+            if time.monotonic() >= deadline:
+                return error_response("A request with this key is still being processed.", status_code=status.HTTP_409_CONFLICT)
+            time.sleep(POLL_INTERVAL)
+
+        # Only touched while this request still holds the claim, so a worker
+        # whose claim was taken over can't overwrite the new one
+        claim = IdempotencyKey.objects.filter(
+            pk=record.pk, status_code__isnull=True, claimed_at=record.claimed_at)
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except BaseException:
+            claim.delete()
+            raise
+
+        if response.status_code >= 500:
+            # Not stored, so a retry runs the action again
+            claim.delete()
+            return response
+
+        claim.update(status_code=response.status_code, response=response.data)
+        return response
+
+    return wrapper
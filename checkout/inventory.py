@@ -0,0 +1,213 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+from django.utils import timezone
+
+from products.models import Product
+
+from .models import OrderItem, StockReservation
+
+
+class InsufficientStock(Exception):
+    """Raised when one or more products can't cover the requested quantity."""
+
+    def __init__(self, product_ids):
+        self.product_ids = list(product_ids)
+        super().__init__(
+            f"Insufficient stock for products: {', '.join(map(str, self.product_ids))}")
+
+
+def reserved_quantities(product_ids, now=None, exclude_order_ids=()):
+    """Return {product_id: quantity} currently held by unexpired reservations."""
+    now = now or timezone.now()
+    rows = (
+        StockReservation.objects.filter(
+            product_id__in=product_ids, status='held', expires_at__gt=now)
+        .exclude(order_id__in=list(exclude_order_ids))
+        .values('product_id')
+        .annotate(reserved=Sum('quantity'))
+    )
+    return {row['product_id']: row['reserved'] for row in rows}
+
+
+def available_stock(products, now=None):
+    """Return {product_id: stock minus active holds} for the given products."""
+    reserved = reserved_quantities([product.id for product in products], now)
+    return {product.id: product.stock - reserved.get(product.id, 0) for product in products}
+
+
+def reserve_stock(order, quantities):
+    """
+    Hold stock for an order. `quantities` maps product ids to the quantity wanted.
+    The product rows are locked only while the holds are written, not for the
+    whole payment window.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        products = list(Product.objects.select_for_update().filter(
+            id__in=quantities.keys()).order_by('id'))
+        available = available_stock(products, now)
+
+        short = [product_id for product_id, quantity in quantities.items()
+                 if available.get(product_id, 0) < quantity]
+        if short:
+            raise InsufficientStock(short)
+
+        expires_at = now + settings.STOCK_RESERVATION_TTL
+        StockReservation.objects.bulk_create([
+            StockReservation(order=order, product_id=product_id,
+                             quantity=quantity, expires_at=expires_at)
+            for product_id, quantity in quantities.items()
+        ])
+
+
+def release_reservations(order):
+    """Give back every hold of an order, e.g. when it is cancelled."""
+    return release_orders_reservations([order.pk])
+
+
+def release_orders_reservations(order_ids):
+    return StockReservation.objects.filter(
+        order_id__in=order_ids, status='held').update(status='released')
+
+
+def decrement_stock(quantities, reserved=None):
+    """
+    Take `quantities` ({product_id: quantity}) off the stock with a single
+    conditional UPDATE. `reserved` ({product_id: quantity}) is stock held for
+    other orders, which has to stay behind. Either every product is
+    decremented or none is, and InsufficientStock lists the products that
+    couldn't cover their quantity.
+    """
+    if not quantities:
+        return
+    reserved = reserved or {}
+
+    guard = Q()
+    for product_id, quantity in quantities.items():
+        guard |= Q(pk=product_id, stock__gte=quantity +
+                   reserved.get(product_id, 0))
+    decrement = Case(
+        *[When(pk=product_id, then=Value(quantity))
+          for product_id, quantity in quantities.items()],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+    try:
+        with transaction.atomic():
+            # UPDATE ... SET stock = stock - CASE ... WHERE (id = x AND stock >= qx) OR ...
+            updated = Product.objects.filter(guard).update(
+                stock=F('stock') - decrement)
+            if updated != len(quantities):
+                # Roll back the rows that did fit, then work out which didn't
+                raise InsufficientStock([])
+    except InsufficientStock:
+        stock = dict(Product.objects.filter(
+            pk__in=quantities.keys()).values_list('pk', 'stock'))
+        raise InsufficientStock(sorted(
+            product_id for product_id, quantity in quantities.items()
+            if stock.get(product_id, 0) - reserved.get(product_id, 0) < quantity))
+
+
+def commit_orders_stock(order_ids):
+    """
+    Commit stock for many confirmed orders at once. Units held by other
+    orders' unexpired reservations are left alone, so an order paid after its
+    own hold expired only gets stock nobody else is holding. The whole batch
+    is tried as one UPDATE; if some product runs short, each order is retried
+    on its own so one short order doesn't hold back the rest. Returns
+    (committed order ids, {order id: product ids that couldn't be covered}).
+    """
+    per_order = defaultdict(lambda: defaultdict(int))
+    rows = OrderItem.objects.filter(order_id__in=order_ids).values_list(
+        'order_id', 'product_id', 'quantity')
+    for order_id, product_id, quantity in rows:
+        per_order[order_id][product_id] += quantity
+
+    combined = defaultdict(int)
+    for quantities in per_order.values():
+        for product_id, quantity in quantities.items():
+            combined[product_id] += quantity
+
+    now = timezone.now()
+    committed, failed = [], {}
+    with transaction.atomic():
+        # Locked like in reserve_stock so no hold is added while we count them
+        list(Product.objects.select_for_update().filter(
+            id__in=list(combined)).order_by('id').values_list('id', flat=True))
+        try:
+            decrement_stock(combined, reserved_quantities(
+                list(combined), now, exclude_order_ids=order_ids))
+            committed = list(order_ids)
+        except InsufficientStock:
+            for order_id in order_ids:
+                quantities = per_order.get(order_id, {})
+                # The holds of orders not committed yet still count
+                reserved = reserved_quantities(
+                    list(quantities), now, exclude_order_ids=[*committed, order_id])
+                try:
+                    decrement_stock(quantities, reserved)
+                    committed.append(order_id)
+                except InsufficientStock as e:
+                    failed[order_id] = e.product_ids
+
+        StockReservation.objects.filter(
+            order_id__in=committed, status='held').update(status='committed')
+
+    return committed, failed
+
+
+def commit_order_stock(order):
+    """
+    Decrement stock for every item of a confirmed order and mark its holds as
+    committed. Nothing is written if any product can't cover its quantity.
+    """
+    _, failed = commit_orders_stock([order.pk])
+    if failed:
+        raise InsufficientStock(failed[order.pk])
+
+
+def restock_orders(order_ids):
+    """
+    Put back the stock taken by confirmed orders that are being cancelled,
+    with one UPDATE, and release their committed reservations.
+    """
+    quantities = defaultdict(int)
+    rows = OrderItem.objects.filter(order_id__in=order_ids).values_list(
+        'product_id', 'quantity')
+    for product_id, quantity in rows:
+        quantities[product_id] += quantity
+    if not quantities:
+        return
+
+    increment = Case(
+        *[When(pk=product_id, then=Value(quantity))
+          for product_id, quantity in quantities.items()],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+    with transaction.atomic():
+        Product.objects.filter(pk__in=list(quantities)).update(
+            stock=F('stock') + increment)
+        StockReservation.objects.filter(
+            order_id__in=order_ids, status='committed').update(status='released')
+
+
+def release_expired_reservations(chunk_size=1000, now=None):
+    """Release held reservations whose TTL has passed, one pk chunk at a time."""
+    now = now or timezone.now()
+    expired = StockReservation.objects.filter(
+        status='held', expires_at__lte=now)
+
+    released = 0
+    while True:
+        pks = list(expired.order_by('pk').values_list(
+            'pk', flat=True)[:chunk_size])
+        if not pks:
+            break
+        released += StockReservation.objects.filter(
+            pk__in=pks, status='held').update(status='released')
+    return released
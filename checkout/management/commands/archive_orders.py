@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from checkout.archive import archivable_orders, archive_chunk
+from checkout.models import OrderItem
+from dashboard.series import add_months, as_datetime
+
+
+class Command(BaseCommand):
+    help = "Move delivered, cancelled and returned orders older than --months to the archive tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=12,
+                            help="Archive orders last updated before the calendar month this many months ago (default: 12).")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of orders moved per transaction (default: 500).")
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help="Seconds to pause between chunks to give other writers room (default: 0).")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many orders would be archived.")
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+        if options['months'] < 1:
+            raise CommandError("--months must be at least 1.")
+
+        # Whole calendar months, the same buckets as the monthly totals
+        queryset = archivable_orders(as_datetime(
+            add_months(timezone.localdate(), -options['months'])))
+
+        if options['dry_run']:
+            orders = queryset.count()
+            items = OrderItem.objects.filter(
+                order_id__in=queryset.values('pk')).count()
+            self.stdout.write(self.style.SUCCESS(
+                f"Would archive {orders} orders ({items} items)."))
+            return
+
+        orders = items = 0
+        last_pk = 0
+        while True:
+            # Walk the primary key index so every chunk is a short range scan
+            pks = list(queryset.filter(pk__gt=last_pk).order_by(
+                'pk').values_list('pk', flat=True)[:options['chunk_size']])
+            if not pks:
+                break
+            last_pk = pks[-1]
+
+            moved_orders, moved_items = archive_chunk(queryset, pks)
+            orders += moved_orders
+            items += moved_items
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {orders} orders ({items} items)."))
@@ -0,0 +1,98 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from cart.models import Cart, CartItem
+from checkout.models import IdempotencyKey, Order, OrderItem
+
+
+class Command(BaseCommand):
+    help = "Delete stale carts and abandoned pending orders in small primary-key chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cart-days', type=int, default=30,
+                            help="Delete carts untouched for this many days (default: 30).")
+        parser.add_argument('--order-days', type=int, default=7,
+                            help="Delete pending orders without a payment older than this many days (default: 7).")
+        parser.add_argument('--idempotency-hours', type=int, default=24,
+                            help="Delete idempotency keys older than this many hours (default: 24).")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of parent rows deleted per transaction (default: 500).")
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help="Seconds to pause between chunks to give other writers room (default: 0).")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many rows would be deleted.")
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        now = timezone.now()
+        self.chunk_size = options['chunk_size']
+        self.sleep = options['sleep']
+        self.dry_run = options['dry_run']
+
+        # Carts are considered stale once nobody touched them for the threshold
+        stale_carts = Cart.objects.filter(
+            updated_at__lt=now - timedelta(days=options['cart_days']))
+
+        # Pending orders that never reached create_payment. Their status log
+        # (only the 'pending' row from creation) is dropped with them on
+        # purpose: nothing was paid, shipped or refunded, so there is nothing
+        # to audit, and the sales rollups already counted the order
+        abandoned_orders = Order.objects.filter(
+            status='pending',
+            payment__isnull=True,
+            created_at__lt=now - timedelta(days=options['order_days']),
+        )
+
+        # Clients only retry for a short while, after that the stored responses are dead weight
+        expired_keys = IdempotencyKey.objects.filter(
+            created_at__lt=now - timedelta(hours=options['idempotency_hours']))
+
+        carts, cart_items = self.purge(stale_carts, CartItem, 'cart_id')
+        orders, order_items = self.purge(
+            abandoned_orders, OrderItem, 'order_id')
+        keys, _ = self.purge(expired_keys)
+
+        verb = "Would delete" if self.dry_run else "Deleted"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {carts} carts ({cart_items} items), "
+            f"{orders} abandoned orders ({order_items} items) and "
+            f"{keys} idempotency keys."))
+
+    def purge(self, queryset, child_model=None, child_fk=None):
+        """Delete the queryset and its child rows one pk range at a time."""
+        if self.dry_run:
+            parents = queryset.count()
+            children = child_model.objects.filter(
+                **{f'{child_fk}__in': queryset.values('pk')}).count() if child_model else 0
+            return parents, children
+
+        parents = children = 0
+        last_pk = 0
+        while True:
+            # Walk the primary key index so every chunk is a short range scan
+            pks = list(queryset.filter(pk__gt=last_pk).order_by(
+                'pk').values_list('pk', flat=True)[:self.chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+
+            with transaction.atomic():
+                # Re-apply the staleness filter so rows revived since the scan are kept
+                pks = list(queryset.select_for_update(of=('self',)).filter(
+                    pk__in=pks).values_list('pk', flat=True))
+                if child_model:
+                    children += child_model.objects.filter(
+                        **{f'{child_fk}__in': pks}).delete()[0]
+                parents += queryset.model.objects.filter(
+                    pk__in=pks).delete()[1].get(queryset.model._meta.label, 0)
+
+            if self.sleep:
+                time.sleep(self.sleep)
+
+        return parents, children
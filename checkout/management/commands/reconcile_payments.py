@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from checkout.reconciliation import apply_webhook_events
+
+
+class Command(BaseCommand):
+    help = "Apply received payment webhook events to payments, orders and stock in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Events applied per transaction (default: 500).")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep polling for new events instead of exiting once caught up.")
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help="Seconds to wait between polls in --loop mode (default: 5).")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        total = 0
+        while True:
+            processed = apply_webhook_events(options['batch_size'])
+            total += processed
+
+            # A full batch means there is probably more waiting
+            if processed == options['batch_size']:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Applied {total} webhook events."))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from checkout.inventory import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Release stock reservations whose hold time has expired."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of reservations released per statement (default: 1000).")
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        released = release_expired_reservations(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Released {released} expired reservations."))
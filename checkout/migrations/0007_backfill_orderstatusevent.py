@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def backfill_status_events(apps, schema_editor):
+    # Orders that predate the log get a single event for their current status,
+    # dated by their last update since that is the best guess we have.
+    Order = apps.get_model('checkout', 'Order')
+    OrderStatusEvent = apps.get_model('checkout', 'OrderStatusEvent')
+
+    events = []
+    for order in Order.objects.only('id', 'status', 'updated_at').iterator(chunk_size=2000):
+        events.append(OrderStatusEvent(
+            order_id=order.id, status=order.status, at=order.updated_at, source='backfill'))
+        if len(events) >= 2000:
+            OrderStatusEvent.objects.bulk_create(events)
+            events = []
+    OrderStatusEvent.objects.bulk_create(events)
+
+
+def remove_backfilled_events(apps, schema_editor):
+    OrderStatusEvent = apps.get_model('checkout', 'OrderStatusEvent')
+    OrderStatusEvent.objects.filter(source='backfill').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("checkout", "0006_orderstatusevent"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_status_events, remove_backfilled_events),
+    ]
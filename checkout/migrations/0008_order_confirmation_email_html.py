@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-19 18:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("checkout", "0007_backfill_orderstatusevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="order",
+            name="confirmation_email_html",
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.0 on 2026-10-19 18:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("checkout", "0010_idempotency_key_created_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="archivedorder",
+            name="confirmation_email_html",
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.CreateModel(
+            name="ArchivedOrderStatusEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "from_status",
+                    models.CharField(
+                        blank=True,
+                        choices=[
+                            ("pending", "Pending"),
+                            ("confirmed", "Confirmed"),
+                            ("delivered", "Delivered"),
+                            ("cancelled", "Cancelled"),
+                            ("return_initiated", "Return Initiated"),
+                            ("returned", "Returned"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("confirmed", "Confirmed"),
+                            ("delivered", "Delivered"),
+                            ("cancelled", "Cancelled"),
+                            ("return_initiated", "Return Initiated"),
+                            ("returned", "Returned"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("at", models.DateTimeField()),
+                ("source", models.CharField(blank=True, max_length=100)),
+                (
+                    "order",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="status_events",
+                        to="checkout.archivedorder",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
 
 from accounts.models import Address
 
@@ -27,9 +29,17 @@ class Order(models.Model):
         Address, on_delete=models.SET_NULL, null=True, blank=True, related_name='billing_orders')
     status = models.CharField(
         max_length=20, choices=ORDER_STATUS_CHOICES, default='pending')
+    # Rendered once when the order is confirmed; reused for resends and "view in browser"
+    confirmation_email_html = models.TextField(blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Order history lists a user's orders newest first
+            models.Index(fields=['user', 'created_at']),
+        ]
+
     def __str__(self):
         return f"Order {self.id} - {self.user.username}"
 
@@ -65,9 +75,9 @@ class Payment(models.Model):
 
     # Razorpay payment details
     razorpay_order_id = models.CharField(
-        max_length=255, blank=True, null=True)
+        max_length=255, blank=True, null=True, db_index=True)
     razorpay_payment_id = models.CharField(
-        max_length=255, blank=True, null=True)
+        max_length=255, blank=True, null=True, db_index=True)
     razorpay_signature = models.CharField(
         max_length=255, blank=True, null=True)
 
@@ -77,3 +87,194 @@ class Payment(models.Model):
 
     def __str__(self):
         return f"Payment {self.id} for Order {self.order.id}"
+
+
+class StockReservation(models.Model):
+    RESERVATION_STATUS_CHOICES = [
+        ('held', 'Held'),
+        ('committed', 'Committed'),
+        ('released', 'Released'),
+    ]
+
+    order = models.ForeignKey(
+        Order, related_name='reservations', on_delete=models.CASCADE)
+    product = models.ForeignKey(
+        'products.Product', related_name='reservations', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(
+        max_length=20, choices=RESERVATION_STATUS_CHOICES, default='held')
+    # A held reservation stops counting against stock once this passes
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Available stock sums held quantities per product
+            models.Index(fields=['product', 'status', 'expires_at']),
+            # The expiry sweeper scans held reservations by expiry
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for Order {self.order_id} ({self.status})"
+
+
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(
+        User, related_name='idempotency_keys', on_delete=models.CASCADE)
+    # The view action the key was used on, e.g. 'create_order'
+    endpoint = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    # SHA-256 of the method, path and body of the first request
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True, encoder=JSONEncoder)
+    # When the request now running with this key claimed it; a claim older
+    # than IDEMPOTENCY_LEASE without a response is taken over
+    claimed_at = models.DateTimeField(default=timezone.now)
+    # purge_stale deletes keys by age
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'endpoint', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.endpoint} {self.key} - {self.user_id}"
+
+
+class PaymentWebhookEvent(models.Model):
+    # Razorpay's x-razorpay-event-id, so redelivered events are stored once
+    event_id = models.CharField(max_length=255, unique=True)
+    event = models.CharField(max_length=100)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    # Set by reconcile_payments once the event has been applied
+    processed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.event} {self.event_id}"
+
+
+class OrderStatusEvent(models.Model):
+    # Append-only: one row per status change, written by checkout.transitions
+    order = models.ForeignKey(
+        Order, related_name='status_events', on_delete=models.CASCADE)
+    # Empty for the backfilled rows of orders that predate the log
+    from_status = models.CharField(
+        max_length=20, choices=Order.ORDER_STATUS_CHOICES, blank=True)
+    status = models.CharField(
+        max_length=20, choices=Order.ORDER_STATUS_CHOICES)
+    at = models.DateTimeField()
+    # Who or what made the change, e.g. 'customer', 'admin:alice', 'webhook'
+    source = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        indexes = [
+            # Dashboard counts transitions into a status per day
+            models.Index(fields=['status', 'at']),
+            models.Index(fields=['order', 'at']),
+        ]
+
+    def __str__(self):
+        return f"Order {self.order_id}: {self.from_status or '-'} -> {self.status}"
+
+
+# Archive tables: closed orders older than a few months are moved here by the
+# archive_orders command so the live tables stay small. Archived orders keep
+# their original id.
+class ArchivedOrder(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(
+        User, related_name='archived_orders', on_delete=models.CASCADE)
+    total_price = models.DecimalField(
+        max_digits=10, decimal_places=2, null=True, blank=True)
+    delivery_charge = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0)
+    shipping_address = models.ForeignKey(
+        Address, on_delete=models.SET_NULL, null=True, related_name='+')
+    billing_address = models.ForeignKey(
+        Address, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(
+        max_length=20, choices=Order.ORDER_STATUS_CHOICES)
+    confirmation_email_html = models.TextField(blank=True, editable=False)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Archived Order {self.id} - {self.user_id}"
+
+
+class ArchivedOrderItem(models.Model):
+    order = models.ForeignKey(
+        ArchivedOrder, related_name='items', on_delete=models.CASCADE)
+    product = models.ForeignKey(
+        'products.Product', related_name='+', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=1)
+    discounted_price = models.DecimalField(
+        max_digits=10, decimal_places=2, null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} (Archived Order {self.order_id})"
+
+
+class ArchivedPayment(models.Model):
+    order = models.OneToOneField(
+        ArchivedOrder, related_name='payment', on_delete=models.CASCADE)
+    method = models.CharField(
+        max_length=20, choices=Payment.PAYMENT_METHOD_CHOICES)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    razorpay_order_id = models.CharField(max_length=255, blank=True, null=True)
+    razorpay_payment_id = models.CharField(
+        max_length=255, blank=True, null=True)
+    razorpay_signature = models.CharField(
+        max_length=255, blank=True, null=True)
+    payment_status = models.CharField(
+        max_length=20, choices=Payment.PAYMENT_STATUS_CHOICES)
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Archived Payment {self.id} for Order {self.order_id}"
+
+
+class ArchivedOrderStatusEvent(models.Model):
+    order = models.ForeignKey(
+        ArchivedOrder, related_name='status_events', on_delete=models.CASCADE)
+    from_status = models.CharField(
+        max_length=20, choices=Order.ORDER_STATUS_CHOICES, blank=True)
+    status = models.CharField(
+        max_length=20, choices=Order.ORDER_STATUS_CHOICES)
+    at = models.DateTimeField()
+    source = models.CharField(max_length=100, blank=True)
+
+    def __str__(self):
+        return f"Archived Order {self.order_id}: {self.from_status or '-'} -> {self.status}"
+
+
+class ArchivedMonthlyTotal(models.Model):
+    # Pre-aggregated totals of archived orders per month (of their last
+    # update, in TIME_ZONE) and final status, so the dashboard never scans
+    # the archive
+    month = models.DateField()
+    status = models.CharField(
+        max_length=20, choices=Order.ORDER_STATUS_CHOICES)
+    orders = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['month', 'status'], name='unique_archived_monthly_total'),
+        ]
+
+    def __str__(self):
+        return f"{self.month:%Y-%m} {self.status}: {self.orders} orders"
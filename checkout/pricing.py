@@ -0,0 +1,119 @@
+from dataclasses import dataclass
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db.models import DecimalField, ExpressionWrapper, F
+from django.db.models.functions import Coalesce
+
+# Orders below this subtotal pay the flat delivery charge
+FREE_DELIVERY_THRESHOLD = Decimal('499')
+DELIVERY_CHARGE = Decimal('50')
+
+CENT = Decimal('0.01')
+
+
+@dataclass(frozen=True)
+class PricedLine:
+    product_id: int
+    name: str
+    price: Decimal
+    discount: int
+    discounted_price: Decimal
+    quantity: int
+    line_total: Decimal
+
+
+@dataclass(frozen=True)
+class Quote:
+    lines: tuple
+    subtotal: Decimal
+    delivery_charge: Decimal
+    total: Decimal
+
+    @property
+    def item_count(self):
+        return sum(line.quantity for line in self.lines)
+
+
+def to_cents(amount):
+    return Decimal(amount).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def discounted_price(price, discount):
+    """Unit price after a percentage discount, rounded to the cent."""
+    discount = discount or 0  # Default to 0 if no discount
+    return to_cents(price - (price * discount / 100))
+
+
+def delivery_charge_for(subtotal):
+    return Decimal('0.00') if subtotal >= FREE_DELIVERY_THRESHOLD else to_cents(DELIVERY_CHARGE)
+
+
+def _quote(lines, delivery_charge=None, total=None):
+    lines = tuple(lines)
+    subtotal = sum((line.line_total for line in lines), Decimal('0.00'))
+    if delivery_charge is None:
+        delivery_charge = delivery_charge_for(subtotal)
+    if total is None:
+        total = subtotal + delivery_charge
+    return Quote(lines=lines, subtotal=subtotal, delivery_charge=delivery_charge, total=total)
+
+
+def price_basket(rows):
+    """
+    Price (product, quantity) pairs at the current catalog prices. The products
+    must already be loaded; nothing here touches the database.
+    """
+    lines = []
+    for product, quantity in rows:
+        unit_price = discounted_price(product.price, product.discount)
+        lines.append(PricedLine(
+            product_id=product.id,
+            name=product.name,
+            price=product.price,
+            discount=product.discount or 0,
+            discounted_price=unit_price,
+            quantity=quantity,
+            line_total=unit_price * quantity,
+        ))
+    return _quote(lines)
+
+
+def quote_cart(cart_items):
+    """Price cart items loaded with select_related('product')."""
+    return price_basket((item.product, item.quantity) for item in cart_items)
+
+
+def quote_order(order, items):
+    """
+    Price an existing order from the prices captured when it was placed.
+    `items` are the order's items loaded with select_related('product').
+    """
+    lines = []
+    for item in items:
+        product = item.product
+        unit_price = item.discounted_price
+        if unit_price is None:
+            # Items added by hand in the admin carry no captured price
+            unit_price = discounted_price(product.price, product.discount)
+        lines.append(PricedLine(
+            product_id=product.id,
+            name=product.name,
+            price=product.price,
+            discount=product.discount or 0,
+            discounted_price=unit_price,
+            quantity=item.quantity,
+            line_total=unit_price * item.quantity,
+        ))
+    return _quote(lines, order.delivery_charge, order.total_price)
+
+
+def order_item_total(prefix=''):
+    """
+    Database expression for the amount an order item was sold for, for use in
+    aggregates. `prefix` is the lookup path to the OrderItem, e.g. 'items__'.
+    """
+    return ExpressionWrapper(
+        Coalesce(F(f'{prefix}discounted_price'), F(f'{prefix}product__price'))
+        * F(f'{prefix}quantity'),
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    )
@@ -0,0 +1,103 @@
+from django.db import transaction
+from django.utils import timezone
+
+from .inventory import commit_orders_stock
+from .models import Order, Payment, PaymentWebhookEvent
+from .transitions import bulk_transition
+
+CAPTURED_EVENTS = ('payment.captured', 'order.paid')
+FAILED_EVENTS = ('payment.failed',)
+
+
+def payment_entity(event):
+    return event.payload.get('payload', {}).get('payment', {}).get('entity', {})
+
+
+def not_pending_error(status):
+    # The money is captured for an order that won't ship, staff refund it
+    return f"Payment captured but the order is {status}, it has to be refunded."
+
+
+def apply_webhook_events(batch_size=500):
+    """
+    Apply one batch of unprocessed webhook events and return how many were
+    processed. Payments, orders and stock are updated with a fixed number of
+    queries per batch rather than per event.
+    """
+    now = timezone.now()
+
+    with transaction.atomic():
+        events = list(
+            PaymentWebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True)
+            .order_by('id')[:batch_size]
+        )
+        if not events:
+            return 0
+
+        razorpay_order_ids = {payment_entity(event).get('order_id')
+                              for event in events} - {None}
+        # Locked (in pk order) so verify_payment can't complete a payment
+        # that a failed event then overwrites; the orders aren't locked yet
+        payments = {
+            payment.razorpay_order_id: payment
+            for payment in Payment.objects.select_related('order')
+            .select_for_update(of=('self',))
+            .filter(razorpay_order_id__in=razorpay_order_ids).order_by('pk')
+        }
+
+        changed_payments = {}
+        to_confirm = {}
+        for event in events:
+            entity = payment_entity(event)
+            payment = payments.get(entity.get('order_id'))
+            event.processed_at = now
+
+            if payment is None:
+                event.error = "No payment matches this gateway order."
+                continue
+
+            if event.event in CAPTURED_EVENTS:
+                captured = payment.payment_status != 'completed'
+                if captured:
+                    payment.payment_status = 'completed'
+                    payment.razorpay_payment_id = entity.get(
+                        'id') or payment.razorpay_payment_id
+                    changed_payments[payment.pk] = payment
+                if payment.order.status == 'pending':
+                    to_confirm[payment.order_id] = event
+                elif captured and payment.order.status != 'confirmed':
+                    event.error = not_pending_error(payment.order.status)
+            elif event.event in FAILED_EVENTS:
+                # A later successful attempt on the same order wins
+                if payment.payment_status == 'pending':
+                    payment.payment_status = 'failed'
+                    changed_payments[payment.pk] = payment
+
+        Payment.objects.bulk_update(
+            changed_payments.values(), ['payment_status', 'razorpay_payment_id'])
+
+        # The status read above isn't locked, and verify_payment may have
+        # confirmed (and committed the stock of) some of these orders since.
+        # verify_payment locks the order before the products too.
+        statuses = dict(
+            Order.objects.select_for_update().filter(pk__in=list(to_confirm))
+            .order_by('pk').values_list('pk', 'status')
+        )
+        for order_id, event in to_confirm.items():
+            if statuses[order_id] not in ('pending', 'confirmed'):
+                # Cancelled in the meantime, as verify_payment's 409
+                event.error = not_pending_error(statuses[order_id])
+        committed, failed = commit_orders_stock(
+            [order_id for order_id in to_confirm if statuses[order_id] == 'pending'])
+        bulk_transition(committed, 'confirmed', source='webhook')
+        for order_id, product_ids in failed.items():
+            # The money is captured, staff have to refund or restock by hand
+            to_confirm[order_id].error = (
+                "Payment captured but stock could not be committed for products: "
+                + ', '.join(map(str, product_ids)))
+
+        PaymentWebhookEvent.objects.bulk_update(
+            events, ['processed_at', 'error'])
+
+    return len(events)
@@ -1,8 +1,13 @@
+from django.db.models import Count, OuterRef, Prefetch, Subquery
+from rest_framework import serializers
+
 from accounts.serializers import AddressSerializer
+from products.models import Image, Review
 from products.serializers import ProductSerializer
 from revvona.utils import CustomSerializer
 
-from .models import Order, OrderItem, Payment
+from .models import (ArchivedOrder, ArchivedOrderItem, Order, OrderItem,
+                     Payment)
 
 
 class OrderItemSerializer(CustomSerializer):
@@ -25,9 +30,98 @@ class OrderSerializer(CustomSerializer):
         read_only_fields = ['total_price',
                             'status', 'created_at', 'updated_at']
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Load everything the nested serializers touch in a fixed number of queries."""
+        return queryset.defer('confirmation_email_html').select_related(
+            'shipping_address', 'billing_address').prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.select_related(
+                'product__category').order_by('id')),
+            'items__product__images',
+            # ProductSerializer counts reviews, which a prefetched cache answers for free
+            Prefetch('items__product__reviews',
+                     queryset=Review.objects.only('id', 'product_id')),
+        )
+
+
+class ArchivedOrderItemSerializer(OrderItemSerializer):
+    class Meta(OrderItemSerializer.Meta):
+        model = ArchivedOrderItem
+
+
+class ArchivedOrderSerializer(OrderSerializer):
+    """Same shape as OrderSerializer, so clients can't tell an archived order apart."""
+    items = ArchivedOrderItemSerializer(many=True, read_only=True)
+
+    class Meta(OrderSerializer.Meta):
+        model = ArchivedOrder
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.select_related('shipping_address', 'billing_address').prefetch_related(
+            Prefetch('items', queryset=ArchivedOrderItem.objects.select_related(
+                'product__category').order_by('id')),
+            'items__product__images',
+            Prefetch('items__product__reviews',
+                     queryset=Review.objects.only('id', 'product_id')),
+        )
+
+
+class OrderSummarySerializer(CustomSerializer):
+    """Compact order history row, serialized from `setup_eager_loading` values."""
+    item_count = serializers.IntegerField(read_only=True)
+    thumbnail = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Order
+        fields = ['id', 'status', 'total_price',
+                  'item_count', 'thumbnail', 'created_at']
+
+    def get_thumbnail(self, row):
+        if not row['thumbnail']:
+            return None
+        return Image._meta.get_field('image').storage.url(row['thumbnail'])
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Summary rows of an Order or ArchivedOrder queryset, with the item count
+        and the first product image as annotations. Both kinds have the same
+        columns, so live and archived history can be UNIONed into one query
+        per page.
+        """
+        item_model = queryset.model._meta.get_field('items').related_model
+        first_image = item_model.objects.filter(
+            order=OuterRef('pk'), product__images__isnull=False,
+        ).order_by('id', 'product__images__id').values('product__images__image')[:1]
+        return queryset.values('id', 'status', 'total_price', 'created_at').annotate(
+            item_count=Count('items'),
+            thumbnail=Subquery(first_image),
+        )
+
 
 class PaymentSerializer(CustomSerializer):
     class Meta:
         model = Payment
         fields = ['id', 'order', 'method', 'amount', 'razorpay_order_id', 'razorpay_payment_id',
                   'razorpay_signature', 'payment_status', 'created_at']
+
+
+class QuoteLineSerializer(serializers.Serializer):
+    product = serializers.CharField(source='product_id')
+    name = serializers.CharField()
+    price = serializers.DecimalField(max_digits=10, decimal_places=2)
+    discount = serializers.IntegerField()
+    discounted_price = serializers.DecimalField(
+        max_digits=10, decimal_places=2)
+    quantity = serializers.IntegerField()
+    line_total = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class QuoteSerializer(serializers.Serializer):
+    lines = QuoteLineSerializer(many=True)
+    item_count = serializers.IntegerField()
+    subtotal = serializers.DecimalField(max_digits=12, decimal_places=2)
+    delivery_charge = serializers.DecimalField(
+        max_digits=10, decimal_places=2)
+    total = serializers.DecimalField(max_digits=12, decimal_places=2)
@@ -1,3 +1,950 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.template.loader import render_to_string
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import Address
+from cart.models import Cart, CartItem
+from dashboard.series import add_months, as_datetime
+from notifications.models import OutboxEmail
+from products.models import Category, Image, Product
+
+from .archive import archived_totals
+from .gateway import (BaseGateway, CircuitBreaker, FakeGateway,
+                      GatewayUnavailable, RazorpayGateway, get_gateway)
+from .inventory import (InsufficientStock, commit_order_stock,
+                        commit_orders_stock, decrement_stock,
+                        release_expired_reservations, reserve_stock)
+from .management.commands import purge_stale
+from .models import (ArchivedOrder, IdempotencyKey, Order, OrderItem,
+                     OrderStatusEvent, Payment, PaymentWebhookEvent,
+                     StockReservation)
+from .pricing import (delivery_charge_for, discounted_price, price_basket,
+                      quote_order)
+from .transitions import (InvalidTransition, bulk_transition, log_created,
+                          transition)
+
+
+class GatewayTest(SimpleTestCase):
+    def test_fake_gateway_round_trip(self):
+        gateway = FakeGateway('secret')
+        order = gateway.create_order('410.50', receipt=7)
+
+        self.assertEqual(order['amount'], 41050)
+        self.assertEqual(gateway.fetch_order(order['id'])['receipt'], '7')
+
+        paid = gateway.pay(order['id'])
+        self.assertTrue(gateway.verify_payment_signature(**paid))
+        self.assertFalse(gateway.verify_payment_signature(
+            paid['razorpay_order_id'], paid['razorpay_payment_id'], 'forged'))
+        self.assertEqual(gateway.metrics.snapshot()['create_order']['calls'], 1)
+
+    def test_signatures_are_refused_without_a_secret(self):
+        # Signed with the empty key, which an unset secret would accept
+        signed = FakeGateway('')
+        paid = signed.pay(signed.create_order(100)['id'])
+        self.assertFalse(RazorpayGateway('key', None).verify_payment_signature(**paid))
+
+    def test_gateways_must_implement_the_order_calls(self):
+        with self.assertRaises(TypeError):
+            BaseGateway('secret')
+
+    def test_circuit_breaker_fails_fast_then_recovers(self):
+        gateway = FakeGateway(breaker=CircuitBreaker(
+            failure_threshold=2, reset_timeout=0.05))
+
+        def unreachable():
+            raise requests.ConnectionError("connection refused")
+
+        for _ in range(2):
+            with self.assertRaises(GatewayUnavailable):
+                gateway._call('create_order', unreachable)
+        self.assertEqual(gateway.breaker.state, 'open')
+
+        # Open breaker rejects without calling the gateway
+        with self.assertRaises(GatewayUnavailable):
+            gateway.create_order(100)
+        self.assertEqual(gateway.metrics.snapshot()[
+                         'create_order']['calls'], 2)
+
+        gateway.breaker.opened_at -= 0.05
+        self.assertEqual(gateway.breaker.state, 'half-open')
+        gateway.create_order(100)
+        self.assertEqual(gateway.breaker.state, 'closed')
+
+    def test_get_gateway_is_shared_and_follows_settings(self):
+        with override_settings(PAYMENT_GATEWAY='fake'):
+            self.assertIsInstance(get_gateway(), FakeGateway)
+            self.assertIs(get_gateway(), get_gateway())
+
+        with override_settings(PAYMENT_GATEWAY='razorpay', RAZORPAY_API_KEY='key',
+                               RAZORPAY_API_SECRET='secret', RAZORPAY_READ_TIMEOUT=4):
+            gateway = get_gateway()
+            self.assertIsInstance(gateway, RazorpayGateway)
+            self.assertEqual(gateway.client.session.timeout, (3.05, 4))
+
+
+@override_settings(PAYMENT_GATEWAY='fake')
+class PaymentWebhookTest(TestCase):
+    def setUp(self):
+        self.user = user = User.objects.create_user(
+            'buyer', 'buyer@example.com', 'pw')
+        address = Address.objects.create(
+            user=user, name='Home', phone_number='1', pin_code='1', street='s',
+            landmark='l', city='c', state='s')
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        self.product = Product.objects.create(
+            name='p', slug='p', description='d', detail='d', price=Decimal('100'),
+            discount=0, stock=3, category=category)
+        self.order = Order.objects.create(
+            user=user, total_price=Decimal('200'), shipping_address=address,
+            billing_address=address)
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=2,
+                                 discounted_price=Decimal('100'))
+        reserve_stock(self.order, {self.product.pk: 2})
+
+        self.gateway = get_gateway()
+        self.razorpay_order = self.gateway.create_order(200)
+        Payment.objects.create(order=self.order, method='razorpay', amount=Decimal('200'),
+                               razorpay_order_id=self.razorpay_order['id'])
+        self.client = APIClient()
+
+    def deliver(self, body, headers):
+        return self.client.post(reverse('payment-webhook'), body, content_type='application/json',
+                                headers=headers)
+
+    def test_captured_event_is_stored_once_and_reconciled(self):
+        body, headers = self.gateway.webhook(
+            'payment.captured', self.razorpay_order['id'], 'pay_1')
+
+        self.assertEqual(self.deliver(body, headers).status_code, 200)
+        # Redelivery of the same event is acknowledged but not stored again
+        self.assertEqual(self.deliver(body, headers).status_code, 200)
+        self.assertEqual(PaymentWebhookEvent.objects.count(), 1)
+
+        call_command('reconcile_payments', stdout=StringIO())
+
+        self.order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(self.order.status, 'confirmed')
+        self.assertEqual(self.order.payment.payment_status, 'completed')
+        self.assertEqual(self.order.payment.razorpay_payment_id, 'pay_1')
+        self.assertEqual(self.product.stock, 1)
+        self.assertFalse(PaymentWebhookEvent.objects.filter(
+            processed_at__isnull=True).exists())
+
+    def test_order_confirmed_by_verify_payment_meanwhile_is_committed_once(self):
+        body, headers = self.gateway.webhook(
+            'payment.captured', self.razorpay_order['id'], 'pay_1')
+        self.deliver(body, headers)
+        paid = self.gateway.pay(self.razorpay_order['id'])
+        bulk_update = Payment.objects.bulk_update
+        self.client.force_authenticate(self.user)
+
+        def verify_then_bulk_update(*args, **kwargs):
+            # The customer's verify_payment lands after the reconciler read the order
+            response = self.client.put(reverse('payment-verify'), paid)
+            self.assertEqual(response.status_code, 200)
+            return bulk_update(*args, **kwargs)
+
+        with mock.patch.object(Payment.objects, 'bulk_update', side_effect=verify_then_bulk_update):
+            call_command('reconcile_payments', stdout=StringIO())
+
+        self.order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(self.order.status, 'confirmed')
+        self.assertEqual(self.product.stock, 1)
+        self.assertEqual(self.order.status_events.filter(
+            status='confirmed').count(), 1)
+        self.assertEqual(PaymentWebhookEvent.objects.get().error, '')
+
+    def test_captured_event_for_a_cancelled_order_is_flagged_for_refund(self):
+        transition(self.order, 'cancelled')
+        body, headers = self.gateway.webhook(
+            'payment.captured', self.razorpay_order['id'], 'pay_1')
+        self.deliver(body, headers)
+
+        call_command('reconcile_payments', stdout=StringIO())
+
+        self.order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertEqual(self.order.payment.payment_status, 'completed')
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(PaymentWebhookEvent.objects.get().error,
+                         "Payment captured but the order is cancelled, it has to be refunded.")
+
+    def test_failed_event_does_not_undo_a_verified_payment(self):
+        body, headers = self.gateway.webhook(
+            'payment.failed', self.razorpay_order['id'], 'pay_1')
+        self.deliver(body, headers)
+        self.client.force_authenticate(self.user)
+        self.client.put(reverse('payment-verify'), self.gateway.pay(self.razorpay_order['id']))
+
+        with CaptureQueriesContext(connection) as captured:
+            call_command('reconcile_payments', stdout=StringIO())
+
+        self.assertEqual(Payment.objects.get().payment_status, 'completed')
+        if connection.features.has_select_for_update:
+            payment_reads = [query['sql'] for query in captured.captured_queries
+                             if 'FROM "checkout_payment"' in query['sql']]
+            self.assertIn('FOR UPDATE', payment_reads[0])
+
+    def test_payment_for_a_cancelled_order_conflicts(self):
+        transition(self.order, 'cancelled')
+        self.client.force_authenticate(self.user)
+
+        response = self.client.put(reverse('payment-verify'),
+                                   self.gateway.pay(self.razorpay_order['id']))
+
+        self.assertEqual(response.status_code, 409)
+        self.order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertEqual(self.order.payment.payment_status, 'completed')
+        self.assertEqual(self.product.stock, 3)
+
+    def test_forged_signature_is_rejected(self):
+        body, headers = self.gateway.webhook(
+            'payment.captured', self.razorpay_order['id'], 'pay_1')
+        headers['X-Razorpay-Signature'] = 'forged'
+
+        self.assertEqual(self.deliver(body, headers).status_code, 400)
+        self.assertFalse(PaymentWebhookEvent.objects.exists())
+
+
+class ConfirmationEmailTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        address = Address.objects.create(
+            user=self.user, name='Home', phone_number='1', pin_code='1', street='s',
+            landmark='l', city='c', state='s')
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        product = Product.objects.create(
+            name='p', slug='p', description='d', detail='d', price=Decimal('100'),
+            discount=0, stock=3, category=category)
+        self.order = Order.objects.create(
+            user=self.user, total_price=Decimal('200'), shipping_address=address,
+            billing_address=address)
+        OrderItem.objects.create(order=self.order, product=product, quantity=2,
+                                 discounted_price=Decimal('100'))
+        reserve_stock(self.order, {product.pk: 2})
+
+    def test_email_is_rendered_once_and_stored_on_the_order(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch('checkout.emails.render_to_string', wraps=render_to_string) as render:
+            response = client.post(reverse('payment-create'),
+                                   {'order': self.order.pk, 'method': 'cod'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(render.call_count, 1)
+
+        self.order.refresh_from_db()
+        email = OutboxEmail.objects.get()
+        self.assertIn(f'#{self.order.pk}', email.subject)
+        self.assertEqual(email.to, ['buyer@example.com'])
+        self.assertTrue(self.order.confirmation_email_html)
+        self.assertEqual(email.html_body, self.order.confirmation_email_html)
+
+    def test_admin_resend_queues_the_stored_html(self):
+        Order.objects.filter(pk=self.order.pk).update(
+            status='confirmed', confirmation_email_html='<p>Stored</p>')
+        unsent = Order.objects.create(user=self.user, total_price=Decimal('10'))
+        self.client.force_login(User.objects.create_superuser(
+            'admin', 'admin@example.com', 'pw'))
+
+        with mock.patch('checkout.emails.render_to_string') as render:
+            response = self.client.post(reverse('admin:checkout_order_changelist'), {
+                'action': 'resend_confirmation_email',
+                '_selected_action': [self.order.pk, unsent.pk],
+            })
+        self.assertEqual(response.status_code, 302)
+        render.assert_not_called()
+
+        # Orders without a stored confirmation are skipped
+        email = OutboxEmail.objects.get()
+        self.assertEqual((email.to, email.html_body), (['buyer@example.com'], '<p>Stored</p>'))
+
+
+class PricingTest(SimpleTestCase):
+    def product(self, pk, price, discount):
+        return Product(id=pk, name=f'p{pk}', price=Decimal(price), discount=discount)
+
+    def test_discounts_round_half_up_to_the_cent(self):
+        self.assertEqual(discounted_price(Decimal('99.99'), 15), Decimal('84.99'))
+        self.assertEqual(discounted_price(Decimal('10.05'), 50), Decimal('5.03'))
+        self.assertEqual(discounted_price(Decimal('10'), None), Decimal('10.00'))
+
+    def test_delivery_is_free_from_the_threshold(self):
+        self.assertEqual(delivery_charge_for(Decimal('498.99')), Decimal('50.00'))
+        self.assertEqual(delivery_charge_for(Decimal('499.00')), Decimal('0.00'))
+
+    def test_basket_totals_are_sums_of_rounded_lines(self):
+        quote = price_basket([
+            (self.product(1, '99.99', 15), 3),
+            (self.product(2, '10.05', 50), 2),
+        ])
+
+        self.assertEqual([line.line_total for line in quote.lines],
+                         [Decimal('254.97'), Decimal('10.06')])
+        self.assertEqual(quote.item_count, 5)
+        self.assertEqual(quote.subtotal, Decimal('265.03'))
+        self.assertEqual(quote.delivery_charge, Decimal('50.00'))
+        self.assertEqual(quote.total, Decimal('315.03'))
+
+    def test_order_is_priced_from_its_captured_prices(self):
+        order = Order(total_price=Decimal('230.00'), delivery_charge=Decimal('0.00'))
+        items = [
+            # Captured before the catalog price changed
+            OrderItem(product=self.product(1, '150', 0), quantity=2,
+                      discounted_price=Decimal('80.00')),
+            # Added in the admin without a captured price
+            OrderItem(product=self.product(2, '100', 30), quantity=1),
+        ]
+
+        quote = quote_order(order, items)
+
+        self.assertEqual([line.discounted_price for line in quote.lines],
+                         [Decimal('80.00'), Decimal('70.00')])
+        self.assertEqual(quote.subtotal, Decimal('230.00'))
+        self.assertEqual(quote.delivery_charge, Decimal('0.00'))
+        self.assertEqual(quote.total, Decimal('230.00'))
+
+
+class QuoteEndpointTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_quote_prices_the_cart_without_ordering(self):
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        product = Product.objects.create(
+            name='p', slug='p', description='d', detail='d', price=Decimal('99.99'),
+            discount=15, stock=1, category=category)
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=product, quantity=6)
+
+        response = self.client.get(reverse('order-quote'))
+
+        self.assertEqual(response.status_code, 200)
+        data = response.data['data']
+        self.assertEqual(data['lines'][0]['discounted_price'], '84.99')
+        self.assertEqual(data['item_count'], 6)
+        self.assertEqual(data['subtotal'], '509.94')
+        self.assertEqual(data['delivery_charge'], '0.00')
+        self.assertEqual(data['total'], '509.94')
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_empty_cart_has_no_quote(self):
+        response = self.client.get(reverse('order-quote'))
+        self.assertEqual(response.status_code, 400)
+
+
+class CreateOrderTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+
+    def make_cart(self, username, lines):
+        user = User.objects.create_user(username, f'{username}@example.com', 'pw')
+        address = Address.objects.create(
+            user=user, name='Home', phone_number='1', pin_code='1', street='s',
+            landmark='l', city='c', state='s')
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, quantity=2, product=Product.objects.create(
+                name=f'{username}-{i}', slug=f'{username}-{i}', description='d', detail='d',
+                price=Decimal('100'), discount=10, stock=5, category=self.category))
+            for i in range(lines)
+        ])
+        client = APIClient()
+        client.force_authenticate(user)
+        return client, address
+
+    def place_order(self, client, address):
+        response = client.post(reverse('order-create'),
+                               {'shipping_address': address.pk})
+        self.assertEqual(response.status_code, 201)
+        return response
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        client, address = self.make_cart('one', 1)
+        with CaptureQueriesContext(connection) as one_line:
+            self.place_order(client, address)
+
+        client, address = self.make_cart('many', 5)
+        with self.assertNumQueries(len(one_line.captured_queries)):
+            response = self.place_order(client, address)
+        self.assertEqual(len(response.data['data']['items']), 5)
+
+    def test_cart_becomes_the_order(self):
+        self.place_order(*self.make_cart('buyer', 2))
+
+        order = Order.objects.get()
+        # 2 x 2 x 90.00, plus delivery below the free delivery threshold
+        self.assertEqual(order.total_price, Decimal('410.00'))
+        self.assertEqual(order.delivery_charge, Decimal('50.00'))
+        self.assertEqual(order.items.count(), 2)
+        self.assertEqual(order.reservations.filter(status='held').count(), 2)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(OrderStatusEvent.objects.get().status, 'pending')
+
+
+class DecrementStockTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        self.products = [
+            Product.objects.create(
+                name=f'p{stock}', slug=f'p{stock}', description='d', detail='d',
+                price=Decimal('100'), discount=0, stock=stock, category=category)
+            for stock in (5, 2, 1)
+        ]
+
+    def stock(self):
+        return list(Product.objects.order_by('stock').values_list('stock', flat=True))
+
+    def test_decrements_every_product_in_one_update(self):
+        a, b, c = self.products
+        # Savepoint, UPDATE, release
+        with self.assertNumQueries(3):
+            decrement_stock({a.pk: 5, b.pk: 1, c.pk: 1})
+        self.assertEqual(self.stock(), [0, 0, 1])
+
+    def test_nothing_is_decremented_if_any_product_is_short(self):
+        a, b, c = self.products
+
+        with self.assertRaises(InsufficientStock) as raised:
+            decrement_stock({a.pk: 1, b.pk: 3, c.pk: 2})
+
+        # The UPDATE that decremented the first product was rolled back
+        self.assertEqual(self.stock(), [1, 2, 5])
+        self.assertEqual(raised.exception.product_ids, sorted([b.pk, c.pk]))
+
+    def test_reserved_units_stay_behind(self):
+        a, b, _ = self.products
+
+        with self.assertRaises(InsufficientStock) as raised:
+            decrement_stock({a.pk: 4, b.pk: 1}, reserved={a.pk: 2})
+        self.assertEqual(raised.exception.product_ids, [a.pk])
+
+        decrement_stock({a.pk: 3}, reserved={a.pk: 2})
+        self.assertEqual(self.stock(), [1, 2, 2])
+
+
+class StockReservationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        self.address = Address.objects.create(
+            user=self.user, name='Home', phone_number='1', pin_code='1', street='s',
+            landmark='l', city='c', state='s')
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        self.product = Product.objects.create(
+            name='p', slug='p', description='d', detail='d', price=Decimal('100'),
+            discount=0, stock=2, category=category)
+
+    def make_order(self, quantity=2, reserve=True):
+        order = Order.objects.create(
+            user=self.user, total_price=Decimal('100') * quantity,
+            shipping_address=self.address, billing_address=self.address)
+        OrderItem.objects.create(order=order, product=self.product, quantity=quantity,
+                                 discounted_price=Decimal('100'))
+        if reserve:
+            reserve_stock(order, {self.product.pk: quantity})
+        return order
+
+    def expire(self, order):
+        StockReservation.objects.filter(order=order).update(
+            expires_at=timezone.now() - timedelta(minutes=1))
+
+    def assertStock(self, stock):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, stock)
+
+    def test_holds_count_against_stock_until_they_expire(self):
+        first = self.make_order()
+        with self.assertRaises(InsufficientStock) as raised:
+            self.make_order()
+        self.assertEqual(raised.exception.product_ids, [self.product.pk])
+
+        self.expire(first)
+        self.make_order()
+        self.assertEqual(release_expired_reservations(), 1)
+        self.assertEqual(StockReservation.objects.get(
+            order=first).status, 'released')
+
+    def test_late_payment_cannot_take_stock_held_by_another_order(self):
+        late = self.make_order()
+        self.expire(late)
+        other = self.make_order()
+
+        with self.assertRaises(InsufficientStock):
+            commit_order_stock(late)
+        self.assertStock(2)
+
+        commit_order_stock(other)
+        self.assertStock(0)
+        self.assertEqual(StockReservation.objects.get(
+            order=other).status, 'committed')
+
+    def test_late_payment_takes_stock_nobody_holds(self):
+        late = self.make_order(quantity=1)
+        self.expire(late)
+        self.make_order(quantity=1)
+
+        commit_order_stock(late)
+        self.assertStock(1)
+
+    def test_batch_commit_skips_only_the_orders_that_are_short(self):
+        self.product.stock = 3
+        self.product.save()
+        first, second = self.make_order(quantity=1), self.make_order(quantity=2)
+        self.expire(second)
+        holder = self.make_order(quantity=1)
+        self.expire(first)
+
+        committed, failed = commit_orders_stock([first.pk, second.pk])
+
+        self.assertEqual(committed, [first.pk])
+        self.assertEqual(failed, {second.pk: [self.product.pk]})
+        self.assertStock(2)
+        self.assertEqual(StockReservation.objects.get(
+            order=holder).status, 'held')
+
+    def test_cancelling_a_confirmed_order_puts_its_stock_back(self):
+        order = self.make_order()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(reverse('payment-create'),
+                               {'order': order.pk, 'method': 'cod'})
+        self.assertEqual(response.status_code, 201)
+        self.assertStock(0)
+
+        response = client.put(reverse('order-cancel', args=[order.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertStock(2)
+        self.assertEqual(StockReservation.objects.get(
+            order=order).status, 'released')
+
+    def test_admin_cancel_restocks_confirmed_and_releases_pending_orders(self):
+        confirmed = self.make_order(quantity=1)
+        commit_order_stock(confirmed)
+        transition(confirmed, 'confirmed')
+        pending = self.make_order(quantity=1)
+        admin_user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'pw')
+        self.client.force_login(admin_user)
+
+        self.client.post(reverse('admin:checkout_order_changelist'), {
+            'action': 'mark_cancelled',
+            '_selected_action': [confirmed.pk, pending.pk],
+        })
+
+        self.assertEqual(Order.objects.filter(
+            status='cancelled').count(), 2)
+        self.assertStock(2)
+        self.assertFalse(StockReservation.objects.exclude(
+            status='released').exists())
+
+
+@override_settings(PAYMENT_GATEWAY='fake')
+class IdempotencyTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        self.order = Order.objects.create(user=user, total_price=Decimal('200'))
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.gateway = get_gateway()
+
+    def pay(self, method='razorpay', key='key-1'):
+        return self.client.post(reverse('payment-create'), {'order': self.order.pk, 'method': method},
+                                headers={'Idempotency-Key': key})
+
+    def test_retry_replays_the_stored_response(self):
+        first = self.pay()
+        replay = self.pay()
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(replay.status_code, 201)
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(replay.data, first.data)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.pay()
+        self.assertEqual(self.pay(method='cod').status_code, 422)
+
+    def test_duplicate_during_the_gateway_call_waits_for_the_first_response(self):
+        outer_depth = len(connection.atomic_blocks)
+        seen = {}
+
+        def first_request_finishes(seconds):
+            IdempotencyKey.objects.update(status_code=201, response={'id': 'first'})
+
+        def create_order(*args, **kwargs):
+            seen['depth'] = len(connection.atomic_blocks)
+            with mock.patch('checkout.idempotency.time.sleep',
+                            side_effect=first_request_finishes) as sleep:
+                duplicate = self.pay()
+            seen['duplicate'] = (duplicate.status_code, duplicate.data, sleep.call_count)
+            return FakeGateway.create_order(self.gateway, *args, **kwargs)
+
+        with mock.patch.object(self.gateway, 'create_order', side_effect=create_order):
+            self.pay()
+
+        # No transaction is held while the duplicate polls
+        self.assertEqual(seen, {'depth': outer_depth, 'duplicate': (201, {'id': 'first'}, 1)})
+        self.assertEqual(Payment.objects.count(), 1)
+
+    @override_settings(IDEMPOTENCY_WAIT=timedelta(0))
+    def test_duplicate_conflicts_once_the_wait_is_over(self):
+        def create_order(*args, **kwargs):
+            self.assertEqual(self.pay().status_code, 409)
+            return FakeGateway.create_order(self.gateway, *args, **kwargs)
+
+        with mock.patch.object(self.gateway, 'create_order', side_effect=create_order):
+            self.assertEqual(self.pay().status_code, 201)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    @override_settings(IDEMPOTENCY_WAIT=timedelta(0))
+    def test_claim_of_a_dead_worker_is_taken_over_after_the_lease(self):
+        record = IdempotencyKey.objects.create(
+            user=self.order.user, endpoint='create_payment', key='key-1', fingerprint='f')
+
+        with mock.patch('checkout.idempotency.request_fingerprint', return_value='f'):
+            # Still within the lease, the claimer may just be slow
+            self.assertEqual(self.pay().status_code, 409)
+
+            IdempotencyKey.objects.update(
+                claimed_at=timezone.now() - settings.IDEMPOTENCY_LEASE - timedelta(seconds=1))
+            response = self.pay()
+
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+        record.refresh_from_db()
+        self.assertEqual(record.status_code, 201)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_server_errors_are_not_stored(self):
+        with mock.patch.object(self.gateway, 'create_order',
+                               side_effect=GatewayUnavailable("timed out")):
+            self.assertEqual(self.pay().status_code, 503)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        response = self.pay()
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+
+
+class OrderTransitionTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+
+    def make_orders(self, *statuses):
+        return [Order.objects.create(user=self.user, total_price=Decimal('100'), status=status)
+                for status in statuses]
+
+    def test_transition_logs_and_rejects_invalid_moves(self):
+        order, = self.make_orders('pending')
+
+        transition(order, 'confirmed', source='test')
+        with self.assertRaises(InvalidTransition):
+            transition(order, 'returned')
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'confirmed')
+        event = order.status_events.get()
+        self.assertEqual((event.from_status, event.status),
+                         ('pending', 'confirmed'))
+
+    def test_status_history_is_read_only_in_the_admin(self):
+        order, = self.make_orders('pending')
+        transition(order, 'confirmed')
+        event = OrderStatusEvent.objects.get()
+        self.client.force_login(User.objects.create_superuser(
+            'admin', 'admin@example.com', 'pw'))
+
+        self.assertEqual(self.client.get(reverse(
+            'admin:checkout_orderstatusevent_changelist')).status_code, 200)
+        self.assertEqual(self.client.get(reverse(
+            'admin:checkout_orderstatusevent_add')).status_code, 403)
+        self.assertEqual(self.client.post(reverse(
+            'admin:checkout_orderstatusevent_delete', args=[event.pk]), {'post': 'yes'}).status_code, 403)
+        self.assertEqual(self.client.post(reverse(
+            'admin:checkout_orderstatusevent_change', args=[event.pk]),
+            {'source': 'forged'}).status_code, 403)
+        self.assertTrue(OrderStatusEvent.objects.filter(
+            pk=event.pk, source='').exists())
+
+    def test_stale_status_is_not_overwritten(self):
+        order, = self.make_orders('confirmed')
+        Order.objects.filter(pk=order.pk).update(status='cancelled')
+
+        with self.assertRaises(InvalidTransition):
+            transition(order, 'delivered')
+        self.assertFalse(OrderStatusEvent.objects.exists())
+
+    def test_bulk_transition_updates_once_per_source_status(self):
+        orders = self.make_orders(
+            'pending', 'pending', 'confirmed', 'delivered')
+
+        # Savepoint, locking SELECT, two UPDATEs, one INSERT, release
+        with self.assertNumQueries(6):
+            moved = bulk_transition(
+                [order.pk for order in orders], 'cancelled')
+
+        self.assertCountEqual(moved, [order.pk for order in orders[:3]])
+        self.assertEqual(Order.objects.filter(status='cancelled').count(), 3)
+        self.assertEqual(OrderStatusEvent.objects.filter(
+            status='cancelled').count(), 3)
+
+
+class ExportOrdersTest(TestCase):
+    def test_csv_has_one_row_per_item_and_honours_filters(self):
+        user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        product = Product.objects.create(
+            name='p', slug='p', description='d', detail='d', price=Decimal('100'),
+            discount=0, stock=3, category=category)
+        for status in ('confirmed', 'cancelled'):
+            order = Order.objects.create(
+                user=user, total_price=Decimal('200'), status=status)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, quantity=1,
+                          discounted_price=Decimal('100'))
+                for _ in range(2)
+            ])
+
+        out = StringIO()
+        call_command('export_orders', '--status', 'confirmed',
+                     stdout=out, stderr=StringIO())
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('order_id,'))
+        self.assertIn(',confirmed,buyer,', lines[1])
+
+
+class PurgeStaleTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        self.product = Product.objects.create(
+            name='p', slug='p', description='d', detail='d', price=Decimal('100'),
+            discount=0, stock=3, category=category)
+        self.long_ago = timezone.now() - timedelta(days=60)
+
+    def make_cart(self, stale):
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=self.product)
+        if stale:
+            Cart.objects.filter(pk=cart.pk).update(updated_at=self.long_ago)
+        return cart
+
+    def make_order(self, stale, paid=False):
+        order = Order.objects.create(user=self.user, total_price=Decimal('100'))
+        OrderItem.objects.create(order=order, product=self.product, quantity=1,
+                                 discounted_price=Decimal('100'))
+        log_created(order)
+        if paid:
+            Payment.objects.create(order=order, method='cod', amount=Decimal('100'))
+        if stale:
+            Order.objects.filter(pk=order.pk).update(created_at=self.long_ago)
+        return order
+
+    def purge(self, *args):
+        out = StringIO()
+        call_command('purge_stale', *args, stdout=out)
+        return out.getvalue()
+
+    def test_stale_rows_are_deleted_in_chunks(self):
+        stale = [self.make_cart(stale=True) for _ in range(5)]
+        fresh = self.make_cart(stale=False)
+        with CaptureQueriesContext(connection) as captured:
+            out = self.purge('--chunk-size', '2')
+
+        self.assertIn('Deleted 5 carts (5 items)', out)
+        self.assertEqual(list(Cart.objects.values_list('pk', flat=True)), [fresh.pk])
+        self.assertFalse(CartItem.objects.filter(cart__in=stale).exists())
+        cart_deletes = [query for query in captured.captured_queries
+                        if query['sql'].startswith('DELETE FROM "cart_cart"')]
+        self.assertEqual(len(cart_deletes), 3)
+
+    def test_rows_revived_after_the_scan_are_kept(self):
+        revived, stale = self.make_cart(stale=True), self.make_cart(stale=True)
+
+        def touch_then_atomic(*args, **kwargs):
+            # Someone adds to the cart between the scan and the chunk's delete
+            Cart.objects.filter(pk=revived.pk).update(updated_at=timezone.now())
+            return transaction.atomic(*args, **kwargs)
+
+        with mock.patch.object(purge_stale, 'transaction', mock.Mock(atomic=touch_then_atomic)):
+            out = self.purge()
+
+        self.assertIn('Deleted 1 carts (1 items)', out)
+        self.assertTrue(Cart.objects.filter(pk=revived.pk).exists())
+        self.assertFalse(Cart.objects.filter(pk=stale.pk).exists())
+
+    def test_dry_run_only_counts(self):
+        self.make_cart(stale=True)
+        self.make_order(stale=True)
+        IdempotencyKey.objects.create(user=self.user, endpoint='create_order',
+                                      key='k', fingerprint='f')
+        IdempotencyKey.objects.update(created_at=self.long_ago)
+
+        out = self.purge('--dry-run')
+
+        self.assertIn('Would delete 1 carts (1 items), 1 abandoned orders (1 items) '
+                      'and 1 idempotency keys.', out)
+        self.assertEqual((Cart.objects.count(), Order.objects.count(),
+                          IdempotencyKey.objects.count()), (1, 1, 1))
+
+    def test_abandoned_orders_and_expired_keys_are_deleted(self):
+        abandoned = self.make_order(stale=True)
+        paid = self.make_order(stale=True, paid=True)
+        recent = self.make_order(stale=False)
+        for key in ('old', 'new'):
+            IdempotencyKey.objects.create(user=self.user, endpoint='create_order',
+                                          key=key, fingerprint='f')
+        IdempotencyKey.objects.filter(key='old').update(created_at=self.long_ago)
+
+        out = self.purge()
+
+        self.assertIn('1 abandoned orders (1 items) and 1 idempotency keys', out)
+        self.assertCountEqual(Order.objects.values_list('pk', flat=True), [paid.pk, recent.pk])
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['new'])
+        # The abandoned order's status log goes with it, the others are kept
+        self.assertFalse(OrderStatusEvent.objects.filter(order_id=abandoned.pk).exists())
+        self.assertEqual(OrderStatusEvent.objects.count(), 2)
+
+
+class ArchiveOrdersTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        self.product = Product.objects.create(
+            name='p', slug='p', description='d', detail='d', price=Decimal('100'),
+            discount=0, stock=3, category=category)
+
+    def make_order(self, status, updated_at=None):
+        order = Order.objects.create(
+            user=self.user, total_price=Decimal('100'), status=status)
+        OrderItem.objects.create(order=order, product=self.product, quantity=1,
+                                 discounted_price=Decimal('100'))
+        if updated_at:
+            Order.objects.filter(pk=order.pk).update(updated_at=updated_at)
+        return order
+
+    def test_old_closed_orders_move_to_archive_and_stay_readable(self):
+        long_ago = timezone.now() - timedelta(days=400)
+        old = self.make_order('confirmed')
+        log_created(old)
+        transition(old, 'delivered', source='admin:staff')
+        Order.objects.filter(pk=old.pk).update(
+            updated_at=long_ago, confirmation_email_html='<p>Thanks</p>')
+        Payment.objects.create(order=old, method='cod', amount=Decimal('100'))
+        recent = self.make_order('delivered')
+        open_order = self.make_order('confirmed', updated_at=long_ago)
+
+        call_command('archive_orders', '--months', '12', stdout=StringIO())
+
+        self.assertCountEqual(Order.objects.values_list(
+            'pk', flat=True), [recent.pk, open_order.pk])
+        archived = ArchivedOrder.objects.get()
+        self.assertEqual(archived.pk, old.pk)
+        self.assertEqual(archived.items.count(), 1)
+        self.assertEqual(archived.payment.method, 'cod')
+        self.assertEqual(list(archived.status_events.values_list('status', 'source')),
+                         [('confirmed', ''), ('delivered', 'admin:staff')])
+        self.assertFalse(OrderStatusEvent.objects.exists())
+        self.assertEqual(archived_totals(), {
+                         'orders': 1, 'revenue': Decimal('100')})
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(reverse('order-detail', args=[old.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data']['items'][0]['quantity'], 1)
+
+        response = client.get(reverse('order-email', args=[old.pk]))
+        self.assertEqual(response.content, b'<p>Thanks</p>')
+
+        response = client.get(reverse('order-list'))
+        orders = response.data['data']['orders']
+        self.assertEqual(response.data['data']['count'], 3)
+        self.assertEqual([order['id'] for order in orders],
+                         [str(open_order.pk), str(recent.pk), str(old.pk)])
+        self.assertEqual(orders[2]['item_count'], 1)
+        self.assertEqual(orders[2]['status'], 'delivered')
+
+    def test_order_list_summarises_live_and_archived_orders_in_constant_queries(self):
+        Image.objects.create(product=self.product, image='products/p.png')
+        plain = Product.objects.create(
+            name='plain', slug='plain', description='d', detail='d', price=Decimal('50'),
+            discount=0, stock=3, category=self.product.category)
+        long_ago = timezone.now() - timedelta(days=400)
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        self.make_order('delivered', long_ago)
+        call_command('archive_orders', '--months', '12', stdout=StringIO())
+        self.make_order('confirmed')
+        with CaptureQueriesContext(connection) as two_orders:
+            client.get(reverse('order-list'))
+
+        for _ in range(2):
+            self.make_order('delivered', long_ago)
+        call_command('archive_orders', '--months', '12', stdout=StringIO())
+        without_image = Order.objects.create(user=self.user, total_price=Decimal('100'))
+        OrderItem.objects.bulk_create([
+            OrderItem(order=without_image, product=plain, quantity=1, discounted_price=Decimal('50'))
+            for _ in range(2)
+        ])
+        with self.assertNumQueries(len(two_orders)):
+            response = client.get(reverse('order-list'))
+
+        orders = response.data['data']['orders']
+        self.assertEqual(response.data['data']['count'], 5)
+        # Newest first, archived or not
+        self.assertEqual([order['status'] for order in orders],
+                         ['pending', 'delivered', 'delivered', 'confirmed', 'delivered'])
+        self.assertEqual(ArchivedOrder.objects.count(), 3)
+        self.assertEqual(orders[0]['id'], str(without_image.pk))
+        self.assertEqual((orders[0]['item_count'], orders[0]['thumbnail']), (2, None))
+        for order in orders[1:]:
+            self.assertEqual(order['item_count'], 1)
+            self.assertIn('products/p.png', order['thumbnail'])
+        self.assertEqual(set(orders[0]), {'id', 'status', 'total_price',
+                                          'item_count', 'thumbnail', 'created_at'})
+
+    def test_cutoff_is_the_start_of_a_calendar_month(self):
+        cutoff = as_datetime(add_months(timezone.localdate(), -1))
+        before = self.make_order('delivered', cutoff - timedelta(seconds=1))
+        self.make_order('delivered', cutoff)
+
+        call_command('archive_orders', '--months', '1', stdout=StringIO())
+
+        self.assertEqual(list(ArchivedOrder.objects.values_list(
+            'pk', flat=True)), [before.pk])
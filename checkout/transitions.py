@@ -0,0 +1,108 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .models import Order, OrderStatusEvent
+
+# Allowed moves, from each status to the statuses it can go to next
+TRANSITIONS = {
+    'pending': ('confirmed', 'cancelled'),
+    'confirmed': ('delivered', 'cancelled'),
+    'delivered': ('return_initiated',),
+    'return_initiated': ('returned',),
+    'returned': (),
+    'cancelled': (),
+}
+
+# Sent inside the transaction with order_ids, status and at whenever orders
+# enter a status, including 'pending' when they are created
+order_status_changed = Signal()
+
+
+class InvalidTransition(Exception):
+    def __init__(self, from_status, to_status):
+        self.from_status = from_status
+        self.to_status = to_status
+        super().__init__(
+            f"Order can't move from '{from_status}' to '{to_status}'.")
+
+
+def can_transition(from_status, to_status):
+    return to_status in TRANSITIONS.get(from_status, ())
+
+
+def sources_for(to_status):
+    """Statuses an order may be in to move to `to_status`."""
+    return [status for status, targets in TRANSITIONS.items() if to_status in targets]
+
+
+def log_created(order, source=''):
+    """Log the initial 'pending' status of a newly created order."""
+    event = OrderStatusEvent.objects.create(
+        order=order, status=order.status, at=order.created_at, source=source)
+    order_status_changed.send(
+        sender=Order, order_ids=[order.pk], status=order.status, at=order.created_at)
+    return event
+
+
+def transition(order, to_status, source=''):
+    """
+    Move one order to `to_status` and log it. The UPDATE is conditional on the
+    status we read, so a concurrent change makes this raise InvalidTransition
+    instead of silently overwriting it.
+    """
+    from_status = order.status
+    if not can_transition(from_status, to_status):
+        raise InvalidTransition(from_status, to_status)
+
+    now = timezone.now()
+    with transaction.atomic():
+        updated = Order.objects.filter(pk=order.pk, status=from_status).update(
+            status=to_status, updated_at=now)
+        if not updated:
+            current = Order.objects.filter(
+                pk=order.pk).values_list('status', flat=True).first()
+            raise InvalidTransition(current, to_status)
+        OrderStatusEvent.objects.create(
+            order=order, from_status=from_status, status=to_status, at=now, source=source)
+        order_status_changed.send(
+            sender=Order, order_ids=[order.pk], status=to_status, at=now)
+
+    order.status = to_status
+    order.updated_at = now
+    return order
+
+
+def bulk_transition(order_ids, to_status, source=''):
+    """
+    Move every order in `order_ids` that is allowed to reach `to_status`, with
+    one UPDATE per source status and one INSERT for the log. Returns the ids
+    that moved; the others were in a status that can't make this move.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        by_status = defaultdict(list)
+        rows = (
+            Order.objects.select_for_update()
+            .filter(pk__in=list(order_ids), status__in=sources_for(to_status))
+            .values_list('pk', 'status')
+        )
+        for pk, status in rows:
+            by_status[status].append(pk)
+
+        events = []
+        for from_status, pks in by_status.items():
+            Order.objects.filter(pk__in=pks).update(
+                status=to_status, updated_at=now)
+            events.extend(
+                OrderStatusEvent(order_id=pk, from_status=from_status,
+                                 status=to_status, at=now, source=source)
+                for pk in pks
+            )
+        OrderStatusEvent.objects.bulk_create(events)
+        order_status_changed.send(
+            sender=Order, order_ids=[event.order_id for event in events], status=to_status, at=now)
+
+    return [event.order_id for event in events]
@@ -8,12 +8,17 @@ urlpatterns = [
          views.OrderViewSet.as_view({'get': 'list_orders'}), name="order-list"),
     path('orders/create/',
          views.OrderViewSet.as_view({'post': 'create_order'}), name="order-create"),
+    # Prices the cart without creating an order
+    path('quote/',
+         views.OrderViewSet.as_view({'get': 'get_quote'}), name="order-quote"),
     path('orders/<int:pk>/',
          views.OrderViewSet.as_view({'get': 'retrieve_order'}), name="order-detail"),
 
     # Updates only shipping address
     path('orders/<int:pk>/update/',
          views.OrderViewSet.as_view({'put': 'update_order'}), name="order-update"),
+    path('orders/<int:pk>/email/',
+         views.OrderViewSet.as_view({'get': 'view_confirmation_email'}), name="order-email"),
     path('orders/<int:pk>/cancel/',
          views.OrderViewSet.as_view({'put': 'cancel_order'}), name="order-cancel"),
     path('orders/<int:pk>/return/',
@@ -24,6 +29,8 @@ urlpatterns = [
          views.PaymentViewSet.as_view({'post': 'create_payment'}), name="payment-create"),
     path('payments/verify/',
          views.PaymentViewSet.as_view({'put': 'verify_payment'}), name="payment-verify"),
+    path('payments/webhook/',
+         views.PaymentWebhookViewSet.as_view({'post': 'receive_webhook'}), name="payment-webhook"),
     path('payments/<int:order_id>/',
          views.PaymentViewSet.as_view({'get': 'retrieve_payment'}), name="payment-detail"),
 ]
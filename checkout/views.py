@@ -1,96 +1,128 @@
-import razorpay
-from django.conf import settings
-from django.core.mail import send_mail
-from django.db.models import F
-from django.template.loader import render_to_string
-from django.utils import timezone
+import hashlib
+
+from django.db import transaction
+from django.http import HttpResponse
 from rest_framework import status, viewsets
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
 
 from accounts.models import Address
 from cart.models import CartItem
 from revvona.utils import CustomPagination, error_response, success_response
 
-from .models import Order, OrderItem, Payment
-from .serializers import OrderSerializer, PaymentSerializer
+from .emails import send_order_confirmation_email
+from .gateway import GatewayError, GatewayUnavailable, get_gateway
+from .idempotency import idempotent
+from .inventory import (InsufficientStock, commit_order_stock,
+                        release_reservations, reserve_stock, restock_orders)
+from .models import (ArchivedOrder, Order, OrderItem, Payment,
+                     PaymentWebhookEvent)
+from .pricing import quote_cart
+from .serializers import (ArchivedOrderSerializer, OrderSerializer,
+                          OrderSummarySerializer, PaymentSerializer,
+                          QuoteSerializer)
+from .transitions import InvalidTransition, log_created, transition
 
 
 class OrderViewSet(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
 
+    @idempotent
     def create_order(self, request):
         try:
             user = request.user
-            cart_items = CartItem.objects.filter(cart__user=user)
-            if not cart_items.exists():
-                return error_response("Cart is empty", status_code=status.HTTP_400_BAD_REQUEST)
-
             shipping_address_id = request.data.get('shipping_address')
             billing_address_id = request.data.get('billing_address', None)
 
-            try:
-                shipping_address = Address.objects.get(
-                    id=shipping_address_id, user=user)
-                billing_address = Address.objects.get(
-                    id=billing_address_id, user=user) if billing_address_id else None
-            except Address.DoesNotExist:
-                return error_response("Invalid address", status_code=status.HTTP_400_BAD_REQUEST)
-
-            total_price = 0
-
-            # Create the order
-            order = Order.objects.create(
-                user=user,
-                shipping_address=shipping_address,
-                billing_address=billing_address,
-                total_price=0,  # Will be updated after calculating total
-                delivery_charge=0,  # Default delivery charge
-            )
-
-            # Create order items and calculate total price with discount
-            for item in cart_items:
-                product_price = item.product.price
-                discount = item.product.discount or 0  # Default to 0 if no discount
-                discounted_price = product_price - \
-                    (product_price * discount / 100)
-
-                total_price += discounted_price * item.quantity
-
-                OrderItem.objects.create(
-                    order=order,
-                    product=item.product,
-                    quantity=item.quantity,
-                    discounted_price=discounted_price
+            # Everything below commits together or not at all
+            with transaction.atomic():
+                # Lock the cart lines so a concurrent request can't order the same cart twice
+                cart_items = list(
+                    CartItem.objects.select_for_update(of=('self',))
+                    .select_related('product')
+                    .filter(cart__user=user)
+                    .order_by('id')
+                )
+                if not cart_items:
+                    return error_response("Cart is empty", status_code=status.HTTP_400_BAD_REQUEST)
+
+                # Fetch both addresses in one query
+                address_ids = {shipping_address_id, billing_address_id} - {None}
+                addresses = {str(address.id): address for address in Address.objects.filter(
+                    id__in=address_ids, user=user)}
+                shipping_address = addresses.get(str(shipping_address_id))
+                billing_address = addresses.get(
+                    str(billing_address_id)) if billing_address_id else None
+                if not shipping_address or (billing_address_id and not billing_address):
+                    return error_response("Invalid address", status_code=status.HTTP_400_BAD_REQUEST)
+
+                quote = quote_cart(cart_items)
+                quantities = {item.product_id: item.quantity for item in cart_items}
+                order_items = [
+                    OrderItem(product_id=line.product_id, quantity=line.quantity,
+                              discounted_price=line.discounted_price)
+                    for line in quote.lines
+                ]
+
+                # The totals are known up front, so the order is written once
+                order = Order.objects.create(
+                    user=user,
+                    shipping_address=shipping_address,
+                    billing_address=billing_address,
+                    total_price=quote.total,
+                    delivery_charge=quote.delivery_charge,
                 )
 
-            delivery_charge = 50
-            if total_price >= 499:
-                delivery_charge = 0
+                for order_item in order_items:
+                    order_item.order = order
+                OrderItem.objects.bulk_create(order_items)
+                log_created(order, source='customer')
 
-            # Update the total price of the order
-            total_price += delivery_charge  # Add delivery charge
-            order.delivery_charge = delivery_charge
-            order.total_price += total_price
-            order.save()
+                # Hold the stock until the order is paid for or the hold expires
+                reserve_stock(order, quantities)
 
-            cart_items.delete()  # Clear cart after order creation
+                # Clear cart after order creation
+                CartItem.objects.filter(
+                    id__in=[item.id for item in cart_items]).delete()
 
+            order = OrderSerializer.setup_eager_loading(
+                Order.objects.filter(pk=order.pk)).get()
             serializer = OrderSerializer(order)
             return success_response(serializer.data, "Order created successfully", status_code=status.HTTP_201_CREATED)
 
+        except InsufficientStock as e:
+            return error_response("Some items in your cart are out of stock.", e.product_ids, status_code=status.HTTP_409_CONFLICT)
         except Exception as e:
             return error_response("An error occurred while creating the order.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def get_quote(self, request):
+        """Price the cart the way create_order would, without creating anything."""
+        try:
+            cart_items = list(CartItem.objects.select_related(
+                'product').filter(cart__user=request.user).order_by('id'))
+            if not cart_items:
+                return error_response("Cart is empty", status_code=status.HTTP_400_BAD_REQUEST)
+
+            serializer = QuoteSerializer(quote_cart(cart_items))
+            return success_response(serializer.data, "Quote calculated successfully")
+        except Exception as e:
+            return error_response("An error occurred while calculating the quote.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
     def list_orders(self, request):
         try:
-            orders = Order.objects.filter(user=request.user)
+            # Archived orders keep their id, so the two never overlap
+            orders = OrderSummarySerializer.setup_eager_loading(
+                Order.objects.filter(user=request.user)).union(
+                OrderSummarySerializer.setup_eager_loading(
+                    ArchivedOrder.objects.filter(user=request.user)),
+                all=True,
+            ).order_by('-created_at', '-id')
             paginator = CustomPagination()
             paginated_orders = paginator.paginate_queryset(orders, request)
 
             if paginated_orders is None:
                 return error_response("No orders found", status_code=status.HTTP_404_NOT_FOUND)
 
-            serializer = OrderSerializer(paginated_orders, many=True)
+            serializer = OrderSummarySerializer(paginated_orders, many=True)
             return success_response({
                 "orders": serializer.data,
                 "count": paginator.page.paginator.count,
@@ -103,14 +135,39 @@ class OrderViewSet(viewsets.ViewSet):
 
     def retrieve_order(self, request, pk=None):
         try:
-            order = Order.objects.get(pk=pk, user=request.user)
-            serializer = OrderSerializer(order)
+            try:
+                order = OrderSerializer.setup_eager_loading(
+                    Order.objects.filter(pk=pk, user=request.user)).get()
+                serializer = OrderSerializer(order)
+            except Order.DoesNotExist:
+                # Old closed orders live in the archive under the same id
+                order = ArchivedOrderSerializer.setup_eager_loading(
+                    ArchivedOrder.objects.filter(pk=pk, user=request.user)).get()
+                serializer = ArchivedOrderSerializer(order)
             return success_response(serializer.data, "Order details retrieved successfully")
-        except Order.DoesNotExist:
+        except (Order.DoesNotExist, ArchivedOrder.DoesNotExist):
             return error_response("Order not found", status_code=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return error_response("An error occurred while fetching the order.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def view_confirmation_email(self, request, pk=None):
+        """Serve the stored confirmation email as a page ("view in browser")."""
+        try:
+            html = Order.objects.filter(pk=pk, user=request.user).values_list(
+                'confirmation_email_html', flat=True).first()
+            if html is None:
+                # Old closed orders live in the archive under the same id
+                html = ArchivedOrder.objects.filter(pk=pk, user=request.user).values_list(
+                    'confirmation_email_html', flat=True).get()
+            if not html:
+                return error_response("No confirmation email has been sent for this order.", status_code=status.HTTP_404_NOT_FOUND)
+
+            return HttpResponse(html, content_type='text/html; charset=utf-8')
+        except ArchivedOrder.DoesNotExist:
+            return error_response("Order not found", status_code=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return error_response("An error occurred while fetching the email.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
     def update_order(self, request, pk=None):
         """Update only the shipping address of an order if it's confirmed."""
         try:
@@ -143,25 +200,30 @@ class OrderViewSet(viewsets.ViewSet):
             return error_response("An error occurred while updating the order.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     def cancel_order(self, request, pk=None):
-        """Cancel an order by setting its status to 'cancelled'."""
+        """Cancel a pending or confirmed order."""
         try:
             order = Order.objects.get(pk=pk, user=request.user)
 
-            if order.status != 'confirmed':
-                return error_response("Only confirmed orders can be cancelled.", status_code=status.HTTP_400_BAD_REQUEST)
-
-            # Set the order status to 'cancelled'
-            order.status = 'cancelled'
-            order.save()
+            # Set the order status to 'cancelled' and give back its stock: the
+            # holds of a pending order, the committed units of a confirmed one
+            with transaction.atomic():
+                was_confirmed = order.status == 'confirmed'
+                transition(order, 'cancelled', source='customer')
+                if was_confirmed:
+                    restock_orders([order.pk])
+                else:
+                    release_reservations(order)
 
             return success_response(None, "Order has been cancelled.", status_code=status.HTTP_200_OK)
+        except InvalidTransition:
+            return error_response("Only pending or confirmed orders can be cancelled.", status_code=status.HTTP_400_BAD_REQUEST)
         except Order.DoesNotExist:
             return error_response("Order not found.", status_code=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return error_response("An error occurred while cancelling the order.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     def return_order(self, request, pk=None):
-        """Return an order by setting its status to 'returned'."""
+        """Start the return of a delivered order."""
         try:
             order = Order.objects.get(pk=pk, user=request.user)
 
@@ -171,14 +233,12 @@ class OrderViewSet(viewsets.ViewSet):
             if order.status == 'return_initiated':
                 return error_response("Order return procedure is already initiated.", status_code=status.HTTP_400_BAD_REQUEST)
 
-            # Check if the order has been delivered before allowing a return
-            if order.status != 'delivered':
-                return error_response("Only delivered orders can be returned.", status_code=status.HTTP_400_BAD_REQUEST)
-
-            order.status = 'return_initiated'
-            order.save()
+            transition(order, 'return_initiated', source='customer')
 
             return success_response(None, "Order return procedure initiated successfully", status_code=status.HTTP_200_OK)
+        except InvalidTransition:
+            # Only delivered orders can be returned
+            return error_response("Only delivered orders can be returned.", status_code=status.HTTP_400_BAD_REQUEST)
         except Order.DoesNotExist:
             return error_response("Order not found.", status_code=status.HTTP_404_NOT_FOUND)
         except Exception as e:
@@ -188,6 +248,7 @@ class OrderViewSet(viewsets.ViewSet):
 class PaymentViewSet(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
 
+    @idempotent
     def create_payment(self, request):
         try:
             user = request.user
@@ -212,32 +273,33 @@ class PaymentViewSet(viewsets.ViewSet):
 
             # Handling COD payment
             if payment_method == 'cod':
-                payment = Payment.objects.create(
-                    order=order, method='cod', amount=amount
-                )
-                order.status = 'confirmed'
-                order.save()
-
-                # Decrement stock for each ordered item
-                for item in order.items.all():
-                    item.product.stock = F('stock') - item.quantity
-                    item.product.save()
-
-                # Send confirmation email
-                self.send_order_confirmation_email(user, order, payment)
+                try:
+                    with transaction.atomic():
+                        # The order row is locked before the products, in the
+                        # same order as verify_payment and the reconciler
+                        transition(order, 'confirmed', source='customer')
+
+                        # Turn the stock holds into a real decrement
+                        commit_order_stock(order)
+
+                        payment = Payment.objects.create(
+                            order=order, method='cod', amount=amount
+                        )
+
+                        # Queue confirmation email with the confirmation itself
+                        send_order_confirmation_email(user, order, payment)
+                except InsufficientStock as e:
+                    return error_response("Some items in this order are out of stock.", e.product_ids, status_code=status.HTTP_409_CONFLICT)
+                except InvalidTransition:
+                    return error_response("Order not eligible for payment", status_code=status.HTTP_400_BAD_REQUEST)
 
                 serializer = PaymentSerializer(payment)
                 return success_response(serializer.data, "Payment created successfully", status_code=status.HTTP_201_CREATED)
 
             # Handling Razorpay payment
             elif payment_method == 'razorpay':
-                client = razorpay.Client(
-                    auth=(settings.RAZORPAY_API_KEY, settings.RAZORPAY_API_SECRET))
-                razorpay_order = client.order.create({
-                    'amount': int(amount) * 100,
-                    'currency': 'INR',
-                    'payment_capture': 1
-                })
+                razorpay_order = get_gateway().create_order(
+                    amount, currency='INR', receipt=order.id)
 
                 payment = Payment.objects.create(
                     order=order,
@@ -255,69 +317,13 @@ class PaymentViewSet(viewsets.ViewSet):
 
             return error_response("Invalid payment method", status_code=status.HTTP_400_BAD_REQUEST)
 
+        except GatewayUnavailable as e:
+            return error_response("The payment gateway is unavailable, please try again.", str(e), status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except GatewayError as e:
+            return error_response("The payment gateway rejected the request.", str(e), status_code=status.HTTP_502_BAD_GATEWAY)
         except Exception as e:
             return error_response("An error occurred while creating the payment.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    # Helper function to send order confirmation email
-    def send_order_confirmation_email(self, user, order, payment):
-        items = order.items.all()
-        subject = f"Order Confirmation - Order #{order.id}"
-
-        for item in items:
-            discount = item.product.discount or 0
-            item.discounted_price = round(
-                item.product.price - (item.product.price * discount / 100), 2)
-            item.item_total = round(item.quantity * item.discounted_price, 2)
-
-        print("payment status", payment.status)
-
-        # Prepare HTML content with order and payment details
-        html_content = render_to_string("emails/order_confirmation.html", {
-            "user": user,
-            "order": order,
-            "payment": payment,
-            "items": items,
-            "current_year": timezone.now().year,
-        })
-
-        # Send the email
-        send_mail(
-            subject,
-            "",
-            settings.DEFAULT_FROM_EMAIL,
-            [user.email],
-            html_message=html_content,
-        )
-
-    # Helper function to send order confirmation email
-    def send_order_confirmation_email(self, user, order, payment):
-        items = order.items.all()
-        subject = f"Order Confirmation - Order #{order.id}"
-
-        for item in items:
-            discount = item.product.discount or 0
-            item.discounted_price = round(
-                item.product.price - (item.product.price * discount / 100), 2)
-            item.item_total = round(item.quantity * item.discounted_price, 2)
-
-        # Prepare HTML content with order and payment details
-        html_content = render_to_string("emails/order_confirmation.html", {
-            "user": user,
-            "order": order,
-            "payment": payment,
-            "items": items,
-            "current_year": timezone.now().year,
-        })
-
-        # Send the email
-        send_mail(
-            subject,
-            "",
-            settings.DEFAULT_FROM_EMAIL,
-            [user.email],
-            html_message=html_content,
-        )
-
     def verify_payment(self, request):
         try:
             razorpay_order_id = request.data.get('razorpay_order_id')
@@ -330,27 +336,33 @@ class PaymentViewSet(viewsets.ViewSet):
             except Payment.DoesNotExist:
                 return error_response("Payment not found or unauthorized", status_code=status.HTTP_404_NOT_FOUND)
 
-            client = razorpay.Client(
-                auth=(settings.RAZORPAY_API_KEY, settings.RAZORPAY_API_SECRET))
-
-            try:
-                client.utility.verify_payment_signature({
-                    'razorpay_order_id': razorpay_order_id,
-                    'razorpay_payment_id': razorpay_payment_id,
-                    'razorpay_signature': razorpay_signature,
-                })
-            except razorpay.errors.SignatureVerificationError:
-                payment.status = 'failed'
+            # The signature is an HMAC checked locally, no gateway round trip
+            if not get_gateway().verify_payment_signature(razorpay_order_id, razorpay_payment_id, razorpay_signature):
+                payment.payment_status = 'failed'
                 payment.save()
                 return error_response("Payment signature verification failed", status_code=status.HTTP_400_BAD_REQUEST)
 
             payment.razorpay_payment_id = razorpay_payment_id
             payment.razorpay_signature = razorpay_signature
-            payment.status = 'completed'
+            payment.payment_status = 'completed'
             payment.save()
 
-            payment.order.status = 'confirmed'
-            payment.order.save()
+            # The money is captured at this point, so the payment stays completed
+            # even if the stock can no longer be committed; staff handle the refund.
+            try:
+                with transaction.atomic():
+                    # Locks the order first, so the reconciler can't commit
+                    # its stock at the same time
+                    transition(payment.order, 'confirmed', source='customer')
+                    commit_order_stock(payment.order)
+            except InsufficientStock as e:
+                return error_response("Payment received but some items are out of stock.", e.product_ids, status_code=status.HTTP_409_CONFLICT)
+            except InvalidTransition as e:
+                if e.from_status != 'confirmed':
+                    # Cancelled in the meantime: the payment stays completed
+                    # next to the cancelled order for staff to refund
+                    return error_response("Payment received but the order is no longer pending, it will be refunded.", f"Order is {e.from_status}.", status_code=status.HTTP_409_CONFLICT)
+                # The webhook reconciliation got there first
 
             return success_response(None, "Payment successful", status_code=status.HTTP_200_OK)
         except Exception as e:
@@ -370,3 +382,31 @@ class PaymentViewSet(viewsets.ViewSet):
             return error_response("Order not found or unauthorized", status_code=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return error_response("An error occurred while retrieving payment details.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class PaymentWebhookViewSet(viewsets.ViewSet):
+    # Razorpay authenticates with the signature header, not a user token
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def receive_webhook(self, request):
+        """Store a signed gateway event for reconcile_payments and acknowledge it immediately."""
+        try:
+            body = request.body
+            signature = request.headers.get('X-Razorpay-Signature')
+            if not get_gateway().verify_webhook_signature(body, signature):
+                return error_response("Invalid webhook signature.", status_code=status.HTTP_400_BAD_REQUEST)
+
+            payload = request.data
+            # Redeliveries carry the same event id and are stored only once
+            event_id = request.headers.get(
+                'X-Razorpay-Event-Id') or hashlib.sha256(body).hexdigest()
+            PaymentWebhookEvent.objects.bulk_create([PaymentWebhookEvent(
+                event_id=event_id,
+                event=payload.get('event', ''),
+                payload=payload,
+            )], ignore_conflicts=True)
+
+            return success_response(None, "Webhook received.")
+        except Exception as e:
+            return error_response("An error occurred while receiving the webhook.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
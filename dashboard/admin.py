@@ -1,3 +1,21 @@
 from django.contrib import admin
+from unfold.admin import ModelAdmin
 
-# Register your models here.
+from .models import LowStockReport
+
+
+class LowStockReportAdmin(ModelAdmin):
+    list_display = ('rank', 'product', 'stock', 'daily_demand',
+                    'days_of_cover', 'stockout_date', 'computed_at')
+    list_select_related = ('product',)
+    search_fields = ('product__name',)
+    readonly_fields = list_display
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+admin.site.register(LowStockReport, LowStockReportAdmin)
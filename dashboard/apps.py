@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class DashboardConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "dashboard"
+
+    def ready(self):
+        from checkout.transitions import order_status_changed
+
+        from .cohorts import record_buyers
+        from .rollups import record_transition
+
+        order_status_changed.connect(
+            record_transition, dispatch_uid='dashboard_record_transition')
+        order_status_changed.connect(
+            record_buyers, dispatch_uid='dashboard_record_buyers')
@@ -0,0 +1,150 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from checkout.archive import archived_totals
+from checkout.models import Order
+from products.models import Category, Product
+
+from .cohorts import (BUYERS, RETURNING, distinct_count, load_sketches,
+                      repeat_rate)
+from .models import DailySalesStats
+
+# KPI cards in display order. Each one compares the last 7 days with the 7
+# before and shows an all-time total, computed with a single aggregate().
+CARDS = []
+
+
+def card(func):
+    CARDS.append(func)
+    return func
+
+
+def calculate_increment(current_count, previous_count):
+    if previous_count == 0:
+        return 100.0 if current_count > 0 else 0.0  # Handle division by zero
+    return float((current_count - previous_count) / previous_count) * 100
+
+
+def make_card(title, current, previous, total, total_label):
+    return {
+        'title': title,
+        'value': current,
+        'increment': round(calculate_increment(current, previous), 2),
+        'total_label': total_label,
+        'total_value': total,
+    }
+
+
+def window_counts(queryset, field, now):
+    """Rows of `queryset` with `field` in the last 7 days, the 7 before, and overall."""
+    last_7_days = now - timedelta(days=7)
+    previous_7_days = now - timedelta(days=14)
+    return queryset.aggregate(
+        current=Count('pk', filter=Q(**{f'{field}__gte': last_7_days})),
+        previous=Count('pk', filter=Q(**{f'{field}__gte': previous_7_days,
+                                         f'{field}__lt': last_7_days})),
+        total=Count('pk'),
+    )
+
+
+def rollup_windows(now):
+    # Rollup rows are keyed by local calendar day, today being the 7th day
+    today = timezone.localdate(now)
+    current = Q(date__gt=today - timedelta(days=7))
+    previous = Q(date__gt=today - timedelta(days=14),
+                 date__lte=today - timedelta(days=7))
+    return current, previous
+
+
+@card
+def orders_card(now):
+    counts = window_counts(Order.objects.all(), 'created_at', now)
+    # Archived orders come from their pre-aggregated monthly totals
+    total = counts['total'] + archived_totals()['orders']
+    return make_card('New Orders', counts['current'], counts['previous'], total, 'Total Orders')
+
+
+@card
+def returns_card(now):
+    current, previous = rollup_windows(now)
+    counts = DailySalesStats.objects.filter(status='return_initiated').aggregate(
+        current=Sum('orders', filter=current, default=0),
+        previous=Sum('orders', filter=previous, default=0),
+        total=Sum('orders', default=0),
+    )
+    return make_card('Returns', counts['current'], counts['previous'], counts['total'], 'Total Returns')
+
+
+@card
+def average_order_value_card(now):
+    current, previous = rollup_windows(now)
+    sums = DailySalesStats.objects.filter(status='delivered').aggregate(
+        current_revenue=Sum('revenue', filter=current, default=0),
+        current_orders=Sum('orders', filter=current, default=0),
+        previous_revenue=Sum('revenue', filter=previous, default=0),
+        previous_orders=Sum('orders', filter=previous, default=0),
+        total_revenue=Sum('revenue', default=0),
+        total_orders=Sum('orders', default=0),
+    )
+
+    def average(revenue, orders):
+        return (Decimal(revenue) / orders).quantize(Decimal('0.01')) if orders else Decimal('0.00')
+
+    return make_card(
+        'Average Order Value',
+        average(sums['current_revenue'], sums['current_orders']),
+        average(sums['previous_revenue'], sums['previous_orders']),
+        average(sums['total_revenue'], sums['total_orders']),
+        'All time',
+    )
+
+
+def sketch_windows(now):
+    # The same day ranges as rollup_windows, plus the last 30 days
+    today = timezone.localdate(now)
+    return ((today - timedelta(days=6), today),
+            (today - timedelta(days=13), today - timedelta(days=7)),
+            (today - timedelta(days=29), today))
+
+
+@card
+def active_buyers_card(now):
+    # Distinct buyers are estimated from the daily HyperLogLog sketches
+    windows = sketch_windows(now)
+    sketches = load_sketches([BUYERS], windows[-1][0])
+    current, previous, total = (distinct_count(
+        sketches, BUYERS, start, end) for start, end in windows)
+    return make_card('Active Buyers', current, previous, total, 'Last 30 days')
+
+
+@card
+def repeat_purchase_card(now):
+    windows = sketch_windows(now)
+    sketches = load_sketches([BUYERS, RETURNING], windows[-1][0])
+    current, previous, total = (repeat_rate(sketches, start, end)
+                                for start, end in windows)
+    return make_card('Repeat Purchase Rate (%)', current, previous, total, 'Last 30 days')
+
+
+@card
+def customers_card(now):
+    # Staff accounts are not customers
+    counts = window_counts(User.objects.filter(
+        is_staff=False), 'date_joined', now)
+    return make_card('New Customers', counts['current'], counts['previous'], counts['total'], 'Total Customers')
+
+
+@card
+def products_card(now):
+    counts = window_counts(Product.objects.all(), 'created_at', now)
+    return make_card('New Products', counts['current'], counts['previous'], counts['total'], 'Total Products')
+
+
+@card
+def categories_card(now):
+    counts = window_counts(Category.objects.all(), 'created_at', now)
+    return make_card('New Categories', counts['current'], counts['previous'], counts['total'], 'Total Categories')
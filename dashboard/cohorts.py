@@ -0,0 +1,175 @@
+import heapq
+from collections import defaultdict
+from datetime import timedelta
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from checkout.models import ArchivedOrder, Order
+
+from .hll import HyperLogLog
+from .models import BuyerSketch
+from .series import add_months
+
+BUYERS = 'buyers'
+RETURNING = 'returning'
+
+
+def cohort_key(date_joined):
+    return f"cohort:{timezone.localtime(date_joined):%Y-%m}"
+
+
+def add_to_sketches(date, users_by_key):
+    """Add users to the (date, key) sketches, creating the rows if needed."""
+    keys = sorted(users_by_key)
+    with transaction.atomic():
+        BuyerSketch.objects.bulk_create([
+            BuyerSketch(date=date, key=key, sketch=HyperLogLog().to_bytes())
+            for key in keys
+        ], ignore_conflicts=True)
+        # Locked so concurrent orders can't overwrite each other's registers,
+        # always in key order so two of them can't deadlock
+        rows = list(BuyerSketch.objects.select_for_update().filter(
+            date=date, key__in=keys).order_by('key'))
+        for row in rows:
+            sketch = HyperLogLog.from_bytes(row.sketch)
+            for user_id in users_by_key[row.key]:
+                sketch.add(user_id)
+            row.sketch = sketch.to_bytes()
+        BuyerSketch.objects.bulk_update(rows, ['sketch'])
+
+
+def record_buyers(order_ids, status, at, **kwargs):
+    """
+    Connected to checkout.transitions.order_status_changed next to the sales
+    rollups. Like them, the sketches are only updated once the new orders
+    have committed, so checkouts never queue on the day's shared rows inside
+    their own transaction. If that update fails, backfill_sales_stats
+    rebuilds the day.
+    """
+    if status != 'pending' or not order_ids:
+        return
+    transaction.on_commit(partial(add_buyers, list(order_ids), at), robust=True)
+
+
+def add_buyers(order_ids, at):
+    """Add the users behind newly created orders to the day's sketches."""
+    buyers = dict(Order.objects.filter(pk__in=order_ids).values_list(
+        'user_id', 'user__date_joined'))
+    returning = set(
+        Order.objects.filter(user_id__in=buyers).exclude(pk__in=order_ids)
+        .values_list('user_id', flat=True).distinct()
+    ) | set(
+        ArchivedOrder.objects.filter(user_id__in=buyers)
+        .values_list('user_id', flat=True).distinct()
+    )
+
+    users_by_key = defaultdict(set)
+    for user_id, date_joined in buyers.items():
+        users_by_key[BUYERS].add(user_id)
+        users_by_key[cohort_key(date_joined)].add(user_id)
+        if user_id in returning:
+            users_by_key[RETURNING].add(user_id)
+    add_to_sketches(timezone.localdate(at), users_by_key)
+
+
+def rebuild_sketches(start=None):
+    """
+    Recompute the sketches from live and archived orders, for every day from
+    `start` (an aware datetime at local midnight) on, or for all history.
+    """
+    fields = ('created_at', 'user_id', 'user__date_joined')
+    orders = Order.objects.order_by('created_at').values_list(*fields)
+    archived = ArchivedOrder.objects.order_by('created_at').values_list(*fields)
+    # Users who ordered before `start` are returning from their first order on
+    seen = set()
+    if start:
+        seen = set(Order.objects.filter(created_at__lt=start).values_list('user_id', flat=True)) | \
+            set(ArchivedOrder.objects.filter(
+                created_at__lt=start).values_list('user_id', flat=True))
+        orders = orders.filter(created_at__gte=start)
+        archived = archived.filter(created_at__gte=start)
+
+    sketches = defaultdict(HyperLogLog)
+    for created_at, user_id, date_joined in heapq.merge(
+            orders.iterator(chunk_size=2000), archived.iterator(chunk_size=2000)):
+        date = timezone.localdate(created_at)
+        sketches[date, BUYERS].add(user_id)
+        sketches[date, cohort_key(date_joined)].add(user_id)
+        if user_id in seen:
+            sketches[date, RETURNING].add(user_id)
+        seen.add(user_id)
+
+    with transaction.atomic():
+        rows = BuyerSketch.objects.all()
+        if start:
+            rows = rows.filter(date__gte=timezone.localdate(start))
+        rows.delete()
+        BuyerSketch.objects.bulk_create([
+            BuyerSketch(date=date, key=key, sketch=sketch.to_bytes())
+            for (date, key), sketch in sketches.items()
+        ], batch_size=1000)
+
+
+def load_sketches(keys, start, end=None):
+    """{(date, key): sketch} for the days from `start` to `end`, in one query."""
+    rows = BuyerSketch.objects.filter(key__in=keys, date__gte=start)
+    if end:
+        rows = rows.filter(date__lte=end)
+    return {
+        (date, key): HyperLogLog.from_bytes(sketch)
+        for date, key, sketch in rows.values_list('date', 'key', 'sketch')
+    }
+
+
+def distinct_count(sketches, key, start, end):
+    """Distinct users under `key` from `start` to `end`, merging the daily sketches."""
+    return HyperLogLog.union(
+        sketch for (date, sketch_key), sketch in sketches.items()
+        if sketch_key == key and start <= date <= end
+    ).count()
+
+
+def repeat_rate(sketches, start, end):
+    """Percentage of the buyers from `start` to `end` who had ordered before."""
+    buyers = distinct_count(sketches, BUYERS, start, end)
+    if not buyers:
+        return 0.0
+    return round(100 * min(distinct_count(sketches, RETURNING, start, end), buyers) / buyers, 1)
+
+
+def cohort_retention(now, months):
+    """
+    Signup cohorts of the last `months` calendar months: how many customers
+    signed up (exact) and how many of them ordered in each month since
+    (estimated from the cohort sketches).
+    """
+    today = timezone.localdate(now)
+    starts = [add_months(today, -back) for back in range(months - 1, -1, -1)]
+    ends = [start - timedelta(days=1) for start in starts[1:]] + [today]
+
+    sizes = {
+        timezone.localdate(row['month']): row['customers']
+        for row in User.objects.filter(is_staff=False, date_joined__date__gte=starts[0])
+        .annotate(month=TruncMonth('date_joined'))
+        .values('month').annotate(customers=Count('id'))
+    }
+    sketches = load_sketches(
+        [f"cohort:{start:%Y-%m}" for start in starts], starts[0])
+
+    cohorts = []
+    for i, start in enumerate(starts):
+        size = sizes.get(start, 0)
+        active = []
+        for month, end in zip(starts[i:], ends[i:]):
+            buyers = distinct_count(sketches, f"cohort:{start:%Y-%m}", month, end)
+            active.append({
+                'buyers': buyers,
+                'percent': round(100 * min(buyers, size) / size, 1) if size else 0.0,
+            })
+        cohorts.append({'label': start.strftime('%b %Y'), 'size': size, 'active': active})
+    return cohorts
@@ -0,0 +1,141 @@
+from datetime import timedelta
+from itertools import chain
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from products.models import Product
+
+from .models import LowStockReport, ProductDailySales, ProductMonthlySales
+from .series import add_months
+
+STOCK_DTYPE = np.dtype([('product', np.int64), ('stock', np.int64)])
+
+
+def load_stock():
+    """(product ids sorted ascending, stock) for the whole catalog."""
+    rows = Product.objects.order_by('id').values_list('id', 'stock')
+    catalog = np.fromiter(rows.iterator(chunk_size=10000), dtype=STOCK_DTYPE)
+    return catalog['product'], catalog['stock']
+
+
+def read_sales(product_ids, rows, width):
+    """
+    Read (product id, value, ...) rows into an int64 matrix, returning the
+    index of each row's product in product_ids and the row values.
+    """
+    sales = np.fromiter(
+        chain.from_iterable(rows.iterator(chunk_size=10000)), dtype=np.int64,
+    ).reshape(-1, width)
+    index = np.searchsorted(product_ids, sales[:, 0])
+    # Products created after the catalog was read have no row
+    known = index < len(product_ids)
+    known[known] = product_ids[index[known]] == sales[known, 0]
+    return index[known], sales[known, 1:]
+
+
+def load_window_units(product_ids, start, days, short_days):
+    """
+    Delivered units per product over the `days` days from `start` and over
+    the last `short_days` of them, entry i being product_ids[i]. Products
+    without a rollup row in the window sold 0.
+    """
+    total = np.zeros(len(product_ids), dtype=np.int64)
+    recent = np.zeros(len(product_ids), dtype=np.int64)
+    if not len(product_ids):
+        return total, recent
+    end = start + timedelta(days=days)
+    recent_start = end - timedelta(days=short_days)
+    # Whole months inside the window come from the monthly rollup, so only
+    # the days around them are read one row per product and day
+    first_month = start if start.day == 1 else add_months(start, 1)
+    last_month = end.replace(day=1)
+    if first_month >= last_month:
+        first_month = last_month = end
+
+    daily = (
+        ProductDailySales.objects.filter(
+            Q(date__gte=start, date__lt=first_month)
+            | Q(date__gte=min(last_month, recent_start), date__lt=end))
+        .values('product_id')
+        .annotate(total=Sum('units', filter=Q(date__lt=first_month) | Q(date__gte=last_month),
+                            default=0),
+                  recent=Sum('units', filter=Q(date__gte=recent_start), default=0))
+        .order_by('product_id')
+        .values_list('product_id', 'total', 'recent')
+    )
+    index, sales = read_sales(product_ids, daily, 3)
+    total[index] = sales[:, 0]
+    recent[index] = sales[:, 1]
+
+    if first_month < last_month:
+        monthly = (
+            ProductMonthlySales.objects.filter(month__gte=first_month, month__lt=last_month)
+            .values('product_id')
+            .annotate(total=Sum('units'))
+            .order_by('product_id')
+            .values_list('product_id', 'total')
+        )
+        index, sales = read_sales(product_ids, monthly, 2)
+        total[index] += sales[:, 0]
+    return total, recent
+
+
+def forecast(total, recent, stock, days, short_days):
+    """
+    Daily demand and days of cover per product. Demand is the higher of the
+    moving average over the whole window and over the last `short_days`
+    days, so a recent surge is not averaged away.
+    """
+    demand = np.maximum(total / days, recent / short_days)
+    cover = np.full(len(stock), np.inf)
+    np.divide(stock, demand, out=cover, where=demand > 0)
+    # Out of stock (or oversold) is no cover at all, whatever the demand
+    cover[stock <= 0] = 0
+    return demand, cover
+
+
+def rank_low_stock(demand, cover, threshold, limit):
+    """Row indexes with less than `threshold` days of cover, soonest first, busiest first on ties."""
+    low = np.flatnonzero(cover < threshold)
+    order = np.lexsort((-demand[low], cover[low]))
+    return low[order][:limit]
+
+
+def publish_report(product_ids, stock, demand, cover, ranked, now):
+    today = timezone.localdate(now)
+    reports = [
+        LowStockReport(
+            rank=rank,
+            product_id=int(product_ids[i]),
+            stock=int(stock[i]),
+            daily_demand=round(float(demand[i]), 2),
+            days_of_cover=round(float(cover[i]), 1),
+            stockout_date=today + timedelta(days=int(cover[i])),
+            computed_at=now,
+        )
+        for rank, i in enumerate(ranked, start=1)
+    ]
+    # Readers see either the previous report or the new one, never a mix
+    with transaction.atomic():
+        LowStockReport.objects.all().delete()
+        LowStockReport.objects.bulk_create(reports, batch_size=1000)
+    return reports
+
+
+def forecast_stock(window=28, short_window=7, threshold=14, limit=500, now=None):
+    """
+    Forecast demand from the last `window` complete days of sales and publish
+    the products with less than `threshold` days of stock left.
+    """
+    now = now or timezone.now()
+    start = timezone.localdate(now) - timedelta(days=window)
+
+    product_ids, stock = load_stock()
+    short_window = min(short_window, window)
+    total, recent = load_window_units(product_ids, start, window, short_window)
+    demand, cover = forecast(total, recent, stock, window, short_window)
+    ranked = rank_low_stock(demand, cover, threshold, limit)
+    return publish_report(product_ids, stock, demand, cover, ranked, now), len(product_ids)
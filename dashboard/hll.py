@@ -0,0 +1,92 @@
+# HyperLogLog sketches for approximate distinct counts.
+#
+# A sketch has 2**PRECISION one-byte registers. Adding a value keeps, in the
+# register picked by its hash, the longest run of leading zeros seen, so the
+# sketch of a union is the register-wise max of the sketches: merging is
+# lossless and weekly or monthly counts can be built from daily sketches.
+#
+# Error bounds with PRECISION = 12 (4096 registers):
+#
+# - The relative standard error is 1.04 / sqrt(4096) ~= 1.6%, so about 95% of
+#   estimates are within 3.3% of the exact count and nearly all within 5%.
+# - Below 2.5 * 4096 = 10240 distinct values the estimate switches to linear
+#   counting, which is within a few values of exact for counts in the hundreds.
+# - A merged sketch has the same bound as a sketch built directly from the
+#   union. A ratio of two estimates (e.g. a repeat-purchase rate) carries both
+#   errors, roughly 2.3% relative.
+import hashlib
+import math
+
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+HASH_BITS = 64
+
+# Stored sketches start with their format. Sparse ones, for the many days and
+# cohorts with few buyers, keep (index, rank) pairs of the non-empty
+# registers in 3 bytes each instead of all 4096 registers.
+SPARSE = 0
+DENSE = 1
+
+_POWERS = [2.0 ** -rank for rank in range(HASH_BITS - PRECISION + 2)]
+
+
+def _hash(value):
+    return int.from_bytes(
+        hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers or REGISTERS)
+
+    def add(self, value):
+        hashed = _hash(value)
+        index = hashed >> (HASH_BITS - PRECISION)
+        rest = hashed & ((1 << (HASH_BITS - PRECISION)) - 1)
+        rank = HASH_BITS - PRECISION - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """Merge `other` into this sketch, which then counts the union of both."""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    @classmethod
+    def union(cls, sketches):
+        merged = cls()
+        for sketch in sketches:
+            merged.update(sketch)
+        return merged
+
+    def count(self):
+        zeros = self.registers.count(0)
+        if zeros == REGISTERS:
+            return 0
+        estimate = ALPHA * REGISTERS * REGISTERS / \
+            sum(_POWERS[rank] for rank in self.registers)
+        if estimate <= 2.5 * REGISTERS and zeros:
+            # Small range correction (linear counting)
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+        return round(estimate)
+
+    def to_bytes(self):
+        filled = [(index, rank)
+                  for index, rank in enumerate(self.registers) if rank]
+        if 3 * len(filled) >= REGISTERS:
+            return bytes([DENSE]) + bytes(self.registers)
+        data = bytearray([SPARSE])
+        for index, rank in filled:
+            data += index.to_bytes(2, 'big') + bytes([rank])
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        if data[0] == DENSE:
+            return cls(data[1:])
+        sketch = cls()
+        for offset in range(1, len(data), 3):
+            index = int.from_bytes(data[offset:offset + 2], 'big')
+            sketch.registers[index] = data[offset + 2]
+        return sketch
@@ -0,0 +1,36 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from dashboard.cohorts import rebuild_sketches
+from dashboard.models import (BuyerSketch, DailySalesStats, ProductDailySales,
+                              ProductMonthlySales)
+from dashboard.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily sales rollups and buyer sketches from the order history."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from',
+                            help="Only rebuild days from this date on (YYYY-MM-DD); default is all history.")
+
+    def handle(self, *args, **options):
+        start = None
+        if options['date_from']:
+            day = parse_date(options['date_from'])
+            if day is None:
+                raise CommandError(
+                    f"'{options['date_from']}' is not a date (YYYY-MM-DD).")
+            start = timezone.make_aware(datetime.combine(day, time.min))
+
+        rebuild_rollups(start)
+        rebuild_sketches(start)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {DailySalesStats.objects.count()} daily, "
+            f"{ProductDailySales.objects.count()} product daily, "
+            f"{ProductMonthlySales.objects.count()} product monthly and "
+            f"{BuyerSketch.objects.count()} buyer sketch rows."))
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Forecast demand for the whole catalog and publish the low-stock report shown in the admin."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=28,
+                            help="Days of delivered sales the moving average covers (default: 28).")
+        parser.add_argument('--short-window', type=int, default=7,
+                            help="Recent days averaged separately so surges are not smoothed away (default: 7).")
+        parser.add_argument('--threshold', type=float, default=14,
+                            help="Report products with fewer days of cover than this (default: 14).")
+        parser.add_argument('--limit', type=int, default=500,
+                            help="Maximum number of products in the report (default: 500).")
+
+    def handle(self, *args, **options):
+        try:
+            from dashboard.forecast import forecast_stock
+        except ImportError:
+            raise CommandError(
+                "forecast_stock needs NumPy; install it with "
+                "'pip install -r requirements-forecast.txt'.")
+
+        for name in ('window', 'short_window', 'limit'):
+            if options[name] < 1:
+                raise CommandError(
+                    f"--{name.replace('_', '-')} must be at least 1.")
+
+        started = time.monotonic()
+        reports, products = forecast_stock(
+            window=options['window'],
+            short_window=options['short_window'],
+            threshold=options['threshold'],
+            limit=options['limit'],
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Forecast {products} products over {options['window']} days in "
+            f"{time.monotonic() - started:.2f}s; {len(reports)} below "
+            f"{options['threshold']:g} days of cover."))
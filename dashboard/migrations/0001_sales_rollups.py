@@ -0,0 +1,98 @@
+# Generated by Django 5.0 on 2026-10-19 18:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ("products", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailySalesStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("confirmed", "Confirmed"),
+                            ("delivered", "Delivered"),
+                            ("cancelled", "Cancelled"),
+                            ("return_initiated", "Return Initiated"),
+                            ("returned", "Returned"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("orders", models.PositiveIntegerField(default=0)),
+                (
+                    "revenue",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                ("units", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "verbose_name_plural": "daily sales stats",
+            },
+        ),
+        migrations.CreateModel(
+            name="ProductDailySales",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("units", models.PositiveIntegerField(default=0)),
+                (
+                    "revenue",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "product daily sales",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="dailysalesstats",
+            constraint=models.UniqueConstraint(
+                fields=("date", "status"), name="unique_daily_sales_stats"
+            ),
+        ),
+        migrations.AddField(
+            model_name="productdailysales",
+            name="product",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="daily_sales",
+                to="products.product",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="productdailysales",
+            constraint=models.UniqueConstraint(
+                fields=("date", "product"), name="unique_product_daily_sales"
+            ),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.0 on 2026-10-19 18:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dashboard", "0002_low_stock_report"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BuyerSketch",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("key", models.CharField(max_length=20)),
+                ("sketch", models.BinaryField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="buyersketch",
+            constraint=models.UniqueConstraint(
+                fields=("date", "key"), name="unique_buyer_sketch"
+            ),
+        ),
+    ]
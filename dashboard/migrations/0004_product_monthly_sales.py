@@ -0,0 +1,71 @@
+# Generated by Django 5.0 on 2026-10-19 20:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+
+
+def fill_monthly_sales(apps, schema_editor):
+    # Sum the existing daily rows, later deliveries update both tables
+    ProductDailySales = apps.get_model('dashboard', 'ProductDailySales')
+    ProductMonthlySales = apps.get_model('dashboard', 'ProductMonthlySales')
+
+    rows = []
+    for row in (ProductDailySales.objects.values('product_id', month=TruncMonth('date'))
+                .annotate(units=Sum('units'), revenue=Sum('revenue'))
+                .iterator(chunk_size=2000)):
+        rows.append(ProductMonthlySales(**row))
+        if len(rows) >= 2000:
+            ProductMonthlySales.objects.bulk_create(rows)
+            rows = []
+    ProductMonthlySales.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dashboard", "0003_buyer_sketches"),
+        ("products", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProductMonthlySales",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("month", models.DateField()),
+                ("units", models.PositiveIntegerField(default=0)),
+                (
+                    "revenue",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="monthly_sales",
+                        to="products.product",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "product monthly sales",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="productmonthlysales",
+            constraint=models.UniqueConstraint(
+                fields=("month", "product"), name="unique_product_monthly_sales"
+            ),
+        ),
+        migrations.RunPython(fill_monthly_sales, migrations.RunPython.noop),
+    ]
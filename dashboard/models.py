@@ -1,3 +1,102 @@
 from django.db import models
 
-# Create your models here.
+from checkout.models import Order
+
+
+# Pre-aggregated sales kept up to date by dashboard.rollups as orders change
+# status, so the dashboard reads a few hundred rows instead of the order history
+class DailySalesStats(models.Model):
+    # Calendar day in TIME_ZONE on which the orders moved into `status`
+    date = models.DateField()
+    status = models.CharField(
+        max_length=20, choices=Order.ORDER_STATUS_CHOICES)
+    orders = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'daily sales stats'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'status'], name='unique_daily_sales_stats'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.status}: {self.orders} orders"
+
+
+class ProductDailySales(models.Model):
+    # Delivered units and revenue per product and day
+    date = models.DateField()
+    product = models.ForeignKey(
+        'products.Product', related_name='daily_sales', on_delete=models.CASCADE)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'product daily sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'product'], name='unique_product_daily_sales'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.product_id}: {self.units} units"
+
+
+class ProductMonthlySales(models.Model):
+    # The product daily sales summed per calendar month, so long forecast
+    # windows read one row per product and month
+    month = models.DateField()
+    product = models.ForeignKey(
+        'products.Product', related_name='monthly_sales', on_delete=models.CASCADE)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'product monthly sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['month', 'product'], name='unique_product_monthly_sales'),
+        ]
+
+    def __str__(self):
+        return f"{self.month:%Y-%m} {self.product_id}: {self.units} units"
+
+
+class LowStockReport(models.Model):
+    # Products running out soonest, published by the forecast_stock command.
+    # The whole table is replaced on every run.
+    rank = models.PositiveIntegerField()
+    product = models.ForeignKey(
+        'products.Product', related_name='low_stock_reports', on_delete=models.CASCADE)
+    stock = models.IntegerField()
+    # Forecast units sold per day and how many days the stock lasts at that rate
+    daily_demand = models.FloatField()
+    days_of_cover = models.FloatField()
+    stockout_date = models.DateField()
+    computed_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['rank']
+
+    def __str__(self):
+        return f"#{self.rank} {self.product_id}: {self.days_of_cover:.1f} days"
+
+
+class BuyerSketch(models.Model):
+    # HyperLogLog sketch (dashboard.hll) of the users who placed orders on a
+    # day. `key` is 'buyers' for everyone, 'returning' for users who had
+    # ordered before and 'cohort:YYYY-MM' for users who signed up that month.
+    date = models.DateField()
+    key = models.CharField(max_length=20)
+    sketch = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'key'], name='unique_buyer_sketch'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.key}"
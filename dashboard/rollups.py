@@ -0,0 +1,146 @@
+from collections import defaultdict
+from functools import partial
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate, TruncMonth
+from django.utils import timezone
+
+from checkout.models import (ArchivedOrderStatusEvent, Order, OrderItem,
+                             OrderStatusEvent)
+from checkout.pricing import order_item_total
+
+from .models import DailySalesStats, ProductDailySales, ProductMonthlySales
+
+# Product rollups only count sales, i.e. deliveries
+PRODUCT_SALES_STATUS = 'delivered'
+
+
+def increment(model, lookup, values):
+    """Add `values` to the row matching `lookup`, creating it if needed."""
+    changes = {field: F(field) + value for field, value in values.items()}
+    if model.objects.filter(**lookup).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **values)
+    except IntegrityError:
+        # Another transaction created the row first
+        model.objects.filter(**lookup).update(**changes)
+
+
+def record_transition(order_ids, status, at, **kwargs):
+    """
+    Connected to checkout.transitions.order_status_changed. The rollups are
+    only updated once the status change has committed, so checkouts never
+    queue on the shared (day, status) row inside their own transaction. If
+    that update fails, backfill_sales_stats recomputes the day.
+    """
+    if not order_ids:
+        return
+    transaction.on_commit(
+        partial(add_to_rollups, list(order_ids), status, at), robust=True)
+
+
+def add_to_rollups(order_ids, status, at):
+    """Fold orders that moved into `status` at `at` into the rollups, in one short transaction."""
+    date = timezone.localdate(at)
+    totals = Order.objects.filter(pk__in=order_ids).aggregate(
+        orders=Count('id'), revenue=Sum('total_price'))
+    units = OrderItem.objects.filter(order_id__in=order_ids).aggregate(
+        units=Sum('quantity'))['units']
+    products = []
+    if status == PRODUCT_SALES_STATUS:
+        products = list(
+            OrderItem.objects.filter(order_id__in=order_ids)
+            .values('product_id')
+            .annotate(units=Sum('quantity'), revenue=Sum(order_item_total()))
+            .order_by('product_id')
+        )
+
+    # Only the increments hold row locks, always in the same order
+    with transaction.atomic():
+        increment(DailySalesStats, {'date': date, 'status': status}, {
+            'orders': totals['orders'],
+            'revenue': totals['revenue'] or 0,
+            'units': units or 0,
+        })
+        for row in products:
+            sales = {'units': row['units'], 'revenue': row['revenue'] or 0}
+            increment(ProductDailySales, {'date': date, 'product_id': row['product_id']}, sales)
+            increment(ProductMonthlySales, {'month': date.replace(day=1),
+                                            'product_id': row['product_id']}, sales)
+
+
+def rebuild_rollups(start=None):
+    """
+    Recompute the rollups from the live and archived order status logs, for
+    every day from `start` (an aware datetime at local midnight) on, or for
+    all history.
+    """
+    tz = timezone.get_current_timezone()
+    day = TruncDate('at', tzinfo=tz)
+    # Archived orders keep their status log and items under the same names
+    stats = defaultdict(lambda: {'orders': 0, 'revenue': 0, 'units': 0})
+    product_sales = defaultdict(lambda: {'units': 0, 'revenue': 0})
+
+    with transaction.atomic():
+        for events in (OrderStatusEvent.objects.all(), ArchivedOrderStatusEvent.objects.all()):
+            if start:
+                events = events.filter(at__gte=start)
+            # Units are summed separately, joining the items would repeat each order's total
+            for row in events.values('status', day=day).annotate(
+                    orders=Count('id'), revenue=Sum('order__total_price')):
+                totals = stats[row['day'], row['status']]
+                totals['orders'] += row['orders']
+                totals['revenue'] += row['revenue'] or 0
+            for row in events.values('status', day=day).annotate(units=Sum('order__items__quantity')):
+                stats[row['day'], row['status']]['units'] += row['units'] or 0
+            for row in (events.filter(status=PRODUCT_SALES_STATUS, order__items__isnull=False)
+                        .values(day=day, product_id=F('order__items__product_id'))
+                        .annotate(units=Sum('order__items__quantity'),
+                                  revenue=Sum(order_item_total('order__items__')))):
+                totals = product_sales[row['day'], row['product_id']]
+                totals['units'] += row['units']
+                totals['revenue'] += row['revenue'] or 0
+
+        old_stats = DailySalesStats.objects.all()
+        old_product_sales = ProductDailySales.objects.all()
+        if start:
+            old_stats = old_stats.filter(date__gte=timezone.localdate(start))
+            old_product_sales = old_product_sales.filter(
+                date__gte=timezone.localdate(start))
+        old_stats.delete()
+        old_product_sales.delete()
+
+        DailySalesStats.objects.bulk_create([
+            DailySalesStats(date=date, status=status, **totals)
+            for (date, status), totals in stats.items()
+        ], batch_size=1000)
+        ProductDailySales.objects.bulk_create([
+            ProductDailySales(date=date, product_id=product_id, **totals)
+            for (date, product_id), totals in product_sales.items()
+        ], batch_size=1000)
+        rebuild_monthly_sales(start and timezone.localdate(start))
+
+
+def rebuild_monthly_sales(start=None):
+    """
+    Recompute the product monthly sales from the daily ones, for the month
+    holding `start` (a date) on, or for all history.
+    """
+    days = ProductDailySales.objects.all()
+    months = ProductMonthlySales.objects.all()
+    if start:
+        # The whole first month, its days before `start` included
+        days = days.filter(date__gte=start.replace(day=1))
+        months = months.filter(month__gte=start.replace(day=1))
+
+    with transaction.atomic():
+        months.delete()
+        ProductMonthlySales.objects.bulk_create([
+            ProductMonthlySales(month=row['month'], product_id=row['product_id'],
+                                units=row['units'], revenue=row['revenue'])
+            for row in days.values('product_id', month=TruncMonth('date'))
+            .annotate(units=Sum('units'), revenue=Sum('revenue'))
+        ], batch_size=1000)
@@ -0,0 +1,220 @@
+import math
+import re
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncHour, TruncMonth, TruncWeek
+from django.utils import timezone
+
+from checkout.models import OrderStatusEvent
+
+from .models import DailySalesStats
+
+# metric: (status, DailySalesStats field)
+METRICS = {
+    'orders': ('pending', 'orders'),
+    'confirmed': ('confirmed', 'orders'),
+    'delivered': ('delivered', 'orders'),
+    'cancelled': ('cancelled', 'orders'),
+    'returns': ('return_initiated', 'orders'),
+    'revenue': ('delivered', 'revenue'),
+    'units': ('delivered', 'units'),
+}
+
+# The same aggregates over the status log, for buckets finer than the daily rollup
+EVENT_AGGREGATES = {
+    'orders': lambda: Count('id'),
+    'revenue': lambda: Sum('order__total_price'),
+    'units': lambda: Sum('order__items__quantity'),
+}
+
+GRANULARITIES = ('hour', 'day', 'week', 'month')
+ROLLUP_TRUNCS = {'week': TruncWeek, 'month': TruncMonth}
+
+RANGE_PATTERN = re.compile(r'^(\d+)([hdwmy])$')
+# Hourly buckets scan the status log instead of the rollup, so keep them short
+MAX_HOUR_RANGE = timedelta(days=31)
+MAX_RANGE = timedelta(days=10 * 366)
+
+LABEL_FORMATS = {'hour': '%b %d %H:00', 'day': '%b %d', 'week': '%b %d', 'month': '%b %Y'}
+
+
+class SeriesError(ValueError):
+    pass
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return day.replace(year=day.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def floor_bucket(moment, granularity):
+    """Start of the bucket holding `moment` (a local datetime for hours, a date otherwise)."""
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'week':
+        return moment - timedelta(days=moment.weekday())
+    if granularity == 'month':
+        return moment.replace(day=1)
+    return moment
+
+
+def next_bucket(bucket, granularity):
+    if granularity == 'hour':
+        # Step in UTC so DST changes don't repeat or skip an hour
+        return timezone.localtime(bucket + timedelta(hours=1))
+    if granularity == 'week':
+        return bucket + timedelta(days=7)
+    if granularity == 'month':
+        return add_months(bucket, 1)
+    return bucket + timedelta(days=1)
+
+
+def range_start(range_value, now):
+    """
+    Local start of a range like "24h", "30d", "12w", "6m" or "1y". The range
+    covers that many whole hours, days, weeks or months, the current one
+    included.
+    """
+    match = RANGE_PATTERN.match(range_value or '')
+    if not match or int(match.group(1)) < 1:
+        raise SeriesError(
+            "range must be a count followed by h, d, w, m or y, e.g. 30d.")
+    count, unit = int(match.group(1)), match.group(2)
+
+    if unit == 'h':
+        return floor_bucket(timezone.localtime(now), 'hour') - timedelta(hours=count - 1)
+    today = timezone.localdate(now)
+    if unit == 'd':
+        return today - timedelta(days=count - 1)
+    if unit == 'w':
+        return floor_bucket(today, 'week') - timedelta(weeks=count - 1)
+    months = count if unit == 'm' else 12 * count
+    return add_months(today, 1 - months)
+
+
+def as_datetime(start):
+    if isinstance(start, datetime):
+        return start
+    return timezone.make_aware(datetime.combine(start, datetime.min.time()))
+
+
+def get_buckets(start, now, granularity):
+    if granularity == 'hour':
+        start = as_datetime(start)
+        last = floor_bucket(timezone.localtime(now), 'hour')
+    else:
+        if isinstance(start, datetime):
+            start = start.date()
+        last = floor_bucket(timezone.localdate(now), granularity)
+
+    bucket = floor_bucket(start, granularity)
+    buckets = []
+    while bucket <= last:
+        buckets.append(bucket)
+        bucket = next_bucket(bucket, granularity)
+    return buckets
+
+
+def split_by_metric(metrics, rows):
+    """{metric: {bucket: value}} from rows grouped by bucket and status."""
+    found = {metric: {} for metric in metrics}
+    for row in rows:
+        for metric in metrics:
+            status, field = METRICS[metric]
+            if row['status'] == status:
+                found[metric][row['bucket']] = row[f'value_{metric}']
+    return found
+
+
+def rollup_values(metrics, buckets, granularity):
+    """
+    Every metric from one GROUP BY bucket and status over the daily rollup,
+    truncated to weeks or months when asked.
+    """
+    rows = DailySalesStats.objects.filter(
+        status__in={METRICS[metric][0] for metric in metrics}, date__gte=buckets[0])
+    if granularity in ROLLUP_TRUNCS:
+        rows = rows.annotate(bucket=ROLLUP_TRUNCS[granularity]('date'))
+    else:
+        rows = rows.annotate(bucket=F('date'))
+    rows = rows.values('bucket', 'status').annotate(**{
+        f'value_{metric}': Sum(METRICS[metric][1]) for metric in metrics})
+    return split_by_metric(metrics, rows)
+
+
+def event_values(metrics, buckets):
+    """
+    Hourly values from a TruncHour GROUP BY bucket and status over the status
+    log. Units join the order items, which would repeat the rows the other
+    aggregates count, so they get a query of their own.
+    """
+    found = {}
+    for group in ([metric for metric in metrics if metric != 'units'],
+                  [metric for metric in metrics if metric == 'units']):
+        if not group:
+            continue
+        rows = (
+            OrderStatusEvent.objects.filter(
+                status__in={METRICS[metric][0] for metric in group}, at__gte=buckets[0])
+            .annotate(bucket=TruncHour('at', tzinfo=timezone.get_current_timezone()))
+            .values('bucket', 'status')
+            .annotate(**{f'value_{metric}': EVENT_AGGREGATES[METRICS[metric][1]]()
+                         for metric in group})
+        )
+        found.update(split_by_metric(group, rows))
+    return found
+
+
+def downsample(buckets, values, max_points):
+    """Merge runs of neighbouring buckets so at most `max_points` are left."""
+    size = max(1, math.ceil(len(buckets) / max_points))
+    if size == 1:
+        return buckets, values, size
+    return (
+        buckets[::size],
+        [sum(values[i:i + size]) for i in range(0, len(values), size)],
+        size,
+    )
+
+
+def build_series(metrics, range_value, granularity, now, max_points=None):
+    if granularity not in GRANULARITIES:
+        raise SeriesError(f"granularity must be one of {', '.join(GRANULARITIES)}.")
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if not metrics or unknown:
+        raise SeriesError(f"metric must be one or more of {', '.join(METRICS)}.")
+
+    start = range_start(range_value, now)
+    if now - as_datetime(start) > (MAX_HOUR_RANGE if granularity == 'hour' else MAX_RANGE):
+        raise SeriesError(f"range is too long for {granularity} granularity.")
+
+    buckets = get_buckets(start, now, granularity)
+    max_points = max_points or settings.DASHBOARD_SERIES_MAX_POINTS
+
+    # The same metric asked twice is one series
+    metrics = list(dict.fromkeys(metrics))
+    if granularity == 'hour':
+        found = event_values(metrics, buckets)
+    else:
+        found = rollup_values(metrics, buckets, granularity)
+
+    series = {}
+    for metric in metrics:
+        # Buckets without rows are zero; floats so revenue serializes as a number
+        values = [float(found[metric].get(bucket) or 0) for bucket in buckets]
+        merged, series[metric], bucket_size = downsample(
+            buckets, values, max_points)
+
+    label_format = LABEL_FORMATS[granularity]
+    if granularity == 'month' and len(buckets) <= 12:
+        label_format = '%B'
+    return {
+        'granularity': granularity,
+        'range': range_value,
+        'bucket_size': bucket_size,
+        'buckets': [bucket.isoformat() for bucket in merged],
+        'labels': [bucket.strftime(label_format) for bucket in merged],
+        'series': series,
+    }
@@ -1,3 +1,462 @@
-from django.test import TestCase
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from importlib.util import find_spec
+from io import StringIO
+from random import Random
+from unittest import skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from checkout.models import ArchivedOrder, Order, OrderItem, OrderStatusEvent
+from checkout.transitions import bulk_transition, log_created, transition
+from products.models import Category, Product
+
+from .cards import CARDS, active_buyers_card, orders_card, repeat_purchase_card
+from .cohorts import cohort_retention
+from .hll import HyperLogLog
+from .models import (BuyerSketch, DailySalesStats, LowStockReport,
+                     ProductDailySales, ProductMonthlySales)
+from .rollups import add_to_rollups, rebuild_monthly_sales
+from .series import build_series
+from .views import (DASHBOARD_CACHE_KEY, DASHBOARD_LOCK_KEY,
+                    get_dashboard_context, get_top_products_data)
+
+
+class SalesRollupTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            'buyer', 'buyer@example.com', 'pw')
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        self.product = Product.objects.create(
+            name='p', slug='p', description='d', detail='d', price=Decimal('100'),
+            discount=0, stock=10, category=category)
+        self.now = timezone.now()
+
+    def make_order(self, status='pending'):
+        order = Order.objects.create(
+            user=self.user, total_price=Decimal('200'), status=status)
+        OrderItem.objects.create(order=order, product=self.product, quantity=2,
+                                 discounted_price=Decimal('100'))
+        return order
+
+    def rollup_rows(self):
+        return (list(DailySalesStats.objects.order_by('date', 'status')
+                     .values_list('date', 'status', 'orders', 'revenue', 'units')),
+                list(ProductDailySales.objects.order_by('date', 'product_id')
+                     .values_list('date', 'product_id', 'units', 'revenue')),
+                list(ProductMonthlySales.objects.order_by('month', 'product_id')
+                     .values_list('month', 'product_id', 'units', 'revenue')))
+
+    def test_transitions_update_rollups_incrementally(self):
+        orders = [self.make_order() for _ in range(3)]
+        # The rollups are written once the status changes commit
+        with self.captureOnCommitCallbacks(execute=True):
+            for order in orders:
+                log_created(order)
+                transition(order, 'confirmed')
+            bulk_transition([order.pk for order in orders], 'delivered')
+
+        today = timezone.localdate(self.now)
+        delivered = DailySalesStats.objects.get(date=today, status='delivered')
+        self.assertEqual((delivered.orders, delivered.revenue, delivered.units),
+                         (3, Decimal('600'), 6))
+        self.assertEqual(DailySalesStats.objects.get(
+            date=today, status='pending').orders, 3)
+        sales = ProductDailySales.objects.get(date=today, product=self.product)
+        self.assertEqual((sales.units, sales.revenue), (6, Decimal('600')))
+        month = ProductMonthlySales.objects.get(month=today.replace(day=1), product=self.product)
+        self.assertEqual((month.units, month.revenue), (6, Decimal('600')))
+        self.assertEqual(get_top_products_data(self.now)[
+                         0]['sales_price'], Decimal('600'))
+
+        # A rebuild from the status log gives the same rows
+        call_command('backfill_sales_stats', stdout=StringIO())
+        self.assertEqual(DailySalesStats.objects.get(
+            date=today, status='delivered').revenue, Decimal('600'))
+        self.assertEqual(ProductDailySales.objects.get(
+            date=today, product=self.product).units, 6)
+        self.assertEqual(ProductMonthlySales.objects.get(
+            month=today.replace(day=1), product=self.product).units, 6)
+
+    def test_backfill_keeps_archived_days(self):
+        long_ago = self.now - timedelta(days=800)
+        orders = [self.make_order() for _ in range(2)]
+        for order in orders:
+            log_created(order)
+            transition(order, 'confirmed')
+            transition(order, 'delivered')
+        Order.objects.update(updated_at=long_ago)
+        OrderStatusEvent.objects.update(at=long_ago)
+        live = self.make_order()
+        log_created(live)
+        transition(live, 'confirmed')
+
+        call_command('backfill_sales_stats', stdout=StringIO())
+        before = self.rollup_rows()
+
+        call_command('archive_orders', '--months', '12', stdout=StringIO())
+        self.assertEqual(ArchivedOrder.objects.count(), 2)
+        call_command('backfill_sales_stats', stdout=StringIO())
+
+        old_day = timezone.localdate(long_ago)
+        delivered = DailySalesStats.objects.get(date=old_day, status='delivered')
+        self.assertEqual((delivered.orders, delivered.revenue, delivered.units),
+                         (2, Decimal('400'), 4))
+        self.assertEqual(ProductDailySales.objects.get(date=old_day).units, 4)
+        self.assertEqual(ProductMonthlySales.objects.get(month=old_day.replace(day=1)).units, 4)
+        self.assertEqual(self.rollup_rows(), before)
+
+    def test_backfill_from_a_day_keeps_the_start_of_its_month(self):
+        ProductDailySales.objects.create(
+            date=datetime(2025, 1, 5).date(), product=self.product, units=3)
+        ProductMonthlySales.objects.create(
+            month=datetime(2025, 1, 1).date(), product=self.product, units=99)
+
+        call_command('backfill_sales_stats', '--from', '2025-01-10', stdout=StringIO())
+
+        self.assertEqual(list(ProductMonthlySales.objects.values_list('month', 'units')),
+                         [(datetime(2025, 1, 1).date(), 3)])
+
+    def test_rollups_are_written_after_the_status_change_commits(self):
+        order = self.make_order()
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            # Savepoint, UPDATE, status log INSERT, release: no rollup row
+            with self.assertNumQueries(4):
+                transition(order, 'confirmed')
+            self.assertFalse(DailySalesStats.objects.exists())
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(DailySalesStats.objects.get(status='confirmed').orders, 1)
+
+    def test_series_come_from_one_query(self):
+        order = self.make_order()
+        for i in range(30):
+            add_to_rollups(
+                [order.pk], 'delivered', self.now - timedelta(days=i))
+
+        # The per-day COUNT loops this replaces ran 120 queries (30 days x 4 series)
+        with self.assertNumQueries(1):
+            series = build_series(
+                ['orders', 'delivered', 'cancelled', 'revenue', 'units'], '30d', 'day', self.now)
+
+        self.assertEqual(series['series']['delivered'], [1] * 30)
+        self.assertEqual(series['series']['cancelled'], [0] * 30)
+        self.assertEqual(series['series']['orders'], [0] * 30)
+        self.assertEqual(series['series']['revenue'], [200] * 30)
+        self.assertEqual(series['series']['units'], [2] * 30)
+
+    def test_buckets_are_calendar_days_in_time_zone(self):
+        order = self.make_order()
+        midnight = timezone.make_aware(
+            datetime.combine(timezone.localdate(self.now), time.min))
+        add_to_rollups([order.pk], 'delivered', midnight)
+        add_to_rollups([order.pk], 'delivered',
+                          midnight - timedelta(seconds=1))
+        # Before the first day of the window
+        add_to_rollups([order.pk], 'delivered',
+                          midnight - timedelta(days=29, seconds=1))
+
+        counts = build_series(['delivered'], '30d', 'day', self.now)[
+            'series']['delivered']
+
+        self.assertEqual(counts[-1], 1)
+        self.assertEqual(counts[-2], 1)
+        self.assertEqual(sum(counts), 2)
+
+
+@override_settings(DASHBOARD_CACHE_TTL=timedelta(minutes=5))
+class DashboardCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_fresh_copy_is_served_from_cache(self):
+        first = get_dashboard_context()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_dashboard_context()[
+                             'computed_at'], first['computed_at'])
+
+    def test_stale_copy_is_served_while_another_request_refreshes(self):
+        stale = get_dashboard_context()
+        stale['computed_at'] -= timedelta(minutes=10)
+        cache.set(DASHBOARD_CACHE_KEY, stale)
+        cache.add(DASHBOARD_LOCK_KEY, timezone.now())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_dashboard_context()[
+                             'computed_at'], stale['computed_at'])
+
+        # Once the lock is free the next request refreshes it
+        cache.delete(DASHBOARD_LOCK_KEY)
+        self.assertGreater(get_dashboard_context(refresh=True)[
+                           'computed_at'], stale['computed_at'])
+
+
+class SeriesTest(TestCase):
+    def setUp(self):
+        self.now = timezone.make_aware(datetime(2024, 3, 15, 12))
+
+    def make_products(self, count):
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        return [Product.objects.create(
+            name=f'p{i}', slug=f'p{i}', description='d', detail='d', price=Decimal('25'),
+            discount=0, stock=5, category=category) for i in range(count)]
+
+    def test_revenue_is_grouped_by_calendar_month_in_one_query(self):
+        for date, revenue in (('2024-03-01', 100), ('2024-02-29', 40),
+                              ('2024-02-01', 60), ('2023-04-30', 5)):
+            DailySalesStats.objects.create(
+                date=date, status='delivered', orders=1, revenue=revenue)
+
+        with self.assertNumQueries(1):
+            series = build_series(['revenue'], '12m', 'month', self.now)
+
+        self.assertEqual(series['buckets'][0], '2023-04-01')
+        self.assertEqual(series['series']['revenue'][0], 5)
+        self.assertEqual(series['series']['revenue'][-2:], [100, 100])
+        self.assertEqual(series['labels'][-1], 'March')
+        self.assertEqual(build_series(['revenue'], '2y', 'month', self.now)[
+                         'labels'][-1], 'Mar 2024')
+
+    def test_weeks_start_on_monday(self):
+        # 2024-03-11 is a Monday
+        for date in ('2024-03-10', '2024-03-11', '2024-03-15'):
+            DailySalesStats.objects.create(
+                date=date, status='pending', orders=1)
+
+        series = build_series(['orders'], '2w', 'week', self.now)
+
+        self.assertEqual(series['buckets'], ['2024-03-04', '2024-03-11'])
+        self.assertEqual(series['series']['orders'], [1, 2])
+
+    def test_long_ranges_are_downsampled(self):
+        DailySalesStats.objects.create(
+            date='2024-03-15', status='pending', orders=3)
+
+        series = build_series(['orders'], '1y', 'day', self.now, max_points=50)
+
+        self.assertLessEqual(len(series['buckets']), 50)
+        # 2023-04-01 to 2024-03-15 is 350 days
+        self.assertEqual(series['bucket_size'], 7)
+        self.assertEqual(sum(series['series']['orders']), 3)
+
+    def test_hourly_buckets_read_the_status_log(self):
+        user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+        order = Order.objects.create(
+            user=user, total_price=Decimal('50'), status='delivered')
+        now = timezone.now()
+        order.status_events.create(
+            from_status='confirmed', status='delivered', at=now)
+        order.status_events.create(
+            from_status='confirmed', status='delivered', at=now - timedelta(hours=2))
+
+        order.status_events.create(from_status='pending', status='cancelled', at=now)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=2, discounted_price=Decimal('25'))
+            for product in self.make_products(2)
+        ])
+
+        # Statuses share one query; units join the items and get their own
+        with self.assertNumQueries(1):
+            series = build_series(['revenue', 'delivered', 'cancelled'], '24h', 'hour', now)
+        with self.assertNumQueries(2):
+            units = build_series(['delivered', 'units'], '24h', 'hour', now)
+
+        self.assertEqual(len(series['buckets']), 24)
+        self.assertEqual(series['series']['revenue'][-1], 50)
+        self.assertEqual(series['series']['revenue'][-3], 50)
+        self.assertEqual(sum(series['series']['revenue']), 100)
+        self.assertEqual(series['series']['delivered'][-1], 1)
+        self.assertEqual(sum(series['series']['cancelled']), 1)
+        self.assertEqual(units['series']['delivered'][-1], 1)
+        self.assertEqual(units['series']['units'][-1], 4)
+
+    def test_endpoint_is_staff_only(self):
+        client = APIClient()
+        url = reverse('dashboard-series')
+        user = User.objects.create_user('user', 'user@example.com', 'pw')
+        client.force_authenticate(user)
+        self.assertEqual(client.get(url).status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        response = client.get(
+            url, {'metric': 'orders,revenue', 'range': '7d'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['data']['buckets']), 7)
+        self.assertEqual(set(response.data['data']['series']), {
+                         'orders', 'revenue'})
+
+        self.assertEqual(client.get(url, {'granularity': 'minute'}).status_code, 400)
+        self.assertEqual(client.get(
+            url, {'range': '1y', 'granularity': 'hour'}).status_code, 400)
+
+
+class KpiCardTest(TestCase):
+    def test_each_card_is_one_aggregate(self):
+        now = timezone.now()
+        User.objects.create_user('old', 'old@example.com', 'pw',
+                                 date_joined=now - timedelta(days=10))
+        User.objects.create_user('new', 'new@example.com', 'pw')
+        today = timezone.localdate(now)
+        DailySalesStats.objects.create(
+            date=today, status='delivered', orders=2, revenue=Decimal('300'))
+        DailySalesStats.objects.create(
+            date=today - timedelta(days=8), status='delivered', orders=1, revenue=Decimal('100'))
+
+        cards = {}
+        for build_card in CARDS:
+            # The orders card also reads the archived totals
+            with self.assertNumQueries(2 if build_card is orders_card else 1):
+                built = build_card(now)
+            cards[built['title']] = built
+
+        self.assertEqual(cards['New Customers']['value'], 1)
+        self.assertEqual(cards['New Customers']['increment'], 0.0)
+        self.assertEqual(cards['New Customers']['total_value'], 2)
+        self.assertEqual(cards['Average Order Value']['value'], Decimal('150.00'))
+        self.assertEqual(cards['Average Order Value']['increment'], 50.0)
+        self.assertEqual(cards['Average Order Value']['total_value'], Decimal('133.33'))
+
+
+@skipUnless(find_spec('numpy'), "forecast_stock needs NumPy from requirements-forecast.txt")
+class ForecastStockTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(
+            name='c', slug='c', description='d', quote='q', image='c.png')
+        self.products = {
+            name: Product.objects.create(
+                name=name, slug=name, description='d', detail='d', price=Decimal('10'),
+                discount=0, stock=stock, category=category)
+            for name, stock in (('steady', 20), ('surge', 50), ('idle', 5), ('empty', 0))
+        }
+        yesterday = timezone.localdate() - timedelta(days=1)
+        for i in range(28):
+            ProductDailySales.objects.create(
+                date=yesterday - timedelta(days=i), product=self.products['steady'], units=2)
+        for i in range(7):
+            ProductDailySales.objects.create(
+                date=yesterday - timedelta(days=i), product=self.products['surge'], units=10)
+        # Today is incomplete and left out of the forecast
+        ProductDailySales.objects.create(
+            date=yesterday + timedelta(days=1), product=self.products['idle'], units=100)
+
+    def test_report_ranks_products_by_days_of_cover(self):
+        LowStockReport.objects.create(
+            rank=1, product=self.products['idle'], stock=5, daily_demand=1,
+            days_of_cover=5, stockout_date=timezone.localdate(), computed_at=timezone.now())
+
+        out = StringIO()
+        call_command('forecast_stock', stdout=out)
+
+        reports = list(LowStockReport.objects.values_list(
+            'product__name', 'daily_demand', 'days_of_cover'))
+        # The surge is ranked on its last 7 days (10/day) not its 28 day average
+        self.assertEqual(reports, [('empty', 0.0, 0.0), ('surge', 10.0, 5.0),
+                                   ('steady', 2.0, 10.0)])
+        self.assertIn('4 products', out.getvalue())
+
+    def test_whole_months_are_read_from_the_monthly_rollup(self):
+        # Only importable with NumPy
+        from .forecast import load_stock, load_window_units
+
+        product = self.products['idle']
+        start = datetime(2025, 1, 20).date()
+        for i in range(100):
+            ProductDailySales.objects.create(
+                date=start + timedelta(days=i), product=product, units=i)
+        rebuild_monthly_sales()
+        product_ids, _ = load_stock()
+        row = list(product_ids).index(product.pk)
+
+        # February and March from the monthly rows, the days around them from the daily ones
+        with self.assertNumQueries(2):
+            total, recent = load_window_units(product_ids, start, 100, 7)
+        self.assertEqual((total[row], recent[row]), (sum(range(100)), sum(range(93, 100))))
+
+        # The last 7 days fall in March, read from the monthly rows for the total
+        total, recent = load_window_units(product_ids, start, 72, 7)
+        self.assertEqual((total[row], recent[row]), (sum(range(72)), sum(range(65, 72))))
+
+        # Inside one month only daily rows are read
+        with self.assertNumQueries(1):
+            total, recent = load_window_units(product_ids, start + timedelta(days=42), 20, 7)
+        self.assertEqual((total[row], recent[row]), (sum(range(42, 62)), sum(range(55, 62))))
+
+
+class HyperLogLogTest(TestCase):
+    def sketch(self, values):
+        sketch = HyperLogLog()
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+    def test_estimates_are_within_the_documented_bounds(self):
+        for exact in (300, 5000, 50000):
+            estimate = self.sketch(range(exact)).count()
+            # Well inside 3 standard errors (1.6% each)
+            self.assertLess(abs(estimate - exact) / exact, 0.05, exact)
+        # Linear counting is close to exact for small counts
+        self.assertLessEqual(abs(self.sketch(range(300)).count() - 300), 3)
+
+    def test_merged_daily_sketches_count_the_union(self):
+        random = Random(7)
+        days = [{random.randrange(20000) for _ in range(3000)} for _ in range(7)]
+        exact = len(set().union(*days))
+
+        merged = HyperLogLog.union(self.sketch(day) for day in days)
+
+        # Merging loses nothing: it is the sketch of the union itself
+        self.assertEqual(merged.registers, self.sketch(set().union(*days)).registers)
+        self.assertLess(abs(merged.count() - exact) / exact, 0.05)
+
+    def test_sketches_round_trip_through_bytes(self):
+        small, large = self.sketch(range(50)), self.sketch(range(20000))
+        self.assertLess(len(small.to_bytes()), 200)
+        for sketch in (small, large):
+            self.assertEqual(HyperLogLog.from_bytes(
+                sketch.to_bytes()).registers, sketch.registers)
+
+
+class BuyerSketchTest(TestCase):
+    def test_buyers_are_counted_from_the_sketches(self):
+        now = timezone.now()
+        users = [User.objects.create_user(f'user{i}', f'user{i}@example.com', 'pw')
+                 for i in range(40)]
+        # Every user orders once, the first ten twice
+        for user in users + users[:10]:
+            with self.captureOnCommitCallbacks(execute=True):
+                log_created(Order.objects.create(user=user, total_price=Decimal('10')))
+
+        self.assertEqual(active_buyers_card(now)['value'], 40)
+        # 10 of the 40 buyers came back
+        self.assertEqual(repeat_purchase_card(now)['value'], 25.0)
+        cohort = cohort_retention(now, 3)[-1]
+        self.assertEqual((cohort['size'], cohort['active'][0]['buyers']), (40, 40))
+
+        # A rebuild from the orders gives the same sketches
+        before = dict(BuyerSketch.objects.values_list('key', 'sketch'))
+        call_command('backfill_sales_stats', stdout=StringIO())
+        after = dict(BuyerSketch.objects.values_list('key', 'sketch'))
+        self.assertEqual({key: bytes(sketch) for key, sketch in before.items()},
+                         {key: bytes(sketch) for key, sketch in after.items()})
+
+    def test_sketches_are_written_after_the_order_commits(self):
+        user = User.objects.create_user('buyer', 'buyer@example.com', 'pw')
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            log_created(Order.objects.create(user=user, total_price=Decimal('10')))
+            self.assertFalse(BuyerSketch.objects.exists())
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(active_buyers_card(timezone.now())['value'], 1)
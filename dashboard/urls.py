@@ -0,0 +1,9 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    # Chart data for the admin dashboard, staff only
+    path('series/',
+         views.DashboardViewSet.as_view({'get': 'get_series'}), name="dashboard-series"),
+]
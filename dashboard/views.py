@@ -1,110 +1,39 @@
-import random
 from datetime import timedelta
 
-from django.contrib.auth.models import User
-from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Sum
 from django.utils import timezone
+from rest_framework import status, viewsets
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.permissions import IsAdminUser
 
-from checkout.models import Order, OrderItem
-from products.models import Category, Product
-
-
-def get_last_6_months_labels(now):
-    return [(now - timedelta(days=30 * i)).strftime('%B') for i in range(6)][::-1]
-
-
-def calculate_revenues(now):
-    revenues = []
-    for i in range(6):
-        start_date = (now - timedelta(days=30 * (i + 1)))
-        end_date = (now - timedelta(days=30 * i))
-        revenue = Order.objects.filter(
-            status='delivered',
-            updated_at__range=[start_date, end_date]
-        ).aggregate(total_revenue=Sum('total_price'))['total_revenue'] or 0
-        revenues.append(revenue)
-    return revenues
-
-
-def get_last_30_days_labels(now):
-    return [(now - timedelta(days=i)).strftime('%b %d') for i in range(30)][::-1]
-
-
-def calculate_last_30_days_sales(now):
-    sales = []
-    for i in range(30):
-        day_start = now - timedelta(days=i + 1)
-        day_end = now - timedelta(days=i)
-        sales_count = Order.objects.filter(
-            status='delivered',
-            updated_at__range=[day_start, day_end]
-        ).count()
-        sales.append(sales_count)
-    return sales[::-1]
-
-
-def calculate_order_status_counts(now):
-    confirmed_orders = []
-    delivered_orders = []
-    cancelled_orders = []
-
-    for i in range(30):
-        day_start = now - timedelta(days=i + 1)
-        day_end = now - timedelta(days=i)
-
-        confirmed_count = Order.objects.filter(
-            status='confirmed',
-            updated_at__range=[day_start, day_end]
-        ).count()
-        delivered_count = Order.objects.filter(
-            status='delivered',
-            updated_at__range=[day_start, day_end]
-        ).count()
-        cancelled_count = Order.objects.filter(
-            status='cancelled',
-            updated_at__range=[day_start, day_end]
-        ).count()
-
-        confirmed_orders.append(confirmed_count)
-        delivered_orders.append(delivered_count)
-        cancelled_orders.append(cancelled_count)
-
-    return confirmed_orders[::-1], delivered_orders[::-1], cancelled_orders[::-1]
-
-
-def populate_random_data(revenues, last_30_days_sales, confirmed_orders, delivered_orders, cancelled_orders):
-    if all(revenue == 0 for revenue in revenues):
-        revenues = [random.randint(1000, 5000) for _ in range(6)]
-    if all(sales == 0 for sales in last_30_days_sales):
-        last_30_days_sales = [random.randint(40, 100) for _ in range(30)]
-    if all(order == 0 for order in confirmed_orders) and all(order == 0 for order in delivered_orders) and all(order == 0 for order in cancelled_orders):
-        confirmed_orders = [random.randint(17, 20) for _ in range(30)]
-        delivered_orders = [random.randint(17, 20) for _ in range(30)]
-        cancelled_orders = [random.randint(0, 4) for _ in range(30)]
-    return revenues, last_30_days_sales, confirmed_orders, delivered_orders, cancelled_orders
+from accounts.authentication import ClaimsJWTAuthentication
+from revvona.utils import error_response, success_response
+
+from .cards import CARDS
+from .cohorts import cohort_retention
+from .models import ProductDailySales
+from .series import SeriesError, build_series
 
 
 def get_top_products_data(now):
-    last_7_days = now - timedelta(days=7)
-    previous_week = now - timedelta(days=14)
+    today = timezone.localdate(now)
+    last_7_days = today - timedelta(days=7)
+    previous_week = today - timedelta(days=14)
 
     top_products_last_7_days = (
-        OrderItem.objects.filter(
-            order__status='delivered',
-            order__updated_at__gte=last_7_days
-        )
+        ProductDailySales.objects.filter(date__gt=last_7_days)
         .values(product_name=F('product__name'))
-        .annotate(sales_price=Sum(F('product__price') * F('quantity'), output_field=DecimalField()))
+        .annotate(sales_price=Sum('revenue'))
         .order_by('-sales_price')[:3]
     )
 
     top_products_previous_week = (
-        OrderItem.objects.filter(
-            order__status='delivered',
-            order__updated_at__range=[previous_week, last_7_days]
-        )
+        ProductDailySales.objects.filter(
+            date__gt=previous_week, date__lte=last_7_days)
         .values(product_name=F('product__name'))
-        .annotate(sales_price=Sum(F('product__price') * F('quantity'), output_field=DecimalField()))
+        .annotate(sales_price=Sum('revenue'))
     )
 
     previous_week_sales = {item['product_name']: item['sales_price']
@@ -133,111 +62,78 @@ def get_top_products_data(now):
     return products_data
 
 
-def get_new_customers(now):
-    last_7_days = now - timedelta(days=7)
-    previous_7_days = now - timedelta(days=14)
-
-    current_customers = User.objects.filter(
-        date_joined__gte=last_7_days,
-        is_staff=False  # Exclude staff users
-    ).count()
+DASHBOARD_CACHE_KEY = 'dashboard:context'
+DASHBOARD_LOCK_KEY = 'dashboard:context:refreshing'
+# Stale copies are kept this long so there is always something to serve
+DASHBOARD_STALE_TIMEOUT = 24 * 60 * 60
+# A refresh that crashed without releasing the lock stops blocking after this
+DASHBOARD_LOCK_TIMEOUT = 60
 
-    previous_customers = User.objects.filter(
-        date_joined__range=[previous_7_days, last_7_days],
-        is_staff=False  # Exclude staff users
-    ).count()
-
-    increment = calculate_increment(current_customers, previous_customers)
 
+def build_dashboard_context(now):
+    # The charts are fetched from the series endpoint once the page has loaded
     return {
-        'name': 'Customers',
-        'value': current_customers,
-        'increment': round(increment, 2),
-        # Total customers excluding staff
-        'total_value': User.objects.filter(is_staff=False).count()
+        'top_products': get_top_products_data(now),
+        'card_items': [build_card(now) for build_card in CARDS],
+        'cohorts': cohort_retention(now, settings.DASHBOARD_COHORT_MONTHS),
     }
 
 
-def get_new_products(now):
-    last_7_days = now - timedelta(days=7)
-    previous_7_days = now - timedelta(days=14)
-
-    current_products = Product.objects.filter(
-        created_at__gte=last_7_days).count()
-    previous_products = Product.objects.filter(
-        created_at__range=[previous_7_days, last_7_days]).count()
-
-    increment = calculate_increment(current_products, previous_products)
-
-    return {
-        'name': 'Products',
-        'value': current_products,
-        'increment': round(increment, 2),
-        'total_value': Product.objects.count()  # Total products
-    }
-
-
-def get_new_categories(now):
-    last_7_days = now - timedelta(days=7)
-    previous_7_days = now - timedelta(days=14)
-
-    current_categories = Category.objects.filter(
-        created_at__gte=last_7_days).count()
-    previous_categories = Category.objects.filter(
-        created_at__range=[previous_7_days, last_7_days]).count()
-
-    increment = calculate_increment(current_categories, previous_categories)
-
-    return {
-        'name': 'Categories',
-        'value': current_categories,
-        'increment': round(increment, 2),
-        'total_value': Category.objects.count()  # Total categories
-    }
-
-
-def calculate_increment(current_count, previous_count):
-    if previous_count == 0:
-        return 100.0 if current_count > 0 else 0.0  # Handle division by zero
-    return ((current_count - previous_count) / previous_count) * 100
-
-
-def dashboard_callback(request, context):
+def get_dashboard_context(refresh=False):
+    """
+    Stale-while-revalidate: a fresh cached copy is served as is. Once it is
+    older than DASHBOARD_CACHE_TTL (or on `refresh`), the request that wins
+    the lock recomputes it while everyone else keeps getting the old copy.
+    """
     now = timezone.now()
+    entry = cache.get(DASHBOARD_CACHE_KEY)
+    if entry and not refresh and now - entry['computed_at'] < settings.DASHBOARD_CACHE_TTL:
+        return entry
 
-    last_6_months_labels = get_last_6_months_labels(now)
-    revenues = calculate_revenues(now)
-    last_30_days = get_last_30_days_labels(now)
-    last_30_days_sales = calculate_last_30_days_sales(now)
-    confirmed_orders, delivered_orders, cancelled_orders = calculate_order_status_counts(
-        now)
+    # cache.add is atomic, so only one request gets to refresh
+    if not cache.add(DASHBOARD_LOCK_KEY, now, DASHBOARD_LOCK_TIMEOUT):
+        if entry:
+            return entry
+        # Nothing to serve yet (cold cache), compute without storing it
+        return {'context': build_dashboard_context(now), 'computed_at': now}
 
-    # Check for empty data and populate with random values
-    revenues, last_30_days_sales, confirmed_orders, delivered_orders, cancelled_orders = populate_random_data(
-        revenues, last_30_days_sales, confirmed_orders, delivered_orders, cancelled_orders
-    )
+    try:
+        entry = {'context': build_dashboard_context(now), 'computed_at': now}
+        cache.set(DASHBOARD_CACHE_KEY, entry, DASHBOARD_STALE_TIMEOUT)
+    finally:
+        cache.delete(DASHBOARD_LOCK_KEY)
+    return entry
 
-    top_products = get_top_products_data(now)
 
-    card_items = [
-        get_new_customers(now),
-        get_new_products(now),
-        get_new_categories(now)
-    ]
+def dashboard_callback(request, context):
+    # Staff can force a recompute with the refresh link on the dashboard
+    entry = get_dashboard_context(refresh=request.GET.get('refresh') == '1')
 
     # Update context
-    context.update(
-        {
-            'last_6_months_labels': last_6_months_labels,
-            'revenues': revenues,
-            'last_30_days': last_30_days,
-            'last_30_days_sales': last_30_days_sales,
-            'confirmed_orders': confirmed_orders,
-            'delivered_orders': delivered_orders,
-            'cancelled_orders': cancelled_orders,
-            'top_products': top_products,
-            'card_items': card_items
-        }
-    )
+    context.update(entry['context'])
+    context['dashboard_computed_at'] = entry['computed_at']
+    context['revenue_months_range'] = f"{settings.DASHBOARD_REVENUE_MONTHS}m"
+    context['revenue_months_badge'] = f"last {settings.DASHBOARD_REVENUE_MONTHS} months"
 
     return context
+
+
+class DashboardViewSet(viewsets.ViewSet):
+    # Session auth lets the admin pages fetch the charts with the staff login
+    authentication_classes = [SessionAuthentication, ClaimsJWTAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get_series(self, request):
+        try:
+            metrics = request.query_params.get('metric', 'orders').split(',')
+            series = build_series(
+                [metric.strip() for metric in metrics if metric.strip()],
+                request.query_params.get('range', '30d'),
+                request.query_params.get('granularity', 'day'),
+                timezone.now(),
+            )
+            return success_response(series, "Series retrieved successfully")
+        except SeriesError as e:
+            return error_response("Invalid series parameters.", str(e))
+        except Exception as e:
+            return error_response("An error occurred while fetching the series.", str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -0,0 +1,24 @@
+from django.contrib import admin
+from django.utils import timezone
+from unfold.admin import ModelAdmin
+
+from .models import OutboxEmail
+
+
+class OutboxEmailAdmin(ModelAdmin):
+    list_display = ('id', 'subject', 'status', 'attempts',
+                    'next_attempt_at', 'created_at', 'sent_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('subject', 'to')
+    readonly_fields = ('subject', 'from_email', 'to', 'body', 'html_body',
+                       'attempts', 'last_error', 'created_at', 'sent_at')
+    actions = ['retry_now']
+
+    @admin.action(description="Retry selected emails now")
+    def retry_now(self, request, queryset):
+        updated = queryset.exclude(status='sent').update(
+            status='pending', attempts=0, next_attempt_at=timezone.now())
+        self.message_user(request, f"{updated} emails queued for sending.")
+
+
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
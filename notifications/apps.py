@@ -0,0 +1,18 @@
+from django.apps import AppConfig
+from django.template.loader import get_template
+
+
+class NotificationsConfig(AppConfig):
+    default_auto_field = "django.db.models.BigAutoField"
+    name = "notifications"
+
+    # Compiled into the cached template loader at startup, so the first email
+    # a worker renders doesn't pay for finding and parsing the template
+    email_templates = (
+        'emails/account_verification.html',
+        'emails/order_confirmation.html',
+    )
+
+    def ready(self):
+        for template_name in self.email_templates:
+            get_template(template_name)
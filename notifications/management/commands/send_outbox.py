@@ -0,0 +1,46 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from notifications.outbox import send_batch
+
+
+class Command(BaseCommand):
+    help = "Send queued outbox emails in batches over one SMTP connection per batch."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help="Emails sent per connection (default: 50).")
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help="Attempts before an email is marked dead (default: 5).")
+        parser.add_argument('--backoff', type=int, default=60,
+                            help="Seconds before the first retry, doubled on every further failure (default: 60).")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep polling the outbox instead of exiting once it is drained.")
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help="Seconds to wait between polls in --loop mode (default: 5).")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['max_attempts'] < 1:
+            raise CommandError(
+                "--batch-size and --max-attempts must be at least 1.")
+
+        backoff = timedelta(seconds=options['backoff'])
+        totals = [0, 0, 0]
+
+        while True:
+            sent, retried, dead = send_batch(
+                options['batch_size'], options['max_attempts'], backoff)
+            totals = [total + count for total,
+                      count in zip(totals, (sent, retried, dead))]
+
+            # A full batch means there is probably more waiting
+            if sent + retried + dead == options['batch_size']:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Sent {totals[0]} emails, {totals[1]} to retry, {totals[2]} dead."))
@@ -0,0 +1,91 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+
+def enqueue_email(subject, to, html_message='', message='', from_email=None):
+    """
+    Queue an email for the send_outbox worker. Call it inside the transaction
+    that makes the email true, so it is only sent if that change commits.
+    """
+    return OutboxEmail.objects.create(
+        subject=subject,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL or '',
+        to=list(to),
+        body=message,
+        html_body=html_message,
+    )
+
+
+def build_message(email, connection):
+    message = EmailMultiAlternatives(
+        email.subject, email.body, email.from_email or None, email.to, connection=connection)
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def send_batch(batch_size=50, max_attempts=5, backoff=timedelta(minutes=1), connection=None):
+    """
+    Send up to `batch_size` due emails over a single connection and return
+    (sent, retried, dead). Failed emails are retried with exponential backoff
+    and marked dead after `max_attempts`.
+    """
+    now = timezone.now()
+    sent = retried = dead = 0
+
+    with transaction.atomic():
+        # skip_locked lets several workers drain the outbox without sending twice
+        batch = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        if not batch:
+            return sent, retried, dead
+
+        for email in batch:
+            email.attempts += 1
+
+        connection = connection or get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            # The server is unreachable, every email in the batch failed this attempt
+            failures = [(email, e) for email in batch]
+        else:
+            failures = []
+            try:
+                for email in batch:
+                    try:
+                        connection.send_messages(
+                            [build_message(email, connection)])
+                    except Exception as e:
+                        failures.append((email, e))
+                    else:
+                        email.status = 'sent'
+                        email.sent_at = timezone.now()
+                        email.last_error = ''
+                        sent += 1
+            finally:
+                connection.close()
+
+        for email, error in failures:
+            email.last_error = str(error)
+            if email.attempts >= max_attempts:
+                email.status = 'dead'
+                dead += 1
+            else:
+                email.next_attempt_at = now + \
+                    backoff * 2 ** (email.attempts - 1)
+                retried += 1
+
+        OutboxEmail.objects.bulk_update(
+            batch, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+
+    return sent, retried, dead
@@ -0,0 +1,81 @@
+from datetime import timedelta
+from io import StringIO
+from smtplib import SMTPException
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .models import OutboxEmail
+from .outbox import enqueue_email, send_batch
+
+
+class FlakyBackend(EmailBackend):
+    """locmem backend that refuses a given recipient, like a bouncing SMTP server."""
+
+    def __init__(self, *args, refuse='bad@example.com', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.refuse = refuse
+        self.opened = 0
+
+    def open(self):
+        self.opened += 1
+
+    def send_messages(self, messages):
+        if any(self.refuse in message.to for message in messages):
+            raise SMTPException("550 mailbox unavailable")
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                   DEFAULT_FROM_EMAIL='shop@example.com')
+class OutboxTest(TestCase):
+    def test_enqueue_does_not_send(self):
+        enqueue_email("Hello", ['a@example.com'], html_message="<p>Hi</p>")
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxEmail.objects.get().status, 'pending')
+
+    def test_batch_is_sent_over_one_connection(self):
+        for i in range(3):
+            enqueue_email(f"Hello {i}", [f'user{i}@example.com'],
+                          html_message="<p>Hi</p>")
+        backend = FlakyBackend()
+
+        self.assertEqual(send_batch(connection=backend), (3, 0, 0))
+        self.assertEqual(backend.opened, 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[0].from_email, 'shop@example.com')
+        self.assertEqual(mail.outbox[0].alternatives[0][1], 'text/html')
+        self.assertFalse(OutboxEmail.objects.exclude(status='sent').exists())
+
+    def test_failures_back_off_then_go_dead(self):
+        enqueue_email("Hello", ['bad@example.com'])
+        enqueue_email("Hello", ['good@example.com'])
+
+        self.assertEqual(send_batch(connection=FlakyBackend(),
+                         max_attempts=2, backoff=timedelta(minutes=1)), (1, 1, 0))
+        failed = OutboxEmail.objects.get(to=['bad@example.com'])
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn('550', failed.last_error)
+        self.assertGreater(failed.next_attempt_at, timezone.now())
+
+        # Not due yet, so nothing is picked up
+        self.assertEqual(send_batch(connection=FlakyBackend()), (0, 0, 0))
+
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_batch(connection=FlakyBackend(),
+                         max_attempts=2), (0, 0, 1))
+        self.assertEqual(OutboxEmail.objects.get(
+            to=['bad@example.com']).status, 'dead')
+
+    def test_send_outbox_command_drains_queue(self):
+        for i in range(5):
+            enqueue_email(f"Hello {i}", [f'user{i}@example.com'])
+
+        call_command('send_outbox', '--batch-size', '2', stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(OutboxEmail.objects.filter(status='sent').count(), 5)
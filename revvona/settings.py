@@ -1,8 +1,11 @@
 import os
+import sys
 from datetime import timedelta
 from pathlib import Path
 from urllib.parse import urlparse
 
+from corsheaders.defaults import default_headers
+from django.core.exceptions import ImproperlyConfigured
 from django.templatetags.static import static
 from django.urls import reverse_lazy
 from django.utils.translation import gettext_lazy as _
@@ -44,6 +47,7 @@ INSTALLED_APPS = [
     'checkout',
     'dashboard',
     'about',
+    'notifications',
 ]
 
 MIDDLEWARE = [
@@ -94,6 +98,47 @@ DATABASES = {
     }
 }
 
+# Set REDIS_URL in production so every worker shares one cache; each process
+# gets its own local memory cache otherwise.
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Token revocations, claim changes and cached users (accounts.authentication)
+# live in their own cache: every worker must see them and they must never be
+# evicted, or a revoked token would be trusted again. Point AUTH_REDIS_URL (or
+# REDIS_URL) at a Redis with maxmemory-policy noeviction, separate from the
+# default cache if that one is allowed to evict. Without one the local memory
+# fallback only suits a single process, and production refuses to start.
+AUTH_REDIS_URL = os.getenv('AUTH_REDIS_URL', REDIS_URL)
+if AUTH_REDIS_URL:
+    CACHES['auth'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': AUTH_REDIS_URL,
+    }
+else:
+    CACHES['auth'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'auth',
+        # Never culled; entries only go when they expire
+        'OPTIONS': {'MAX_ENTRIES': sys.maxsize},
+    }
+    if os.getenv('ENV') == 'PROD':
+        raise ImproperlyConfigured(
+            "Set AUTH_REDIS_URL or REDIS_URL in production: token revocations "
+            "must be shared by every worker.")
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -121,8 +166,11 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=300),
     # User will be logged in for 10 days
     'REFRESH_TOKEN_LIFETIME': timedelta(days=10),
-    'ROTATE_REFRESH_TOKENS': False,
-    'BLACKLIST_AFTER_ROTATION': True,
+    # Every refresh returns a new refresh token and revokes the old one. The
+    # revocation list lives in the cache (accounts.authentication), not in
+    # simplejwt's blacklist tables
+    'ROTATE_REFRESH_TOKENS': True,
+    'BLACKLIST_AFTER_ROTATION': False,
     'UPDATE_LAST_LOGIN': False,
 
     'ALGORITHM': 'HS256',
@@ -158,10 +206,41 @@ if os.getenv('ENV') == 'PROD':
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        'accounts.authentication.ClaimsJWTAuthentication',
+    ),
+    # Proxies in front of the app that add the client address to
+    # X-Forwarded-For (Vercel's edge is one). The throttles take the address
+    # the outermost of them saw, never what the client sent itself; with 0
+    # they use REMOTE_ADDR and ignore the header
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', 1 if os.getenv('ENV') == 'PROD' else 0)),
+}
+
+# Sliding-window limits on the account endpoints (accounts.throttling), per
+# client IP and per submitted username/email or logged-in user. Rates are
+# "<requests>/<period>" with the period in s, m, h or d, e.g. "5/15m".
+AUTH_THROTTLE_RATES = {
+    'login': {
+        'ip': os.getenv('LOGIN_IP_RATE', '20/m'),
+        'username': os.getenv('LOGIN_USERNAME_RATE', '5/15m'),
+        # Every IP together, so guesses spread over many IPs are capped too;
+        # looser, as the owner is locked out once it's reached
+        'account': os.getenv('LOGIN_ACCOUNT_RATE', '50/h'),
+    },
+    'register': {
+        'ip': os.getenv('REGISTER_IP_RATE', '5/h'),
+        'email': os.getenv('REGISTER_EMAIL_RATE', '3/h'),
+    },
+    'password': {
+        'ip': os.getenv('PASSWORD_IP_RATE', '20/h'),
+        'user': os.getenv('PASSWORD_USER_RATE', '5/h'),
+    },
 }
 
+# How long a user's fields stay cached for the JWT authentication; saves
+# and deletes clear the entry straight away
+USER_CACHE_TTL = timedelta(
+    seconds=int(os.getenv('USER_CACHE_TTL_SECONDS', 300)))
+
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 STATIC_ROOT = BASE_DIR / 'staticfiles'
@@ -179,6 +258,8 @@ CLOUDINARY_STORAGE = {
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ALLOW_ALL_ORIGINS = True
+# Lets clients send Idempotency-Key on checkout requests
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
 
 # Email settings
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -189,6 +270,40 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_PASS')
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL')
 EMAIL_USE_TLS = True
 
+# Payment gateway settings, PAYMENT_GATEWAY=fake uses an in-process fake for tests and load runs
+PAYMENT_GATEWAY = os.getenv('PAYMENT_GATEWAY', 'razorpay')
+RAZORPAY_API_KEY = os.getenv('RAZORPAY_API_KEY')
+RAZORPAY_API_SECRET = os.getenv('RAZORPAY_API_SECRET')
+RAZORPAY_WEBHOOK_SECRET = os.getenv('RAZORPAY_WEBHOOK_SECRET')
+RAZORPAY_CONNECT_TIMEOUT = float(os.getenv('RAZORPAY_CONNECT_TIMEOUT', 3.05))
+RAZORPAY_READ_TIMEOUT = float(os.getenv('RAZORPAY_READ_TIMEOUT', 10))
+
+# Stock reserved by an order is held this long while waiting for the payment
+STOCK_RESERVATION_TTL = timedelta(
+    minutes=int(os.getenv('STOCK_RESERVATION_TTL_MINUTES', 15)))
+
+# A retry sent while the first request with its Idempotency-Key is still
+# running waits this long for that request's response
+IDEMPOTENCY_WAIT = timedelta(
+    seconds=int(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 10)))
+# A key claimed longer ago than this without a response is taken over by the
+# next request, as the worker that claimed it has died. Keep it well above
+# the slowest checkout request, gateway timeouts included
+IDEMPOTENCY_LEASE = timedelta(
+    seconds=int(os.getenv('IDEMPOTENCY_LEASE_SECONDS', 60)))
+
+# The admin dashboard is recomputed at most this often; older copies are
+# served while a single request refreshes them
+DASHBOARD_CACHE_TTL = timedelta(
+    seconds=int(os.getenv('DASHBOARD_CACHE_TTL_SECONDS', 300)))
+# Calendar months shown on the dashboard revenue chart
+DASHBOARD_REVENUE_MONTHS = int(os.getenv('DASHBOARD_REVENUE_MONTHS', 6))
+# Signup cohorts shown on the dashboard retention table
+DASHBOARD_COHORT_MONTHS = int(os.getenv('DASHBOARD_COHORT_MONTHS', 6))
+# Longer dashboard series are merged down to at most this many points
+DASHBOARD_SERIES_MAX_POINTS = int(
+    os.getenv('DASHBOARD_SERIES_MAX_POINTS', 200))
+
 # Frontend and Brand settings
 FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://localhost:3000')
 BRAND_NAME = os.getenv('BRAND_NAME', 'REVVONA')
@@ -269,6 +384,11 @@ UNFOLD = {
                         "icon": "potted_plant",
                         "link": reverse_lazy("admin:products_product_changelist"),
                     },
+                    {
+                        "title": _("Low Stock"),
+                        "icon": "production_quantity_limits",
+                        "link": reverse_lazy("admin:dashboard_lowstockreport_changelist"),
+                    },
                 ],
             },
             {
@@ -311,6 +431,32 @@ UNFOLD = {
                         "icon": "payment",
                         "link": reverse_lazy("admin:checkout_payment_changelist"),
                     },
+                    {
+                        "title": _("Stock Reservations"),
+                        "icon": "inventory",
+                        "link": reverse_lazy("admin:checkout_stockreservation_changelist"),
+                    },
+                    {
+                        "title": _("Status History"),
+                        "icon": "history",
+                        "link": reverse_lazy("admin:checkout_orderstatusevent_changelist"),
+                    },
+                    {
+                        "title": _("Archived Orders"),
+                        "icon": "inventory_2",
+                        "link": reverse_lazy("admin:checkout_archivedorder_changelist"),
+                    },
+                ],
+            },
+            {
+                "title": _("Notifications"),
+                "collapsible": True,
+                "items": [
+                    {
+                        "title": _("Email Outbox"),
+                        "icon": "outgoing_mail",
+                        "link": reverse_lazy("admin:notifications_outboxemail_changelist"),
+                    },
                 ],
             },
             {
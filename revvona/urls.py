@@ -9,6 +9,7 @@ urlpatterns = [
     path('api/v1/cart/', include('cart.urls')),
     path('api/v1/checkout/', include('checkout.urls')),
     path('api/v1/about/', include('about.urls')),
+    path('api/v1/dashboard/', include('dashboard.urls')),
     path('', admin.site.urls),
 ]
 